@@ -2,19 +2,30 @@
 
 import argparse
 import collections
+import concurrent.futures
 import glob
+import gzip
+import hashlib
+import io
 import json
 import logging
 import os
+import posixpath
+import random
 import re
 import shutil
 import sqlite3
+import struct
+import subprocess
+import sys
 import tarfile
 import tempfile
+import threading
 import time
 import urllib
 import urllib.parse
 import zipfile
+import zlib
 
 import requests
 from bs4 import BeautifulSoup as bs  # pip install bs4
@@ -80,6 +91,52 @@ class Configuration:
     domain = "docs.microsoft.com"
     default_theme_uri = "_themes/docs.theme/master/en-us/_themes"
 
+    # locale of the crawled urls when --locales is not given, the Documents layout always uses it
+    default_locale = "en-us"
+    locale_pattern = re.compile(r"^/[a-z]{2}-[a-z]{2}/", re.IGNORECASE)
+    theme_uri_pattern = re.compile(r"^_themes/docs\.theme/master/[a-z]{2}-[a-z]{2}/_themes", re.IGNORECASE)
+
+    # bump whenever rewrite_soup output may change on any page (new rule, rule matching other elements, parser),
+    # invalidates every cached rewritten page
+    rewrite_rules_version = 2
+
+    # bump a single rule, named as in --profile-rewrite, when only what it does to its matches changes :
+    # only the cached pages it fired on are rewritten again. Unlisted rules are at version 1.
+    rewrite_rule_versions = {}
+    rewrite_parser = "html.parser"
+
+    # crawl priorities, lowest first : the most used reference is available early in snapshots
+    crawl_priorities = {
+        'sdk-api reference': 0,  # functions, structures, interfaces and enums
+        'ADSchema classes': 1,
+        'sdk-api index': 2,
+        'sdk-api': 2,
+        'win32': 3,  # guides and every other win32 page
+    }
+
+    # docSet.dsidx page size, 4096 matching the filesystem block size
+    index_page_size = 4096
+
+    # content toc category -> searchIndex type
+    index_types = {
+        # win32 content
+        "guides": "Guide",
+        "attributes": "Attribute",
+        "classes": "Class",
+        "entries": "Entry",
+
+        # api-sdk content
+        "categories": "Category",
+        "files": "File",
+
+        'callbacks': "Callback",
+        'functions': "Function",
+        'enums': "Enum",
+        'interfaces': "Interface",
+        'structures': "Structure",
+
+    }
+
     def __init__(self, args):
         # # selected powershell api version
         # self.powershell_version = args.version
@@ -89,15 +146,26 @@ class Configuration:
 
         # build folder (must be cleaned afterwards)
         # self.build_folder = os.path.join(os.getcwd(), "_build_{0:s}".format(self.powershell_version))
-        self.build_folder = os.path.join(os.getcwd(), "_build_msdn")
+        self.build_folder = getattr(args, "build_dir", None) or os.path.join(os.getcwd(), "_build_msdn")
 
         # output file
         self.output_filepath = os.path.realpath(args.output)
 
+        # docs and source archives hosts, can be pointed to a mirror or a stand-in server
+        self.docs_url = getattr(args, "base_url", None) or "https://docs.microsoft.com"
+        sources_url = getattr(args, "sources_url", None) or "https://github.com"
+        self.win32_source_url = "%s/MicrosoftDocs/win32/archive/refs/heads/docs.zip" % sources_url
+        self.sdk_api_source_url = "%s/MicrosoftDocs/sdk-api/archive/refs/heads/docs.zip" % sources_url
+
+        # docsets to build : the contents are crawled in the first locale, only the html pages are
+        # fetched again for the other ones
+        self.locales = getattr(args, "locales", None) or [Configuration.default_locale]
+        self.locale = self.locales[0]
+
         # powershell docs start page
-        self.api_index_url = "https://docs.microsoft.com/en-us/windows/win32/api/"
+        self.api_index_url = "%s/windows/win32/api/" % self.locale_url
 
-        self.docs_index_url = "https://docs.microsoft.com/en-us/windows/win32/desktop-app-technologies"
+        self.docs_index_url = "%s/windows/win32/desktop-app-technologies" % self.locale_url
 
         # # powershell docs table of contents url
         # self.docs_toc_url =  "https://{0:s}/psdocs/toc.json?{2:s}".format(
@@ -110,76 +178,1007 @@ class Configuration:
         #     Configuration.base_url
         # )
 
-        # selenium webdriver
-        self.webdriver = PoshWebDriver()
+        # selenium webdriver, started on first use
+        self._webdriver = None
+
+        # concurrent requests of the crawl, the shared transport keeps as many connections alive
+        self.http_connections = getattr(args, "connections", None) or 8
+        transport.set_pool_size(self.http_connections)
 
         self.crawl_contents = True
 
+        # crawl only the directories of this shard : (index, count)
+        self.shard = getattr(args, "shard", None) or (0, 1)
+
+        # "tgz" archive to extract, or "tarix" docset folder which stays compressed once installed
+        self.output_format = getattr(args, "format", "tgz")
+
+        # tgz archive compression, "gzip" or "zstd", and compression threads count
+        self.compression = getattr(args, "compression", "gzip")
+        self.compression_jobs = getattr(args, "jobs", None) or os.cpu_count()
+
+        # losslessly recompress png and jpeg images
+        self.optimize_images = getattr(args, "optimize_images", False)
+
+        # FTS5 index of the page bodies in docSet.dsidx
+        self.fulltext = getattr(args, "fulltext", False)
+
+        # manifest of a previous build, to create a delta update package against
+        self.previous_manifest = getattr(args, "previous_manifest", None)
+
+        # count and time every rewrite rule
+        self.profile_rewrite = getattr(args, "profile_rewrite", False)
+
+        # build a partial docset every snapshot_interval seconds of crawl, and whenever a crawl priority is done
+        snapshot_interval = getattr(args, "snapshot_interval", None)
+        self.snapshot_interval = snapshot_interval * 60 if snapshot_interval else None
+
+        # what to do with links to documents the build did not produce : "online" or "drop"
+        self.dead_link_policy = getattr(args, "dead_links", "online")
+
         # selected module
         # self.filter_modules = [module.lower() for module in args.modules]
 
+    @property
+    def locale_url(self):
+        """ docs url of the locale being built, e.g. https://docs.microsoft.com/de-de """
+        return "%s/%s" % (self.docs_url, self.locale)
+
+    def localize_url(self, url: str, locale: str):
+        """ same docs page url in another locale """
+        if not url.startswith(self.locale_url + "/"):
+            return url
+        return "%s/%s%s" % (self.docs_url, locale, url[len(self.locale_url):])
+
+    def locale_filepath(self, filepath: str, locale: str):
+        """ output (or previous manifest) of a locale docset, in a per-locale subfolder when several are built """
+        if filepath is None or len(self.locales) == 1:
+            return filepath
+        return os.path.join(os.path.dirname(filepath), locale, os.path.basename(filepath))
+
+    @property
+    def webdriver(self):
+        if self._webdriver is None:
+            self._webdriver = PoshWebDriver()
+        return self._webdriver
+
+    def in_shard(self, corpus: str, directory: str):
+        """ stable assignment of a crawled directory to a shard, identical across processes and hosts """
+        shard_index, shard_count = self.shard
+        key = ("%s:%s" % (corpus, directory)).encode('utf-8')
+        return zlib.crc32(key) % shard_count == shard_index
+
+
+class HttpTransport:
+    """
+    Single HTTP client of the build : pooled keep-alive connections with retries for http and https,
+    de-duplication of in-flight requests to the same url, and per-url request accounting.
+    """
+
+    def __init__(self, pool_size: int = 8):
+        self.session = requests.Session()
+        self.set_pool_size(pool_size)
+
+        self._lock = threading.Lock()
+        self._in_flight = {}
+
+        # url -> [requests, in-flight duplicates, bytes, last status code]
+        self.requests = collections.defaultdict(lambda: [0, 0, 0, None])
+
+    def set_pool_size(self, pool_size: int):
+        """ size the connection pool to the number of concurrent requests """
+        # persistent gateway errors end as their last response, get_content then returns None as for any error page
+        retries = Retry(total=5, backoff_factor=1, status_forcelist=[502, 503, 504], raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _account(self, url: str, status_code, size: int):
+        with self._lock:
+            record = self.requests[url]
+            record[0] += 1
+            record[2] += size
+            record[3] = status_code
+
+    def get(self, url: str, **kwargs):
+        """ raw GET request, accounted but not de-duplicated (streamed or conditional requests) """
+        while True:
+            try:
+                r = self.session.get(url, **kwargs)
+            except ConnectionError:
+                logger.debug("caught ConnectionError, retrying...")
+                time.sleep(2)
+            else:
+                break
+
+        size = len(r.content) if not kwargs.get('stream') else int(r.headers.get('Content-Length', 0))
+        self._account(url, r.status_code, size)
+        return r
+
+    def get_text(self, url: str, params: dict = None):
+        """ GET request as utf-8 text, None on error pages """
+        content = self.get_content(url, params)
+        return content.decode('utf-8', errors='replace') if content is not None else None
+
+    def get_content(self, url: str, params: dict = None):
+        """ GET request as bytes, None on error pages. Concurrent requests of the same url share one fetch """
+        key = (url, json.dumps(params, sort_keys=True))
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self._in_flight[key] = concurrent.futures.Future()
+            else:
+                self.requests[url][1] += 1
+
+        if not owner:
+            return future.result()
+
+        try:
+            r = self.get(url, data=params)
+
+            # do not keep 404 pages
+            content = r.content if r.status_code == 200 else None
+            future.set_result(content)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+        return content
+
+    def report(self, report_filepath: str):
+        """ dump the request accounting as json : urls fetched several times and failed requests first """
+        with self._lock:
+            requests_items = [(url, list(record)) for url, record in self.requests.items()]
+
+        repeated = sorted(
+            (item for item in requests_items if item[1][0] > 1),
+            key=lambda item: (-item[1][0], item[0])
+        )
+        failed = sorted(item for item in requests_items if item[1][3] != 200 and item[1][3] != 304)
+
+        report = {
+            'urls': len(requests_items),
+            'requests': sum(record[0] for url, record in requests_items),
+            'deduplicated': sum(record[1] for url, record in requests_items),
+            'bytes': sum(record[2] for url, record in requests_items),
+            'repeated_requests': sum(record[0] - 1 for url, record in repeated),
+            'repeated_bytes': sum(record[2] - record[2] // record[0] for url, record in repeated),
+            'failed_requests': sum(record[0] for url, record in failed),
+            'repeated': [
+                {'url': url, 'requests': record[0], 'bytes': record[2]}
+                for url, record in repeated
+            ],
+            'failed': [
+                {'url': url, 'requests': record[0], 'status': record[3]}
+                for url, record in failed
+            ],
+        }
 
-# Global session for several retries
-session = requests.Session()
-retries = Retry(total=5, backoff_factor=1, status_forcelist=[502, 503, 504])
-session.mount('http://', HTTPAdapter(max_retries=retries))
+        with open(report_filepath, "w") as report_fd:
+            json.dump(report, report_fd, indent=2)
+
+        return report
+
+
+# Global transport, every request of the build goes through it
+transport = HttpTransport()
 
 
 def download_binary(url, output_filename):
     """ Download GET request as binary file """
-    global session
 
     logger.debug("download_binary : %s -> %s" % (url, output_filename))
 
     # ensure the folder path actually exist
     os.makedirs(os.path.dirname(output_filename), exist_ok=True)
 
-    r = session.get(url, stream=True)
+    r = transport.get(url, stream=True)
     with open(output_filename, 'wb') as f:
         for data in r.iter_content(32 * 1024):
             f.write(data)
 
 
+def fetch_textfile(url: str, params: dict = None):
+    """ GET request as utf-8 text, None on error pages """
+    return transport.get_text(url, params)
+
+
 def download_textfile(url: str, output_filename: str, params: dict = None):
     """ Download GET request as utf-8 text file """
-    global session
 
     logger.debug("download_textfile : %s -> %s" % (url, output_filename))
     # ensure the folder path actually exist
     os.makedirs(os.path.dirname(output_filename), exist_ok=True)
 
-    while True:
-        try:
-            r = session.get(url, data=params)
-        except ConnectionError:
-            logger.debug("caught ConnectionError, retrying...")
-            time.sleep(2)
-        else:
-            break
-
-    # do not write 404 pages on disk
-    if r.status_code != 200:
+    text = fetch_textfile(url, params)
+    if text is None:
         return False
 
-    r.encoding = 'utf-8'
     with open(output_filename, 'w', encoding="utf-8") as f:
-        f.write(r.text)
+        f.write(text)
 
     return True
 
 
-def make_docset(source_dir, dst_filepath, filename):
+def download_page(url: str, pages: 'PageStore', page_path: str):
+    """ Download GET request as utf-8 text into the page store """
+
+    logger.debug("download_page : %s -> %s" % (url, page_path))
+
+    text = fetch_textfile(url)
+    if text is None:
+        return False
+
+    pages.put(page_path, text.encode('utf-8'))
+    pages.set_source(page_path, url)
+    return True
+
+
+class BuildStateStore:
+    """
+    On-disk store for the crawled index entries and directory TOCs.
+
+    Entries and TOCs are written as they are crawled and streamed back by the later stages,
+    so memory usage does not grow with the size of the corpus.
+    """
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.db = sqlite3.connect(filepath)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS entries(id INTEGER PRIMARY KEY, category TEXT, name TEXT, path TEXT);'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS entries_category ON entries (category);')
+        self.db.execute('CREATE INDEX IF NOT EXISTS entries_path ON entries (path);')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS tocs(corpus TEXT, directory TEXT, toc TEXT, PRIMARY KEY (corpus, directory));'
+        )
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS crawl_plan('
+            'id INTEGER PRIMARY KEY, priority INTEGER, corpus TEXT, directory TEXT, page TEXT);'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS crawl_plan_priority ON crawl_plan (priority, id);')
+
+        # single slot cache : pages of a directory are crawled together
+        self._toc_cache_key = None
+        self._toc_cache = None
+
+    def add_entry(self, category: str, name: str, path: str):
+        self.db.execute('INSERT INTO entries(category, name, path) VALUES (?,?,?)', (category, name, path))
+
+    def merge(self, filepath: str):
+        """ append the entries and TOCs of another store, e.g. a crawl shard TOC fragment """
+        self.db.commit()
+        self.db.execute('ATTACH DATABASE ? AS fragment', (filepath,))
+        self.db.execute(
+            'INSERT INTO entries(category, name, path) SELECT category, name, path FROM fragment.entries ORDER BY id'
+        )
+        self.db.execute('INSERT OR REPLACE INTO tocs(corpus, directory, toc) SELECT corpus, directory, toc FROM fragment.tocs')
+        self.db.commit()
+        self.db.execute('DETACH DATABASE fragment')
+        self._toc_cache_key = None
+
+    def remove_entries(self, path: str):
+        self.db.execute('DELETE FROM entries WHERE path = ?', (path,))
+
+    def entry_paths(self, prefix: str = ''):
+        """ distinct paths of the index entries, under a path prefix """
+        cursor = self.db.execute(
+            'SELECT DISTINCT path FROM entries WHERE path >= ? AND path < ?', (prefix, prefix + '\U0010ffff')
+        )
+        return [path for path, in cursor]
+
+    def rename_entries(self, path: str, name: str):
+        self.db.execute('UPDATE entries SET name = ? WHERE path = ?', (name, path))
+
+    def iter_entries(self, category: str):
+        """ yield {'name', 'path'} records for a category, in crawl order """
+        cursor = self.db.execute('SELECT name, path FROM entries WHERE category = ? ORDER BY id', (category,))
+        for name, path in cursor:
+            yield {'name': name, 'path': path}
+
+    def set_toc(self, corpus: str, directory: str, toc: dict):
+        self.db.execute(
+            'INSERT OR REPLACE INTO tocs(corpus, directory, toc) VALUES (?,?,?)',
+            (corpus, directory, json.dumps(toc))
+        )
+        self._toc_cache_key = None
+
+    def has_toc(self, corpus: str, directory: str):
+        cursor = self.db.execute('SELECT 1 FROM tocs WHERE corpus = ? AND directory = ?', (corpus, directory))
+        return cursor.fetchone() is not None
+
+    def get_toc(self, corpus: str, directory: str):
+        """ return the decoded TOC for a directory, or None if it has none """
+        if self._toc_cache_key != (corpus, directory):
+            cursor = self.db.execute('SELECT toc FROM tocs WHERE corpus = ? AND directory = ?', (corpus, directory))
+            row = cursor.fetchone()
+            self._toc_cache_key = (corpus, directory)
+            self._toc_cache = json.loads(row[0]) if row else None
+
+        return self._toc_cache
+
+    def iter_tocs(self):
+        """ yield (corpus, directory, toc) for every crawled directory, one at a time """
+        for corpus, directory, toc in self.db.execute('SELECT corpus, directory, toc FROM tocs'):
+            yield corpus, directory, json.loads(toc)
+
+    def clear_crawl_plan(self):
+        self.db.execute('DELETE FROM crawl_plan')
+
+    def add_crawl_task(self, task: 'CrawlTask'):
+        self.db.execute(
+            'INSERT INTO crawl_plan(priority, corpus, directory, page) VALUES (?,?,?,?)',
+            (task.priority, task.corpus, task.directory, task.page)
+        )
+
+    def crawl_plan_counts(self):
+        """ [(priority, planned pages)], lowest priority first """
+        return self.db.execute(
+            'SELECT priority, COUNT(*) FROM crawl_plan GROUP BY priority ORDER BY priority'
+        ).fetchall()
+
+    def iter_crawl_tasks(self, priority: int, batch_size: int = 1000):
+        """ yield the planned CrawlTask of a priority in plan order, read by batches """
+        last_id = 0
+        while True:
+            rows = self.db.execute(
+                'SELECT id, priority, corpus, directory, page FROM crawl_plan '
+                'WHERE priority = ? AND id > ? ORDER BY id LIMIT ?',
+                (priority, last_id, batch_size)
+            ).fetchall()
+            if not rows:
+                return
+
+            for row in rows:
+                yield CrawlTask(*row[1:])
+            last_id = rows[-1][0]
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+class PageStore:
+    """
+    Single file store of the pages, images and stylesheets of a build stage.
+
+    Paths are unix paths relative to the Documents folder, pointing to content addressed blobs :
+    identical files are zlib compressed and stored once. Loose files are only written when exporting
+    the final docset, duplicates being hardlinked to a single copy.
+    """
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.db = sqlite3.connect(filepath)
+        self.db.execute('PRAGMA synchronous = OFF;')
+        self.db.execute('CREATE TABLE IF NOT EXISTS blobs(digest TEXT PRIMARY KEY, size INTEGER, data BLOB);')
+        self.db.execute('CREATE TABLE IF NOT EXISTS pages(path TEXT PRIMARY KEY, digest TEXT);')
+        self.db.execute('CREATE INDEX IF NOT EXISTS pages_digest ON pages (digest);')
+        self.db.execute('CREATE TABLE IF NOT EXISTS sources(path TEXT PRIMARY KEY, url TEXT);')
+
+    @staticmethod
+    def _key(path: str):
+        return os.path.normpath(path).replace(os.sep, '/')
+
+    def put(self, path: str, data: bytes):
+        digest = hashlib.sha256(data).hexdigest()
+        cursor = self.db.execute('SELECT 1 FROM blobs WHERE digest = ?', (digest,))
+        if cursor.fetchone() is None:
+            self.db.execute(
+                'INSERT INTO blobs(digest, size, data) VALUES (?,?,?)',
+                (digest, len(data), zlib.compress(data))
+            )
+
+        self.db.execute('INSERT OR REPLACE INTO pages(path, digest) VALUES (?,?)', (PageStore._key(path), digest))
+        return digest
+
+    def get(self, path: str):
+        """ return the content stored for this path, or None """
+        cursor = self.db.execute(
+            'SELECT data FROM pages JOIN blobs USING (digest) WHERE path = ?',
+            (PageStore._key(path),)
+        )
+        row = cursor.fetchone()
+        return zlib.decompress(row[0]) if row else None
+
+    def digest(self, path: str):
+        """ return the sha256 of the content stored for this path, or None """
+        cursor = self.db.execute('SELECT digest FROM pages WHERE path = ?', (PageStore._key(path),))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def __contains__(self, path: str):
+        return self.digest(path) is not None
+
+    def set_source(self, path: str, url: str):
+        """ remember the url a page was downloaded from """
+        self.db.execute('INSERT OR REPLACE INTO sources(path, url) VALUES (?,?)', (PageStore._key(path), url))
+
+    def sources(self, extensions: tuple = None):
+        """ list (path, url) of the downloaded pages, optionally filtered on file extensions """
+        sources = list(self.db.execute('SELECT path, url FROM sources ORDER BY path'))
+        if extensions:
+            sources = [(path, url) for path, url in sources if os.path.splitext(path)[1].lower() in extensions]
+        return sources
+
+    def delete(self, path: str):
+        self.db.execute('DELETE FROM pages WHERE path = ?', (PageStore._key(path),))
+
+    def paths(self, extensions: tuple = None):
+        """ list stored paths, optionally filtered on file extensions """
+        paths = [path for path, in self.db.execute('SELECT path FROM pages ORDER BY path')]
+        if extensions:
+            paths = [path for path in paths if os.path.splitext(path)[1].lower() in extensions]
+        return paths
+
+    def merge(self, filepath: str):
+        """ copy every blob of another store, e.g. a crawl shard """
+        self.db.commit()
+        self.db.execute('ATTACH DATABASE ? AS fragment', (filepath,))
+        self.db.execute('INSERT OR IGNORE INTO blobs(digest, size, data) SELECT digest, size, data FROM fragment.blobs')
+        self.db.execute('INSERT OR REPLACE INTO pages(path, digest) SELECT path, digest FROM fragment.pages')
+        self.db.execute('INSERT OR REPLACE INTO sources(path, url) SELECT path, url FROM fragment.sources')
+        self.db.commit()
+        self.db.execute('DETACH DATABASE fragment')
+
+    def dedup_stats(self):
+        """ (stored files, distinct blobs, bytes saved by deduplication) """
+        files, total_size = self.db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages JOIN blobs USING (digest)'
+        ).fetchone()
+        blobs, blobs_size = self.db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs WHERE digest IN (SELECT digest FROM pages)'
+        ).fetchone()
+        return files, blobs, total_size - blobs_size
+
+    def export(self, dst_dir: str):
+        """ write every blob as a loose file under dst_dir, hardlinking identical files """
+        count = 0
+        exported = None
+
+        for path, digest, data in self.db.execute(
+                'SELECT path, digest, data FROM pages JOIN blobs USING (digest) ORDER BY digest, path'
+        ):
+            filepath = os.path.join(dst_dir, *path.split('/'))
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+            linked = False
+            if exported and exported[0] == digest:
+                try:
+                    os.link(exported[1], filepath)
+                    linked = True
+                except OSError:
+                    # no hardlinks on this filesystem
+                    pass
+
+            if not linked:
+                with open(filepath, 'wb') as o_fd:
+                    o_fd.write(zlib.decompress(data))
+                exported = (digest, filepath)
+
+            count += 1
+
+        return count
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        # drop blobs no path points to anymore, e.g. pages before their rewrite
+        self.db.execute('DELETE FROM blobs WHERE digest NOT IN (SELECT digest FROM pages)')
+        self.db.commit()
+        self.db.close()
+
+
+class FullTextIndex:
+    """ FTS5 index of the stripped text of every page, filled while pages are rewritten """
+
+    create_statement = 'CREATE VIRTUAL TABLE IF NOT EXISTS searchBodies USING fts5(path UNINDEXED, title, body);'
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.db = sqlite3.connect(filepath)
+        self.db.execute('PRAGMA synchronous = OFF;')
+        self.db.execute(FullTextIndex.create_statement)
+
+    @staticmethod
+    def page_text(soup):
+        """ (title, body text) of a parsed page """
+        title_tag = soup.find("h1") or soup.title
+        title = title_tag.get_text(" ", strip=True) if title_tag else ""
+        body = (soup.body or soup).get_text(" ", strip=True)
+        return title, body
+
+    def add_text(self, path: str, title: str, body: str):
+        self.db.execute('DELETE FROM searchBodies WHERE path = ?', (path,))
+        self.db.execute('INSERT INTO searchBodies(path, title, body) VALUES (?,?,?)', (path, title, body))
+
+    def copy_into(self, db):
+        """ copy the index into another database, e.g. docSet.dsidx """
+        self.db.commit()
+        db.execute(FullTextIndex.create_statement)
+        db.execute('ATTACH DATABASE ? AS fulltext', (self.filepath,))
+        db.execute('INSERT INTO searchBodies(path, title, body) SELECT path, title, body FROM fulltext.searchBodies')
+        db.commit()
+        db.execute('DETACH DATABASE fulltext')
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def search_fulltext(sqlite_filepath: str, query: str, limit: int = 20):
+    """ ranked (path, title, snippet) hits of a full text query against docSet.dsidx """
+    db = sqlite3.connect(sqlite_filepath)
+    statement = (
+        "SELECT path, title, snippet(searchBodies, 2, '[', ']', '...', 16) FROM searchBodies "
+        "WHERE searchBodies MATCH ? ORDER BY rank LIMIT ?"
+    )
+
+    try:
+        try:
+            hits = db.execute(statement, (query, limit)).fetchall()
+        except sqlite3.OperationalError:
+            # not a valid fts5 query, search it as a phrase
+            hits = db.execute(statement, ('"%s"' % query.replace('"', '""'), limit)).fetchall()
+    finally:
+        db.close()
+
+    return hits
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """
+    Write-only file object compressing fixed size blocks on a thread pool.
+
+    Every block is an independent gzip member : the output is a regular gzip file for gunzip and tarfile.
+    """
+
+    def __init__(self, fileobj, jobs: int = None, block_size: int = 1024 * 1024, compresslevel: int = 6):
+        self.fileobj = fileobj
+        self.block_size = block_size
+        self.compresslevel = compresslevel
+        self.jobs = jobs or os.cpu_count() or 1
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        self.bytes_in += len(data)
+
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+
+        return len(data)
+
+    def _submit(self, block: bytes):
+        # zlib releases the GIL, blocks are compressed concurrently
+        self.pending.append(self.executor.submit(gzip.compress, block, self.compresslevel, mtime=0))
+
+        # bound memory usage, write blocks back in order
+        while len(self.pending) > 2 * self.jobs:
+            self._write_next()
+
+    def _write_next(self):
+        compressed = self.pending.popleft().result()
+        self.fileobj.write(compressed)
+        self.bytes_out += len(compressed)
+
+    def close(self):
+        if self.closed:
+            return
+
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer.clear()
+
+        while self.pending:
+            self._write_next()
+
+        self.executor.shutdown()
+        super().close()
+
+
+def make_docset(source_dir, dst_filepath, compression: str = "gzip", jobs: int = None):
     """ 
-    Tar-gz the build directory while conserving the relative folder tree paths. 
+    Tar the build directory while conserving the relative folder tree paths, compressing it on several threads.
+    The archive is streamed directly to dst_filepath, either as multi-member gzip or as zstd.
     Copied from : https://stackoverflow.com/a/17081026/1741450 
     """
-    dst_dir = os.path.dirname(dst_filepath)
-    tar_filepath = os.path.join(dst_dir, '%s.tar' % filename)
+    jobs = jobs or os.cpu_count() or 1
+    start = time.time()
+
+    with open(dst_filepath, "wb") as dst_fd:
+
+        if compression == "zstd":
+            try:
+                import zstandard  # pip install zstandard
+            except ImportError:
+                raise RuntimeError("zstd compression requires the zstandard package : pip install zstandard")
+
+            compressor = zstandard.ZstdCompressor(level=10, threads=jobs)
+            compressed_fd = compressor.stream_writer(dst_fd, closefd=False)
+        else:
+            compressed_fd = ParallelGzipWriter(dst_fd, jobs=jobs)
+
+        with tarfile.open(fileobj=compressed_fd, mode="w|") as tar:
+            tar.add(source_dir, arcname=os.path.basename(source_dir))
+
+        compressed_fd.close()
+        bytes_out = dst_fd.tell()
+
+    elapsed = max(time.time() - start, 1e-6)
+    bytes_in = sum(
+        os.path.getsize(os.path.join(r, filename)) for r, d, f in os.walk(source_dir) for filename in f
+    )
+    logger.info(
+        "[5] packaged %.1f MB into %.1f MB (%s, %d threads) in %.1fs : %.1f MB/s" % (
+        bytes_in / 1e6, bytes_out / 1e6, compression, jobs, elapsed, bytes_in / 1e6 / elapsed)
+    )
+
+
+def make_tarix_docset(source_dir, dst_dir, jobs: int = None):
+    """
+    Write an installable docset which stays compressed : the docset tree is packed in a tarix.tgz
+    and tarixIndex.db maps every member to its gzip offset, so pages are read without extraction.
+
+    Every member is compressed as its own gzip stream, the concatenation being a regular tar.gz.
+    The index "hash" of a member is "<tar block offset> <gzip offset> <tar block count>".
+    """
+    docset_name = os.path.basename(source_dir)
+    docset_dir = os.path.join(dst_dir, docset_name)
+    resources_dir = os.path.join(docset_dir, "Contents", "Resources")
+
+    if os.path.realpath(docset_dir) == os.path.realpath(source_dir):
+        raise ValueError("tarix docset can not be written over its build tree %s" % source_dir)
+
+    shutil.rmtree(docset_dir, ignore_errors=True)
+    os.makedirs(resources_dir)
+
+    # small files Dash needs before opening the archive
+    to_extract = [
+        "Contents/Info.plist",
+        "Contents/Resources/docSet.dsidx",
+        "Contents/Resources/LICENSE",
+        "icon.png",
+        "icon@2x.png",
+    ]
+
+    index_db = sqlite3.connect(os.path.join(resources_dir, "tarixIndex.db"))
+    index_db.execute('CREATE TABLE tarindex(path TEXT PRIMARY KEY COLLATE NOCASE, hash TEXT);')
+    index_db.execute('CREATE TABLE toextract(path TEXT PRIMARY KEY COLLATE NOCASE, hash TEXT);')
+
+    def tar_members():
+        for r, d, f in os.walk(source_dir):
+            d.sort()
+            for filename in sorted(f):
+                filepath = os.path.join(r, filename)
+                relpath = os.path.relpath(filepath, source_dir).replace(os.sep, '/')
+                arcname = "%s/%s" % (docset_name, relpath)
+
+                tarinfo = tarfile.TarInfo(arcname)
+                tarinfo.mtime = int(os.path.getmtime(filepath))
+                tarinfo.mode = 0o644
+
+                # hardlinked duplicates are link members to their first occurrence, whose data they share
+                stat = os.stat(filepath)
+                inode = (stat.st_dev, stat.st_ino)
+                if stat.st_nlink > 1 and inode in first_arcnames:
+                    tarinfo.type = tarfile.LNKTYPE
+                    tarinfo.linkname = first_arcnames[inode]
+                    yield filepath, relpath, tarinfo.tobuf(tarfile.GNU_FORMAT, "utf-8", "surrogateescape"), inode
+                    continue
+
+                if stat.st_nlink > 1:
+                    first_arcnames[inode] = arcname
+
+                tarinfo.size = stat.st_size
+                with open(filepath, "rb") as i_fd:
+                    data = i_fd.read()
+
+                member = tarinfo.tobuf(tarfile.GNU_FORMAT, "utf-8", "surrogateescape") + data
+                member += tarfile.NUL * (-len(member) % tarfile.BLOCKSIZE)
+
+                yield filepath, relpath, member, None
+
+    def write_member(tarix_fd, future, filepath, relpath, block_count, shared_inode):
+        nonlocal tar_block
+
+        arcname = "%s/%s" % (docset_name, relpath)
+        member_hash = "%d %d %d" % (tar_block, tarix_fd.tell(), block_count)
+        if shared_inode is not None:
+            # reads of a link member go to the data of its first occurrence
+            member_hash = member_hashes[shared_inode]
+        else:
+            stat = os.stat(filepath)
+            member_hashes[(stat.st_dev, stat.st_ino)] = member_hash
+
+        index_db.execute('INSERT INTO tarindex(path, hash) VALUES (?,?)', (arcname, member_hash))
+
+        if relpath in to_extract:
+            index_db.execute('INSERT INTO toextract(path, hash) VALUES (?,?)', (arcname, member_hash))
+            os.makedirs(os.path.dirname(os.path.join(docset_dir, relpath)), exist_ok=True)
+            shutil.copyfile(filepath, os.path.join(docset_dir, relpath))
+
+        tarix_fd.write(future.result())
+        tar_block += block_count
+
+    jobs = jobs or os.cpu_count() or 1
+    tar_block = 0
+    pending = collections.deque()
+    first_arcnames = {}
+    member_hashes = {}
+
+    with open(os.path.join(resources_dir, "tarix.tgz"), "wb") as tarix_fd, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+
+        for filepath, relpath, member, shared_inode in tar_members():
+            future = executor.submit(gzip.compress, member, mtime=0)
+            pending.append((future, filepath, relpath, len(member) // tarfile.BLOCKSIZE, shared_inode))
+
+            # members are written back in order, as soon as they are compressed
+            while len(pending) > 2 * jobs:
+                write_member(tarix_fd, *pending.popleft())
+
+        while pending:
+            write_member(tarix_fd, *pending.popleft())
+
+        # end of archive marker
+        tarix_fd.write(gzip.compress(tarfile.NUL * (2 * tarfile.BLOCKSIZE), mtime=0))
+
+    index_db.commit()
+    index_db.close()
+
+
+def read_tarix_member(docset_dir, path):
+    """ random access read of a file packed in a tarix docset, path being relative to the docset folder """
+    resources_dir = os.path.join(docset_dir, "Contents", "Resources")
+    arcname = "%s/%s" % (os.path.basename(os.path.normpath(docset_dir)), path.replace(os.sep, '/'))
+
+    index_db = sqlite3.connect(os.path.join(resources_dir, "tarixIndex.db"))
+    row = index_db.execute('SELECT hash FROM tarindex WHERE path = ?', (arcname,)).fetchone()
+    index_db.close()
+    if row is None:
+        return None
+
+    tar_block, gzip_offset, block_count = (int(v) for v in row[0].split())
+    with open(os.path.join(resources_dir, "tarix.tgz"), "rb") as tarix_fd:
+        tarix_fd.seek(gzip_offset)
+        with gzip.GzipFile(fileobj=tarix_fd) as member_fd:
+            member = member_fd.read(block_count * tarfile.BLOCKSIZE)
+
+    with tarfile.open(fileobj=io.BytesIO(member), mode="r:") as tar:
+        return tar.extractfile(tar.next()).read()
+
+
+def _index_row_key(row):
+    """ sort key of a searchIndex row, names are NULL for pages missing from their TOC """
+    return tuple('' if value is None else value for value in row)
+
+
+def build_docset_manifest(docset_dir):
+    """ path -> sha256 of every docset file, the searchIndex rows of docSet.dsidx and digests of its full text rows """
+    files = {}
+    for r, d, f in os.walk(docset_dir):
+        for filename in f:
+            filepath = os.path.join(r, filename)
+            relpath = os.path.relpath(filepath, docset_dir).replace(os.sep, '/')
+
+            # the index is diffed row by row
+            if relpath == "Contents/Resources/docSet.dsidx":
+                continue
+
+            digest = hashlib.sha256()
+            with open(filepath, "rb") as i_fd:
+                for data in iter(lambda: i_fd.read(1024 * 1024), b""):
+                    digest.update(data)
+            files[relpath] = digest.hexdigest()
+
+    db = sqlite3.connect(os.path.join(docset_dir, "Contents", "Resources", "docSet.dsidx"))
+    index = sorted(db.execute('SELECT name, type, path FROM searchIndex'), key=_index_row_key)
+
+    # full text rows are diffed per page
+    fulltext = {}
+    if db.execute("SELECT 1 FROM sqlite_master WHERE name = 'searchBodies'").fetchone() is not None:
+        for path, title, body in db.execute('SELECT path, title, body FROM searchBodies'):
+            fulltext[path] = hashlib.sha256(("%s\0%s" % (title, body)).encode('utf-8')).hexdigest()
+    db.close()
+
+    return {
+        'docset': os.path.basename(os.path.normpath(docset_dir)),
+        'files': files,
+        'index': [list(row) for row in index],
+        'fulltext': fulltext,
+    }
+
+
+def manifest_version(manifest: dict):
+    """ digest of the files, index rows and full text rows of a manifest, the docset state a delta applies to """
+    state = [manifest['files'], manifest['index'], manifest.get('fulltext', {})]
+    return hashlib.sha256(json.dumps(state, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def make_docset_delta(previous_manifest: dict, manifest: dict, docset_dir: str, delta_filepath: str, jobs: int = None):
+    """ Archive the files and index rows changed since a previous build, to be applied with "apply_delta" """
+
+    previous_files = previous_manifest['files']
+    files = manifest['files']
+
+    changed = sorted(path for path, digest in files.items() if previous_files.get(path) != digest)
+    deleted = sorted(path for path in previous_files if path not in files)
+
+    previous_index = set(tuple(row) for row in previous_manifest['index'])
+    index = set(tuple(row) for row in manifest['index'])
+
+    previous_fulltext = previous_manifest.get('fulltext', {})
+    fulltext = manifest.get('fulltext', {})
+    fulltext_changed = set(path for path, digest in fulltext.items() if previous_fulltext.get(path) != digest)
+
+    fulltext_added = []
+    if fulltext_changed:
+        db = sqlite3.connect(os.path.join(docset_dir, "Contents", "Resources", "docSet.dsidx"))
+        fulltext_added = sorted(
+            [path, title, body]
+            for path, title, body in db.execute('SELECT path, title, body FROM searchBodies')
+            if path in fulltext_changed
+        )
+        db.close()
+
+    delta = {
+        'docset': manifest['docset'],
+        'base': manifest_version(previous_manifest),
+        'version': manifest_version(manifest),
+        'changed': {path: files[path] for path in changed},
+        'deleted': deleted,
+        'index_added': sorted(index - previous_index, key=_index_row_key),
+        'index_removed': sorted(previous_index - index, key=_index_row_key),
+        'fulltext_added': fulltext_added,
+        'fulltext_removed': sorted(path for path in previous_fulltext if path not in fulltext),
+    }
+    delta_json = json.dumps(delta).encode('utf-8')
+
+    with open(delta_filepath, "wb") as dst_fd:
+        compressed_fd = ParallelGzipWriter(dst_fd, jobs=jobs)
+        with tarfile.open(fileobj=compressed_fd, mode="w|") as tar:
+            tarinfo = tarfile.TarInfo("delta.json")
+            tarinfo.size = len(delta_json)
+            tar.addfile(tarinfo, io.BytesIO(delta_json))
+
+            for path in changed:
+                tar.add(os.path.join(docset_dir, *path.split('/')), arcname="files/%s" % path)
+
+        compressed_fd.close()
+
+    logger.info(
+        "[5] delta : %d changed, %d deleted files, %d added, %d removed index rows, %d full text pages -> %s" % (
+        len(changed), len(deleted), len(delta['index_added']), len(delta['index_removed']),
+        len(delta['fulltext_added']) + len(delta['fulltext_removed']), delta_filepath)
+    )
+    return delta
+
+
+def _delta_filepath(docset_dir: str, path: str):
+    """ file of a docset targeted by a delta path, which must stay inside the docset folder """
+    filepath = os.path.join(docset_dir, *path.split('/'))
+    if os.path.isabs(path) or os.path.relpath(filepath, docset_dir).startswith(os.pardir):
+        raise ValueError("delta path escapes the docset folder : %s" % path)
+    return filepath
+
+
+def apply_docset_delta(delta_filepath: str, docset_dir: str):
+    """
+    Patch an installed (extracted) docset in place with a delta archive.
+
+    The docset must be the build the delta was made against, and the archive is checked entirely
+    (paths, links and file digests) before anything is written.
+    """
+
+    resources_dir = os.path.join(docset_dir, "Contents", "Resources")
+    if os.path.exists(os.path.join(resources_dir, "tarix.tgz")):
+        raise ValueError("delta updates only apply to extracted docsets, %s is tarix compressed" % docset_dir)
+
+    with tarfile.open(delta_filepath, "r:*") as tar:
+        delta = json.load(tar.extractfile("delta.json"))
 
-    with tarfile.open(tar_filepath, "w:gz") as tar:
-        tar.add(source_dir, arcname=os.path.basename(source_dir))
+        for path in list(delta['changed']) + delta['deleted']:
+            _delta_filepath(docset_dir, path)
 
-    shutil.move(tar_filepath, dst_filepath)
+        base = manifest_version(build_docset_manifest(docset_dir))
+        if delta.get('base') != base:
+            raise ValueError(
+                "delta %s applies to docset version %s, %s is at %s" % (
+                delta_filepath, delta.get('base'), docset_dir, base)
+            )
+
+        # every changed file is in the archive with the recorded digest, duplicates as links to one of them
+        members = {}
+        for tarinfo in tar:
+            if not tarinfo.name.startswith("files/"):
+                continue
+
+            path = tarinfo.name[len("files/"):]
+            if path not in delta['changed'] or not (tarinfo.isfile() or tarinfo.islnk()):
+                raise ValueError("unexpected file in delta archive : %s" % tarinfo.name)
+
+            if tarinfo.islnk():
+                link_path = tarinfo.linkname[len("files/"):]
+                if not tarinfo.linkname.startswith("files/") or link_path not in delta['changed'] \
+                        or delta['changed'][link_path] != delta['changed'][path]:
+                    raise ValueError("delta archive link escapes the docset folder : %s" % tarinfo.linkname)
+            else:
+                digest = hashlib.sha256()
+                member_fd = tar.extractfile(tarinfo)
+                for data in iter(lambda: member_fd.read(1024 * 1024), b""):
+                    digest.update(data)
+                if digest.hexdigest() != delta['changed'][path]:
+                    raise ValueError("delta archive file does not match its digest : %s" % tarinfo.name)
+
+            members[path] = tarinfo
+
+        missing = sorted(set(delta['changed']) - set(members))
+        if missing:
+            raise ValueError("delta archive misses %d changed files, first is %s" % (len(missing), missing[0]))
+
+        # regular files first, so link targets are written when their links are copied
+        for path, tarinfo in sorted(members.items(), key=lambda item: item[1].islnk()):
+            filepath = _delta_filepath(docset_dir, path)
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+            # never write through a deduplication hardlink, unchanged copies share its inode
+            if os.path.lexists(filepath):
+                os.remove(filepath)
+
+            # duplicated files are stored once in the archive
+            if tarinfo.islnk():
+                shutil.copyfile(_delta_filepath(docset_dir, tarinfo.linkname[len("files/"):]), filepath)
+                continue
+
+            with open(filepath, "wb") as o_fd:
+                shutil.copyfileobj(tar.extractfile(tarinfo), o_fd)
+
+    for path in delta['deleted']:
+        filepath = _delta_filepath(docset_dir, path)
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+    db = sqlite3.connect(os.path.join(resources_dir, "docSet.dsidx"))
+    db.executemany('DELETE FROM searchIndex WHERE name IS ? AND type IS ? AND path IS ?', delta['index_removed'])
+    db.executemany('INSERT OR IGNORE INTO searchIndex(name, type, path) VALUES (?,?,?)', delta['index_added'])
+
+    # full text rows of changed pages are replaced
+    fulltext_added = delta.get('fulltext_added', [])
+    fulltext_removed = delta.get('fulltext_removed', [])
+    if fulltext_added or fulltext_removed:
+        db.execute(FullTextIndex.create_statement)
+        db.executemany(
+            'DELETE FROM searchBodies WHERE path = ?',
+            [(path,) for path in fulltext_removed] + [(path,) for path, title, body in fulltext_added]
+        )
+        db.executemany('INSERT INTO searchBodies(path, title, body) VALUES (?,?,?)', fulltext_added)
+
+    db.commit()
+    db.close()
+
+    logger.info(
+        "delta applied : %d changed, %d deleted files, %d added, %d removed index rows" % (
+        len(delta['changed']), len(delta['deleted']), len(delta['index_added']), len(delta['index_removed']))
+    )
 
 
 def download_page_contents(configuration, uri, output_filepath):
@@ -248,306 +1247,736 @@ def _findname(obj, key):
                     return item
 
 
-def crawl_sdk_api_folder(
-        configuration: Configuration,
-        download_dir: str,
-        source_dir: str,
-        directory: str,
-        api_content_toc: dict
-):
-    for markdown_filepath in glob.glob(os.path.join(source_dir, directory, "*.md")):
+def _toc_titles(toc: dict):
+    """ flatten a TOC into a 'href' -> 'toc_title' dict, for repeated lookups """
+    titles = {}
+    nodes = [toc]
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, dict):
+            if 'href' in node and 'toc_title' in node:
+                titles.setdefault(node['href'], node['toc_title'])
+            nodes.extend(node.values())
+        elif isinstance(node, list):
+            nodes.extend(node)
 
-        page_filename, page_ext = os.path.splitext(os.path.basename(markdown_filepath))
-        realarb = os.path.relpath(os.path.dirname(markdown_filepath), source_dir)
+    return titles
 
-        # already processed
-        if page_filename == "index":
-            continue
 
-        url = "https://docs.microsoft.com/en-us/windows/win32/api/{0:s}/{1:s}".format(realarb, page_filename)
-        filepath = os.path.join(
-            download_dir,
-            "docs.microsoft.com/en-us/windows/win32/api/{0:s}/{1:s}.html".format(realarb, page_filename)
-        )
-        logger.info("[+] download page %s  -> %s " % (url, filepath))
-        success = download_textfile(url, filepath)
+def _toc_url(configuration: Configuration, corpus: str, directory: str):
+    """ url of the TOC of a win32 or sdk-api directory """
+    if corpus == 'win32':
+        return "{0:s}/windows/win32/{1:s}/toc.json".format(configuration.locale_url, directory)
+    return "{0:s}/windows/win32/api/{1:s}/toc.json".format(configuration.locale_url, directory)
 
-        if not success:
-            logger.info("[X] could not download page %s  -> %s " % (url, filepath))
-            continue
 
-        url_relpath = "/windows/win32/api/{0:s}/{1:s}".format(realarb, page_filename)
-        page_title = _findname(api_content_toc['toc'][directory]['items'][0], url_relpath)
-        # logger.info("[+] %s => title '%s'" % (url_relpath, page_title))
-
-        if page_filename.startswith("nc-"):
-            category = "callbacks"
-        elif page_filename.startswith("ne-"):
-            category = "enums"
-        elif page_filename.startswith("nf-"):
-            category = "functions"
-        elif page_filename.startswith("nn-"):
-            category = "interfaces"
-        elif page_filename.startswith("ns-"):
-            category = "structures"
-        elif page_filename.startswith("nl-"):
-            category = "classes"
-        else:
-            category = "entries"
+def _toc_entry_prefix(corpus: str, directory: str):
+    """ path prefix of the index entries of a win32 or sdk-api directory, subdirectories included """
+    if corpus == 'win32':
+        return "docs.microsoft.com/win32/%s/" % directory
+    return "docs.microsoft.com/en-us/windows/win32/api/%s/" % directory
 
-        api_content_toc[category].append(
-            {
-                'name': page_title,
-                'path': "docs.microsoft.com/en-us{0:s}.html".format(url_relpath),
-            }
-        )
 
-    return api_content_toc
+def _entry_toc_href(entry_path: str):
+    """ (corpus, directory, TOC href) of an index entry from its page path, None if it has none """
+    directory, page = posixpath.split(entry_path.replace(os.sep, '/'))
+    page_filename, ext = posixpath.splitext(page)
 
+    sdk_api_prefix = "docs.microsoft.com/en-us/windows/win32/api/"
+    win32_prefix = "docs.microsoft.com/win32/"
+    if directory.startswith(sdk_api_prefix):
+        directory = directory[len(sdk_api_prefix):]
+        if page_filename == "index":
+            return 'sdk-api', directory, None
+        return 'sdk-api', directory, "/windows/win32/api/{0:s}/{1:s}".format(directory, page_filename)
+    elif directory.startswith(win32_prefix):
+        return 'win32', directory[len(win32_prefix):], page_filename
+
+    return None
+
+
+def _sdk_api_category(page_filename: str):
+    """ content toc category of a sdk-api page, based on its filename prefix """
+    if page_filename.startswith("nc-"):
+        return "callbacks"
+    elif page_filename.startswith("ne-"):
+        return "enums"
+    elif page_filename.startswith("nf-"):
+        return "functions"
+    elif page_filename.startswith("nn-"):
+        return "interfaces"
+    elif page_filename.startswith("ns-"):
+        return "structures"
+    elif page_filename.startswith("nl-"):
+        return "classes"
+    else:
+        return "entries"
 
-def crawl_sdk_api_contents(configuration: Configuration, download_dir: str, source_dir: str):
-    """ Download sdk-api entries based on TOC """
 
-    api_content_toc = {
-        'categories': [],
-        'files': [],
-        'callbacks': [],
-        'functions': [],
-        'enums': [],
-        'interfaces': [],
-        'structures': [],
-        'classes': [],
+def crawl_sdk_api_page(
+        configuration: Configuration,
+        pages: PageStore,
+        directory: str,
+        page_filename: str,
+        build_state: BuildStateStore
+):
+    """ download a sdk-api page and index it """
+    url = "{0:s}/windows/win32/api/{1:s}/{2:s}".format(configuration.locale_url, directory, page_filename)
+    page_path = "docs.microsoft.com/en-us/windows/win32/api/{0:s}/{1:s}.html".format(directory, page_filename)
+    logger.info("[+] download page %s  -> %s " % (url, page_path))
+    success = download_page(url, pages, page_path)
+
+    if not success:
+        logger.info("[X] could not download page %s  -> %s " % (url, page_path))
+        return
+
+    url_relpath = "/windows/win32/api/{0:s}/{1:s}".format(directory, page_filename)
+    page_title = _findname(build_state.get_toc('sdk-api', directory)['items'][0], url_relpath)
+    # logger.info("[+] %s => title '%s'" % (url_relpath, page_title))
+
+    category = _sdk_api_category(page_filename)
+
+    build_state.add_entry(
+        category,
+        page_title,
+        "docs.microsoft.com/en-us{0:s}.html".format(url_relpath),
+    )
 
-        'entries': [],
-        'toc': {}
-    }
 
-    content_dir = os.path.join(source_dir, "sdk-api-docs", "sdk-api-src", "content")
+def crawl_sdk_api_index(
+        configuration: Configuration,
+        pages: PageStore,
+        directory: str,
+        build_state: BuildStateStore
+):
+    """ download the index page of a sdk-api directory and index it as a category or a header file """
+    directory_toc = build_state.get_toc('sdk-api', directory)
 
-    for directory in os.listdir(content_dir):
+    url = "{0:s}/windows/win32/api/{1:s}".format(
+        configuration.locale_url,
+        directory,
+    )
+    page_path = os.path.join(
+        "docs.microsoft.com/en-us/windows/win32/api/{0:s}".format(directory),
+        "index.html"
+    )
+    logger.info("[+] download page %s  -> %s " % (url, page_path))
+    download_page(url, pages, page_path)
+
+    category_title = directory_toc['items'][0]['toc_title']
+
+    # "meta" directory, otherwise directory generated from a file
+    build_state.add_entry(
+        'categories' if directory.startswith("_") else 'files',
+        category_title,
+        os.path.join(
+            "docs.microsoft.com/en-us/windows/win32/api/{0:s}".format(directory),
+            "index.html"
+        ),
+    )
 
-        # download toc for directory
-        toc_url = "https://docs.microsoft.com/en-us/windows/win32/api/{0:s}/toc.json".format(directory)
-        logger.info("[+] download toc for directory %s" % (toc_url))
-        toc_r = requests.get(toc_url)
-        if toc_r.status_code == 200:
-            api_content_toc['toc'][directory] = json.loads(requests.get(toc_url).text)
-        else:
-            logger.warning("[!] directory %s has no TOC !" % (toc_url))
 
-        # only index folders with a toc
-        if not api_content_toc['toc'].get(directory, None):
-            continue
+def fetch_sdk_api_toc(configuration: Configuration, directory: str, build_state: BuildStateStore):
+    """ download the TOC of a sdk-api directory, return False if it has none """
+    toc_url = _toc_url(configuration, 'sdk-api', directory)
+    logger.info("[+] download toc for directory %s" % (toc_url))
+    toc = fetch_textfile(toc_url)
+    if toc is None:
+        logger.warning("[!] directory %s has no TOC !" % (toc_url))
+        return False
 
-        # "meta" directory
-        if directory.startswith("_"):
+    build_state.set_toc('sdk-api', directory, json.loads(toc))
+    return bool(build_state.get_toc('sdk-api', directory))
 
-            url = "https://docs.microsoft.com/en-us/windows/win32/api/{0:s}".format(
-                directory,
-            )
-            filepath = os.path.join(
-                download_dir,
-                "docs.microsoft.com/en-us/windows/win32/api/{0:s}".format(directory),
-                "index.html"
-            )
-            logger.info("[+] download page %s  -> %s " % (url, filepath))
-            download_textfile(url, filepath)
 
-            category_title = api_content_toc['toc'][directory]['items'][0]['toc_title']
-            api_content_toc['categories'].append(
-                {
-                    'name': category_title,
-                    'path': os.path.join(
-                        "docs.microsoft.com/en-us/windows/win32/api/{0:s}".format(directory),
-                        "index.html"
-                    ),
-                }
-            )
+def plan_sdk_api_contents(configuration: Configuration, source_dir: str, build_state: BuildStateStore):
+    """ Plan the crawl of the sdk-api index and pages, their TOCs are downloaded once their priority is reached """
 
-        # directory generated from a file
-        else:
+    content_dir = os.path.join(source_dir, "sdk-api-docs", "sdk-api-src", "content")
 
-            url = "https://docs.microsoft.com/en-us/windows/win32/api/{0:s}".format(
-                directory,
-            )
-            filepath = os.path.join(
-                download_dir,
-                "docs.microsoft.com/en-us/windows/win32/api/{0:s}".format(directory),
-                "index.html"
-            )
-            logger.info("[+] download page %s  -> %s " % (url, filepath))
-            download_textfile(url, filepath)
+    for directory in os.listdir(content_dir):
 
-            category_title = directory
-            if api_content_toc['toc'].get(directory, None):
-                category_title = api_content_toc['toc'][directory]['items'][0]['toc_title']
+        if not configuration.in_shard('sdk-api', directory):
+            continue
 
-            api_content_toc['files'].append(
-                {
-                    'name': category_title,
-                    'path': os.path.join(
-                        "docs.microsoft.com/en-us/windows/win32/api/{0:s}".format(directory),
-                        "index.html"
-                    ),
-                }
-            )
+        build_state.add_crawl_task(
+            CrawlTask(Configuration.crawl_priorities['sdk-api index'], 'sdk-api', directory, "index")
+        )
 
-        api_content_toc = crawl_sdk_api_folder(configuration, download_dir, content_dir, directory, api_content_toc)
+        for markdown_filepath in glob.glob(os.path.join(content_dir, directory, "*.md")):
+            page_filename, page_ext = os.path.splitext(os.path.basename(markdown_filepath))
 
-    return api_content_toc
+            # already processed
+            if page_filename == "index":
+                continue
 
+            build_state.add_crawl_task(
+                CrawlTask(_crawl_priority('sdk-api', directory, page_filename), 'sdk-api', directory, page_filename)
+            )
 
-def crawl_msdn_contents(configuration: Configuration, download_dir: str, source_dir: str):
-    """ Download MSDN modules and content pages based on TOC """
 
-    content_toc = {
-        'attributes': [],
-        'classes': [],
-        'entries': [],
-        'guides': [],
-        'toc': {},
-    }
+def crawl_msdn_page(
+        configuration: Configuration,
+        pages: PageStore,
+        realarb: str,
+        page_filename: str,
+        build_state: BuildStateStore
+):
+    """ download a win32 page, along with the TOC of its folder the first time, and index it """
+    url = "{0:s}/windows/win32/{1:s}/{2:s}".format(
+        configuration.locale_url,
+        realarb,
+        page_filename
+    )
 
-    # counter = 0
-    for r, d, f in os.walk(os.path.join(source_dir, "win32-docs", "desktop-src"), topdown=True):
+    # retrieve html of page
+    page_dir = os.path.normpath(os.path.join("docs.microsoft.com/win32", realarb))
+    page_path = os.path.join(page_dir, "%s.html" % page_filename)
+    logger.debug("[+] download page %s  -> %s " % (url, page_path))
+    download_page(url, pages, page_path)
 
-        # if counter >=2000:
-        #     break
+    # don't care about top level pages
+    if realarb == '.':
+        return
 
-        for image_file in filter(lambda s: os.path.splitext(s)[1] in [".png", ".jpg", ".jpeg"], f):
-            realarb = os.path.relpath(r, os.path.join(source_dir, "win32-docs", "desktop-src"))
-            image_dir = os.path.join(download_dir, "docs.microsoft.com/win32", realarb)
-            filepath = os.path.join(image_dir, image_file)
+    # First time navigating in this directory
+    if not build_state.has_toc('win32', realarb):
 
-            os.makedirs(image_dir, exist_ok=True)
-            shutil.copyfile(os.path.join(r, image_file), filepath)
+        # download toc for page
+        toc_url = _toc_url(configuration, 'win32', realarb)
+        logger.info("[+] download toc for page %s" % (toc_url))
 
-        for markdown_file in filter(lambda s: os.path.splitext(s)[1] == ".md", f):
-            page_filename, page_ext = os.path.splitext(markdown_file)
+        toc = fetch_textfile(toc_url)
+        if toc is None:
 
-            realarb = os.path.relpath(r, os.path.join(source_dir, "win32-docs", "desktop-src"))
-            url = "https://docs.microsoft.com/en-us/windows/win32/{0:s}/{1:s}".format(
-                realarb,
-                page_filename
+            # Could not find a toc for this folder
+            build_state.set_toc('win32', realarb, {'items': [{}]})
+
+            build_state.add_entry(
+                'guides',
+                page_filename,
+                os.path.join(page_dir, "%s.html" % page_filename),
             )
 
-            # retrieve html of page
-            page_dir = os.path.join(download_dir, "docs.microsoft.com/win32", realarb)
-            filepath = os.path.join(page_dir, "%s.html" % page_filename)
-            logger.debug("[+] download page %s  -> %s " % (url, filepath))
-            download_textfile(url, filepath)
+        else:
+            component_toc = json.loads(toc)
+            item = component_toc['items'][0]
+            if "href" in item:
+                component_title = item['toc_title']
+                component_href = item['href']
+
+                build_state.set_toc('win32', realarb, component_toc)
+
+                build_state.add_entry(
+                    'guides',
+                    component_title,
+                    os.path.join(page_dir, "%s.html" % component_href),
+                )
 
-            # don't care about top level pages
-            if realarb == '.':
-                continue
+    # Adding current page to content toc
+    component_toc = build_state.get_toc('win32', realarb)
 
-            # First time navigating in this directory
-            if realarb not in content_toc['toc'].keys():
+    # Class page
+    if "ADSchema" in realarb and page_filename.startswith("c-"):
+        logger.info("[+] new class page %s" % (page_filename))
 
-                # download toc for page
-                toc_url = "https://docs.microsoft.com/en-us/windows/win32/{0:s}/toc.json".format(
-                    realarb
-                )
-                logger.info("[+] download toc for page %s" % (toc_url))
+        page_title = _findname(component_toc['items'][0], page_filename)
+        if not page_title:
+            page_title = page_filename
 
-                toc_r = requests.get(toc_url)
-                if toc_r.status_code != 200:
+        build_state.add_entry('classes', page_title, page_path)
 
-                    # Could not find a toc for this folder
-                    content_toc['toc'][realarb] = {
-                        'toc': {'items': [{}]}
-                    }
+    # Attribute page
+    elif "ADSchema" in realarb and page_filename.startswith("a-"):
+        logger.debug("[+] new attribute page %s" % (page_filename))
 
-                    content_toc['guides'].append(
-                        {
-                            'name': page_filename,
-                            'path': os.path.join(os.path.relpath(page_dir, download_dir), "%s.html" % page_filename),
-                        }
-                    )
+        page_title = _findname(component_toc['items'][0], page_filename)
+        if not page_title:
+            page_title = page_filename
 
-                else:
-                    component_toc = json.loads(requests.get(toc_url).text)
-                    item = component_toc['items'][0]
-                    if "href" in item:
-                        component_title = item['toc_title']
-                        component_href = item['href']
-
-                        content_toc['toc'][realarb] = {
-                            'toc': component_toc
-                        }
-
-                        content_toc['guides'].append(
-                            {
-                                'name': component_title,
-                                'path': os.path.join(
-                                    os.path.relpath(page_dir, download_dir),
-                                    "%s.html" % component_href
-                                ),
-                            }
-                        )
-
-            # Adding current page to content toc
-
-            # Class page
-            if "ADSchema" in realarb and page_filename.startswith("c-"):
-                logger.info("[+] new class page %s" % (page_filename))
+        build_state.add_entry('attributes', page_title, page_path)
 
-                page_title = _findname(content_toc['toc'][realarb]['toc']['items'][0], page_filename)
-                if not page_title:
-                    page_title = page_filename
+    # Generic entry
+    elif component_toc is not None:
+        try:
+            page_title = _findname(component_toc['items'][0], page_filename)
+            if not page_title:
+                page_title = page_filename
 
-                content_toc['classes'].append(
-                    {
-                        'name': page_title,
-                        'path': os.path.relpath(filepath, download_dir),
-                    }
-                )
+            build_state.add_entry('entries', page_title, page_path)
+        except Exception as e:
+            logger.warning("[!] could not find a name for page %s" % page_filename)
+            logger.warning("[!] %s" % e)
 
-            # Attribute page
-            elif "ADSchema" in realarb and page_filename.startswith("a-"):
-                logger.debug("[+] new attribute page %s" % (page_filename))
 
-                page_title = _findname(content_toc['toc'][realarb]['toc']['items'][0], page_filename)
-                if not page_title:
-                    page_title = page_filename
+def plan_msdn_contents(
+        configuration: Configuration,
+        pages: PageStore,
+        source_dir: str,
+        build_state: BuildStateStore
+):
+    """ Copy the win32 images, then plan the crawl of the MSDN modules and content pages """
 
-                content_toc['attributes'].append(
-                    {
-                        'name': page_title,
-                        'path': os.path.relpath(filepath, download_dir),
-                    }
-                )
+    desktop_src_dir = os.path.join(source_dir, "win32-docs", "desktop-src")
 
-            # Generic entry
-            elif realarb in content_toc['toc']:
-                try:
-                    page_title = _findname(content_toc['toc'][realarb]['toc']['items'][0], page_filename)
-                    if not page_title:
-                        page_title = page_filename
-
-                    content_toc['entries'].append(
-                        {
-                            'name': page_title,
-                            'path': os.path.relpath(filepath, download_dir),
-                        }
-                    )
-                except Exception as e:
-                    logger.warning("[!] could not find a name for page %s" % page_filename)
-                    logger.warning("[!] %s" % e)
+    for r, d, f in os.walk(desktop_src_dir, topdown=True):
+
+        # shards are made of top level desktop-src folders, top level pages being a shard of their own
+        if r == desktop_src_dir:
+            d[:] = [folder for folder in d if configuration.in_shard('win32', folder)]
+            if not configuration.in_shard('win32', '.'):
+                continue
+
+        realarb = os.path.relpath(r, desktop_src_dir)
+
+        for image_file in filter(lambda s: os.path.splitext(s)[1] in [".png", ".jpg", ".jpeg"], f):
+            image_path = os.path.join("docs.microsoft.com/win32", realarb, image_file)
+
+            with open(os.path.join(r, image_file), 'rb') as image_fd:
+                pages.put(image_path, image_fd.read())
+
+        for markdown_file in filter(lambda s: os.path.splitext(s)[1] == ".md", f):
+            page_filename, page_ext = os.path.splitext(markdown_file)
+
+            build_state.add_crawl_task(
+                CrawlTask(_crawl_priority('win32', realarb, page_filename), 'win32', realarb, page_filename)
+            )
+
+
+# a planned page to crawl, lowest priority first
+CrawlTask = collections.namedtuple('CrawlTask', 'priority, corpus, directory, page')
+
+
+def _crawl_priority(corpus: str, directory: str, page_filename: str):
+    """ crawl priority of a page, the most used reference first """
+    if corpus == 'sdk-api':
+        if _sdk_api_category(page_filename) in ("functions", "structures", "interfaces", "enums"):
+            return Configuration.crawl_priorities['sdk-api reference']
+        return Configuration.crawl_priorities['sdk-api']
+
+    if "ADSchema" in directory and page_filename.startswith("c-"):
+        return Configuration.crawl_priorities['ADSchema classes']
+    return Configuration.crawl_priorities['win32']
+
+
+def crawl_contents(
+        configuration: Configuration,
+        pages: PageStore,
+        source_dir: str,
+        api_source_dir: str,
+        build_state: BuildStateStore,
+        snapshot=None
+):
+    """
+    Plan every page of both corpora in the build state, then crawl them highest priority first.
+
+    Only the source folders are read to plan, the TOC of a sdk-api directory is downloaded when its first
+    page is crawled. snapshot() is called every configuration.snapshot_interval seconds and whenever
+    a priority is done, the stores being committed beforehand.
+    """
+    logger.info("[1] planning sdk-api and win32 crawl")
+    build_state.clear_crawl_plan()
+    plan_sdk_api_contents(configuration, api_source_dir, build_state)
+    plan_msdn_contents(configuration, pages, source_dir, build_state)
+    build_state.commit()
+
+    priority_counts = build_state.crawl_plan_counts()
+    total = sum(count for priority, count in priority_counts)
+    logger.info(
+        "[1] crawling %d pages, per priority : %s" % (
+        total, ", ".join("%d: %d" % item for item in priority_counts))
+    )
+
+    # pages of a priority are crawled in source order, keeping the pages of a folder together
+    crawled = 0
+    planned = 0
+    has_sdk_api_toc = {}
+    last_snapshot = time.monotonic()
+    for priority, count in priority_counts:
+        planned += count
+
+        for task in build_state.iter_crawl_tasks(priority):
+            if task.corpus == 'win32':
+                crawl_msdn_page(configuration, pages, task.directory, task.page, build_state)
+            else:
+                if task.directory not in has_sdk_api_toc:
+                    has_sdk_api_toc[task.directory] = fetch_sdk_api_toc(configuration, task.directory, build_state)
+
+                # only index folders with a toc
+                if has_sdk_api_toc[task.directory] and task.page == "index":
+                    crawl_sdk_api_index(configuration, pages, task.directory, build_state)
+                elif has_sdk_api_toc[task.directory]:
+                    crawl_sdk_api_page(configuration, pages, task.directory, task.page, build_state)
+
+            crawled += 1
+            if crawled % 100 == 0:
+                build_state.commit()
+
+            if snapshot is None or crawled == total:
+                continue
+
+            priority_done = crawled == planned
+            if priority_done or time.monotonic() - last_snapshot >= configuration.snapshot_interval:
+                build_state.commit()
+                pages.commit()
+
+                logger.info("[1] snapshot after %d/%d pages" % (crawled, total))
+                snapshot()
+                last_snapshot = time.monotonic()
+
+    build_state.commit()
+
+
+# theme resource to download : (url, path relative to the Documents folder)
+ThemeResourceRecord = collections.namedtuple('ThemeResourceRecord', 'url, path')
+
+
+class LinkTargetIndex:
+    """ Hash index of every document path produced by the build, for O(1) link target lookups """
+
+    def __init__(self, paths=()):
+        # lowercase unix path -> actual path, links are not consistent about case
+        self._paths = {}
+        for path in paths:
+            self.add(path)
+
+    @classmethod
+    def from_directory(cls, documents_dir: str):
+        return cls(
+            os.path.relpath(html_file, documents_dir)
+            for html_file in glob.glob("%s/**/*.html" % documents_dir, recursive=True)
+        )
+
+    def add(self, path: str):
+        path = path.replace(os.sep, '/')
+        self._paths.setdefault(path.lower(), path)
+
+    def remove(self, path: str):
+        self._paths.pop(path.replace(os.sep, '/').lower(), None)
+
+    def resolve(self, path: str):
+        """ return the indexed path matching this document path, or None if the build did not produce it """
+        return self._paths.get(path.replace(os.sep, '/').lower())
+
+    def __len__(self):
+        return len(self._paths)
+
+
+class DeadLinkReport:
+    """ Links pointing to documents the build did not produce, collected while rewriting """
+
+    def __init__(self):
+        self.targets = collections.Counter()
+        self.examples = {}
+
+    def add(self, target: str, href: str, page_path: str):
+        target = target.replace(os.sep, '/')
+        self.targets[target] += 1
+        self.examples.setdefault(target, (href, page_path.replace(os.sep, '/')))
+
+    def __len__(self):
+        return sum(self.targets.values())
+
+    def merge(self, other: 'DeadLinkReport'):
+        self.targets.update(other.targets)
+        for target, example in other.examples.items():
+            self.examples.setdefault(target, example)
+
+    def write(self, report_filepath: str):
+        """ dump the report as json, most referenced targets first """
+        report = {
+            'dead_links': len(self),
+            'missing_targets': len(self.targets),
+            'targets': [
+                {
+                    'target': target,
+                    'count': count,
+                    'href': self.examples[target][0],
+                    'example_page': self.examples[target][1],
+                }
+                for target, count in self.targets.most_common()
+            ],
+        }
+
+        with open(report_filepath, "w") as report_fd:
+            json.dump(report, report_fd, indent=2)
+
+
+class _RecordingLinkIndex:
+    """ LinkTargetIndex proxy remembering every lookup, i.e. which link targets a rewritten page depends on """
+
+    def __init__(self, link_index: LinkTargetIndex):
+        self.link_index = link_index
+        self.lookups = {}
 
+    def resolve(self, path: str):
+        resolved = self.link_index.resolve(path)
+        self.lookups[path.replace(os.sep, '/').lower()] = resolved
+        return resolved
 
-            # counter+=1
 
-            # if counter >=2000:
-            #     break
+class RewriteCache:
+    """
+    Rewritten pages of previous builds, keyed by page path, source html digest, rewrite rules version and parser.
+
+    An entry is only reused if the rules which fired on the page are still at the same version, and if every
+    link target it looked up still resolves the same way. The looked up targets are indexed, so an incremental
+    build finds the pages to rewrite when documents are added or removed. Entries of a build scope (build folder)
+    which the last build of that scope neither reused nor wrote are pruned on close.
+    """
+
+    def __init__(self, filepath: str, configuration: Configuration, scope: str):
+        self.db = sqlite3.connect(filepath)
+        self.db.execute('PRAGMA synchronous = OFF;')
+
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS rewrites('
+            'key TEXT PRIMARY KEY, scope TEXT, path TEXT, rules TEXT, html BLOB, resources TEXT, lookups TEXT, '
+            'dead_links TEXT, title TEXT, body TEXT);'
+        )
+        self.db.execute('CREATE TABLE IF NOT EXISTS targets(target TEXT, key TEXT);')
+        self.db.execute('CREATE INDEX IF NOT EXISTS targets_target ON targets (target);')
+        self.db.execute('CREATE INDEX IF NOT EXISTS targets_key ON targets (key);')
+        self.db.execute('CREATE TEMP TABLE used(key TEXT PRIMARY KEY);')
+        self.scope = scope
+
+        # every setting rewrite_soup output depends on, besides the rules themselves
+        self.settings = "%d:%s:%s:%s" % (
+            Configuration.rewrite_rules_version,
+            Configuration.rewrite_parser,
+            configuration.docs_url,
+            configuration.dead_link_policy,
+        )
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, html_path: str, source_digest: str):
+        return hashlib.sha256(("%s\0%s\0%s" % (self.settings, html_path, source_digest)).encode('utf8')).hexdigest()
+
+    def get(self, key: str, link_index: LinkTargetIndex, with_text: bool = False):
+        """ return (html, resources, dead_links, title, body) if a valid entry exists, None otherwise """
+        row = self.db.execute(
+            'SELECT rules, html, resources, lookups, dead_links, title, body FROM rewrites WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        rules, html, resources, lookups, dead_links, title, body = row
+        if with_text and body is None:
+            self.misses += 1
+            return None
+
+        for rule, version in json.loads(rules).items():
+            if Configuration.rewrite_rule_versions.get(rule, 1) != version:
+                self.misses += 1
+                return None
+
+        for target, resolved in json.loads(lookups).items():
+            if link_index.resolve(target) != resolved:
+                self.misses += 1
+                return None
+
+        page_dead_links = DeadLinkReport()
+        for target, (count, href, page_path) in json.loads(dead_links).items():
+            page_dead_links.targets[target] = count
+            page_dead_links.examples[target] = (href, page_path)
+
+        self.db.execute('UPDATE rewrites SET scope = ? WHERE key = ?', (self.scope, key))
+        self.db.execute('INSERT OR IGNORE INTO used(key) VALUES (?)', (key,))
+        self.hits += 1
+        return (
+            zlib.decompress(html),
+            set(ThemeResourceRecord(url=url, path=path) for url, path in json.loads(resources)),
+            page_dead_links,
+            title,
+            body,
+        )
+
+    def put(
+            self,
+            key: str,
+            html_path: str,
+            rules: set,
+            html: bytes,
+            resources: set,
+            lookups: dict,
+            dead_links: DeadLinkReport,
+            title,
+            body
+    ):
+        """ store a rewritten page, rules being the names of the rules which fired on it """
+        self.db.execute(
+            'INSERT OR REPLACE INTO rewrites('
+            'key, scope, path, rules, html, resources, lookups, dead_links, title, body'
+            ') VALUES (?,?,?,?,?,?,?,?,?,?)',
+            (
+                key,
+                self.scope,
+                html_path.replace(os.sep, '/'),
+                json.dumps({rule: Configuration.rewrite_rule_versions.get(rule, 1) for rule in sorted(rules)}),
+                zlib.compress(html),
+                json.dumps(sorted(resources)),
+                json.dumps(lookups),
+                json.dumps({
+                    target: (count, ) + dead_links.examples[target]
+                    for target, count in dead_links.targets.items()
+                }),
+                title,
+                body,
+            )
+        )
+        self.db.execute('DELETE FROM targets WHERE key = ?', (key,))
+        self.db.executemany('INSERT INTO targets(target, key) VALUES (?,?)', ((target, key) for target in lookups))
+        self.db.execute('INSERT OR IGNORE INTO used(key) VALUES (?)', (key,))
+
+    def dependents(self, targets):
+        """ paths of the pages of this scope which looked up one of these link targets """
+        paths = set()
+        for target in targets:
+            paths.update(path for path, in self.db.execute(
+                'SELECT rewrites.path FROM targets JOIN rewrites ON rewrites.key = targets.key '
+                'WHERE targets.target = ? AND rewrites.scope = ?',
+                (target.replace(os.sep, '/').lower(), self.scope)
+            ))
+        return paths
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self, prune: bool = True):
+        """ prune unless the build only rewrote some pages, e.g. an incremental one """
+        if prune:
+            # entries of removed pages, previous sources, settings or rule versions can never be hit again
+            self.db.execute(
+                'DELETE FROM rewrites WHERE scope = ? AND key NOT IN (SELECT key FROM used)', (self.scope,)
+            )
+            self.db.execute('DELETE FROM targets WHERE key NOT IN (SELECT key FROM rewrites)')
+        self.db.commit()
+        self.db.close()
+
+
+class RewriteProfile:
+    """ Opt-in counters and timers of the rewrite rules, aggregated across pages """
+
+    def __init__(self):
+        # rule -> [pages, matches, removed, seconds], in first seen order
+        self.rules = {}
+
+    def add(self, rule: str, start: float, matches: int = 0, removed: int = 0):
+        """ account one application of a rule started at start (time.perf_counter) """
+        record = self.rules.setdefault(rule, [0, 0, 0, 0.0])
+        record[0] += 1
+        record[1] += matches
+        record[2] += removed
+        record[3] += time.perf_counter() - start
+
+    def merge(self, other: 'RewriteProfile'):
+        """ aggregate the profile of another worker """
+        for rule, (pages, matches, removed, seconds) in other.rules.items():
+            record = self.rules.setdefault(rule, [0, 0, 0, 0.0])
+            record[0] += pages
+            record[1] += matches
+            record[2] += removed
+            record[3] += seconds
+
+    def summary(self):
+        """ one line per rule, slowest first """
+        total = sum(record[3] for record in self.rules.values()) or 1.0
+        lines = ["%-52s %8s %9s %8s %10s %6s" % ("rule", "calls", "matches", "removed", "time (ms)", "%")]
+        for rule, (pages, matches, removed, seconds) in sorted(self.rules.items(), key=lambda item: -item[1][3]):
+            lines.append(
+                "%-52s %8d %9d %8d %10.1f %5.1f%%" % (
+                rule, pages, matches, removed, seconds * 1000, 100 * seconds / total)
+            )
+        return lines
+
+    def write(self, report_filepath: str):
+        report = [
+            {'rule': rule, 'calls': pages, 'matches': matches, 'removed': removed, 'seconds': round(seconds, 6)}
+            for rule, (pages, matches, removed, seconds) in self.rules.items()
+        ]
+        with open(report_filepath, "w") as report_fd:
+            json.dump(report, report_fd, indent=2)
+
+
+def _rewrite_internal_link(
+        configuration: Configuration,
+        abs_href,
+        uri_target: str,
+        html_path: str,
+        documents_dir: str,
+        link_index: LinkTargetIndex,
+        dead_links: DeadLinkReport
+):
+    """ rewrite an absolute href to a docs page as a relative link to the local copy of this page """
+
+    href = abs_href['href']
+    fragment = href[href.index('#'):] if '#' in href else ''
+
+    # module index
+    if uri_target[-1] in ('/', os.sep):
+        target_path = "%sindex.html" % uri_target
+    else:
+        # strip .html if it exists
+        uri_target, ext = os.path.splitext(uri_target)
+        target_path = "%s.html" % uri_target
+
+    if link_index is not None:
+        resolved_path = link_index.resolve(target_path)
+
+        if resolved_path is None:
+            dead_links.add(target_path, href, os.path.relpath(html_path, documents_dir))
+
+            if configuration.dead_link_policy == "drop":
+                logger.info("link drop : %s" % href)
+                abs_href.unwrap()
+            else:
+                logger.info("link rewrite : %s -> online" % href)
+                abs_href['href'] = "https://docs.microsoft.com" + href
+            return
+
+        target_path = resolved_path
+
+    rel_path = os.path.relpath(
+        os.path.join(documents_dir, target_path),
+        os.path.dirname(html_path)
+    )
+    rel_href = '/'.join(rel_path.split(os.sep)) + fragment
+
+    logger.info("link rewrite : %s -> %s " % (href, rel_href))
+    abs_href['href'] = rel_href
+    abs_href['data-linktype'] = "relative-path"
+
+
+def rewrite_soup(
+        configuration: Configuration,
+        soup,
+        html_path: str,
+        documents_dir: str,
+        link_index: 'LinkTargetIndex' = None,
+        dead_links: 'DeadLinkReport' = None,
+        profile: RewriteProfile = None,
+        fired: set = None
+):
+    """
+    rewrite html contents by fixing links and remove unnecessary cruft
 
-    return content_toc
+    The names of the rules which matched are added to fired, the rewrite cache keys pages on their versions.
+    """
 
+    page_path = os.path.relpath(html_path, documents_dir)
+    if dead_links is None:
+        dead_links = DeadLinkReport()
 
-def rewrite_soup(configuration: Configuration, soup, html_path: str, documents_dir: str):
-    """ rewrite html contents by fixing links and remove unnecessary cruft """
+    def applied(rule: str, start: float, matches: int = 0, removed: int = 0):
+        if fired is not None and matches:
+            fired.add(rule)
+        if profile is not None:
+            profile.add(rule, start, matches=matches, removed=removed)
 
     # Fix navigations links
+    start = time.perf_counter()
     links = soup.findAll("a", {"data-linktype": "relative-path"})  # for modules and cmdlet pages
     link_pattern = re.compile(r"([\w\.\/-]+)")
 
@@ -575,98 +2004,74 @@ def rewrite_soup(configuration: Configuration, soup, html_path: str, documents_d
             logger.info("link rewrite : %s -> %s " % (href, fixed_href))
             link['href'] = fixed_href
 
+        # relative links have no known online location, they are only reported
+        if link_index is not None:
+            target_path = os.path.normpath(os.path.join(os.path.dirname(page_path), fixed_href))
+            if not link_index.resolve(target_path):
+                dead_links.add(target_path, href, page_path)
+
+    applied("relative links", start, matches=len(links))
+
     # remove link to external references if we can't support it
-    for abs_href in soup.findAll("a", {"data-linktype": "absolute-path"}):
+    start = time.perf_counter()
+    abs_hrefs = soup.findAll("a", {"data-linktype": "absolute-path"})
+    applied("absolute links : select", start, matches=len(abs_hrefs))
+
+    for abs_href in abs_hrefs:
+        start = time.perf_counter()
+        href_path = re.split(r"[?#]", abs_href['href'], maxsplit=1)[0]
+
+        # localized pages link to their own locale, matched like /en-us/ links
+        is_localized = Configuration.locale_pattern.match(href_path) is not None
+        href_path = Configuration.locale_pattern.sub("/%s/" % Configuration.default_locale, href_path)
 
         # some externals hrefs are like this win32 -> api:
         #   <a href="/en-us/windows/win32/api/activation/nn-activation-iactivationfactory" data-linktype="absolute-path">IActivationFactory</a>
-        if abs_href['href'].startswith("/en-us/windows/win32/api/"):
+        if href_path.startswith("/en-us/windows/win32/api/"):
 
             # remove prefixing /
-            prefix, *abs_suffix = abs_href['href'].split("/")
+            prefix, *abs_suffix = href_path.split("/")
+            uri_target = os.path.join("docs.microsoft.com", *abs_suffix)
 
-            # strip .html if it exists
-            html_uri, ext = os.path.splitext(
-                os.path.relpath(html_path, os.path.join(documents_dir, "docs.microsoft.com"))
-            )
-            uri_target, ext = os.path.splitext(os.path.join("docs.microsoft.com", *abs_suffix))
-
-            rel_href = os.path.relpath(uri_target, html_uri)
-
-            # rel_href = os.path.relpath(full_url_target, full_url_html_page)
-            if rel_href[-1] == '/':  # module index
-                rel_href = "%sindex.html" % rel_href
-            else:
-                rel_href = "%s.html" % rel_href
-
-            logger.info("link rewrite : %s -> %s " % (abs_href['href'], rel_href))
-            abs_href['href'] = rel_href
-            abs_href['data-linktype'] = "relative-path"
+            _rewrite_internal_link(configuration, abs_href, uri_target, html_path, documents_dir, link_index, dead_links)
+            rule = "absolute links : win32/api"
 
         # some externals hrefs are like this win32 -> win32 :
         # <a href="/en-us/windows/desktop/api/FileAPI/nf-fileapi-definedosdevicew" data-linktype="absolute-path"><strong>DefineDosDevice</strong></a>
-        elif abs_href['href'].startswith("/en-us/windows/desktop/api/"):
+        elif href_path.startswith("/en-us/windows/desktop/api/"):
 
             # rewrite /en-us/windows/desktop/api to /en-us/windows/win32/api
-            prefix, abs_suffix = abs_href['href'].split("/en-us/windows/desktop/api/")
-
-            # strip .html if it exists
-            html_uri, ext = os.path.splitext(
-                os.path.relpath(html_path, os.path.join(documents_dir, "docs.microsoft.com"))
-            )
-            uri_target, ext = os.path.splitext(
-                os.path.join("docs.microsoft.com", "en-us", "windows", "win32", "api", abs_suffix)
-            )
-
-            rel_href = os.path.relpath(uri_target, html_uri)
-
-            # rel_href = os.path.relpath(full_url_target, full_url_html_page)
-            if rel_href[-1] == '/':  # module index
-                rel_href = "%sindex.html" % rel_href
-            else:
-                rel_href = "%s.html" % rel_href
-
-            logger.info("link rewrite : %s -> %s " % (abs_href['href'], rel_href))
-            abs_href['href'] = rel_href
-            abs_href['data-linktype'] = "relative-path"
+            prefix, abs_suffix = href_path.split("/en-us/windows/desktop/api/")
+            uri_target = os.path.join("docs.microsoft.com", "en-us", "windows", "win32", "api", abs_suffix)
 
+            _rewrite_internal_link(configuration, abs_href, uri_target, html_path, documents_dir, link_index, dead_links)
+            rule = "absolute links : desktop/api"
 
         # some externals hrefs are like this win32 -> win32 :
         #   <a href="/en-us/windows/desktop/winauto/inspect-objects" data-linktype="absolute-path">Inspect</a>
-        elif abs_href['href'].startswith("/en-us/windows/desktop/"):
+        elif href_path.startswith("/en-us/windows/desktop/"):
 
             # rewrite /en-us/windows/desktop to /win32/
-            prefix, abs_suffix = abs_href['href'].split("/en-us/windows/desktop/")
-
-            # strip .html if it exists
-            html_uri, ext = os.path.splitext(
-                os.path.relpath(html_path, os.path.join(documents_dir, "docs.microsoft.com"))
-            )
-            uri_target, ext = os.path.splitext(os.path.join("docs.microsoft.com", "win32", abs_suffix))
-
-            rel_href = os.path.relpath(uri_target, html_uri)
-
-            # rel_href = os.path.relpath(full_url_target, full_url_html_page)
-            if rel_href[-1] == '/':  # module index
-                rel_href = "%sindex.html" % rel_href
-            else:
-                rel_href = "%s.html" % rel_href
+            prefix, abs_suffix = href_path.split("/en-us/windows/desktop/")
+            uri_target = os.path.join("docs.microsoft.com", "win32", abs_suffix)
 
-            logger.info("link rewrite : %s -> %s " % (abs_href['href'], rel_href))
-            abs_href['href'] = rel_href
-            abs_href['data-linktype'] = "relative-path"
+            _rewrite_internal_link(configuration, abs_href, uri_target, html_path, documents_dir, link_index, dead_links)
+            rule = "absolute links : desktop"
 
         # some externals hrefs are like this :
         #   <a href="/en-us/uwp/api/windows.ui.viewmanagement.uisettings.textscalefactorchanged" data-linktype="absolute-path">UISettings.TextScaleFactorChanged Event</a>
-        elif abs_href['href'].startswith("/en-us/"):
+        elif is_localized:
             full_url_target = "https://docs.microsoft.com" + abs_href['href']
             abs_href['href'] = full_url_target
+            rule = "absolute links : online"
 
         # Remove every other linktype absolute since we don't know how to handle it
         else:
             # TODO : currently we don't replace it in order to show the broken urls
             # abs_href.replace_with(abs_href.text)
-            pass
+            rule = "absolute links : unsupported"
+
+        applied(rule, start, matches=1)
 
     # remove unsupported nav elements
     nav_elements = [
@@ -692,27 +2097,38 @@ def rewrite_soup(configuration: Configuration, soup, html_path: str, documents_d
     for nav in nav_elements:
         nav_class, nav_attr = nav
 
-        for nav_tag in soup.findAll(nav_class, nav_attr):
+        start = time.perf_counter()
+        nav_tags = soup.findAll(nav_class, nav_attr)
+        for nav_tag in nav_tags:
             _ = nav_tag.extract()
 
+        if nav_tags or profile is not None:
+            selector = " ".join("%s=%s" % item for item in nav_attr.items())
+            applied("nav : %s[%s]" % (nav_class, selector), start, matches=len(nav_tags), removed=len(nav_tags))
+
     # remove script elems
-    for head_script in soup.head.findAll("script"):
+    start = time.perf_counter()
+    head_scripts = soup.head.findAll("script")
+    for head_script in head_scripts:
         _ = head_script.extract()
 
-    # Extract and rewrite additionnal stylesheets to download
-    ThemeResourceRecord = collections.namedtuple('ThemeResourceRecord', 'url, path')
+    applied("head scripts", start, matches=len(head_scripts), removed=len(head_scripts))
 
+    # Extract and rewrite additionnal stylesheets to download
+    start = time.perf_counter()
     theme_output_dir = os.path.join(documents_dir, Configuration.domain)
     theme_resources = []
 
     for link in soup.head.findAll("link", {"rel": "stylesheet"}):
         uri_path = link['href'].strip()
 
-        if not uri_path.lstrip('/').startswith(Configuration.default_theme_uri):
+        # every locale shares the same stylesheets
+        uri_path = Configuration.theme_uri_pattern.sub(Configuration.default_theme_uri, uri_path.lstrip('/'))
+        if not uri_path.startswith(Configuration.default_theme_uri):
             continue
 
         # Construct (url, path) tuple
-        css_url = "https://%s/%s" % (Configuration.domain, uri_path)
+        css_url = "%s/%s" % (configuration.docs_url, uri_path.lstrip('/'))
         css_filepath = os.path.join(theme_output_dir, uri_path.lstrip('/'))
 
         # Converting href to a relative link
@@ -727,48 +2143,240 @@ def rewrite_soup(configuration: Configuration, soup, html_path: str, documents_d
             )
         )
 
+    applied("stylesheets", start, matches=len(theme_resources))
+
     return soup, set(theme_resources)
 
 
-def rewrite_html_contents(configuration: Configuration, html_root_dir: str):
-    """ rewrite every html file downloaded """
+def rewrite_html_contents(
+        configuration: Configuration,
+        pages: PageStore,
+        html_root_dir: str,
+        dead_links: DeadLinkReport = None,
+        fulltext: FullTextIndex = None,
+        cache: RewriteCache = None,
+        profile: RewriteProfile = None
+):
+    """ rewrite every html page downloaded, html_root_dir being the future location of the pages """
 
     additional_resources = set()
 
-    for html_file in glob.glob("%s/**/*.html" % html_root_dir, recursive=True):
-        logger.info("rewrite  html_file : %s" % (html_file))
+    # every produced document is indexed once, links are then resolved against it
+    html_paths = pages.paths(extensions=(".html",))
+    link_index = LinkTargetIndex(html_paths)
+    logger.info("indexed %d link targets" % len(link_index))
 
-        # Read content and parse html
-        with open(html_file, 'r', encoding='utf8') as i_fd:
-            html_content = i_fd.read()
+    if dead_links is None:
+        dead_links = DeadLinkReport()
 
-        soup = bs(html_content, 'html.parser')
+    for html_path in html_paths:
+        html_file = os.path.join(html_root_dir, *html_path.split('/'))
 
-        # rewrite html
-        soup, resources = rewrite_soup(configuration, soup, html_file, html_root_dir)
+        # unchanged page, same rules and same link targets : reuse the previous build output
+        start = time.perf_counter()
+        if cache is not None:
+            cache_key = cache.key(html_path, pages.digest(html_path))
+            cached = cache.get(cache_key, link_index, with_text=fulltext is not None)
+
+            if cached is not None:
+                fixed_html, resources, page_dead_links, title, body = cached
+                logger.debug("rewrite  html_file : %s (cached)" % (html_file))
+
+                additional_resources = additional_resources.union(resources)
+                dead_links.merge(page_dead_links)
+                if fulltext is not None:
+                    fulltext.add_text(html_path, title, body)
+
+                pages.put(html_path, fixed_html)
+                if profile is not None:
+                    profile.add("cached page", start)
+                continue
+
+        logger.info("rewrite  html_file : %s" % (html_file))
+
+        # Read content and parse html
+        html_content = pages.get(html_path).decode('utf8')
+
+        soup = bs(html_content, Configuration.rewrite_parser)
+        if profile is not None:
+            profile.add("parse", start)
+
+        # rewrite html, recording the rules fired, link targets and dead links of this page alone for the cache
+        page_link_index = _RecordingLinkIndex(link_index)
+        page_dead_links = DeadLinkReport()
+        page_rules = set()
+        soup, resources = rewrite_soup(
+            configuration, soup, html_file, html_root_dir, page_link_index, page_dead_links, profile, page_rules
+        )
         additional_resources = additional_resources.union(resources)
+        dead_links.merge(page_dead_links)
+
+        # index page text from the same parse
+        title, body = None, None
+        if fulltext is not None:
+            title, body = FullTextIndex.page_text(soup)
+            fulltext.add_text(html_path, title, body)
 
         # Export fixed html
+        start = time.perf_counter()
         fixed_html = soup.prettify("utf-8")
-        with open(html_file, 'wb') as o_fd:
-            o_fd.write(fixed_html)
+        if profile is not None:
+            profile.add("serialize", start)
+        pages.put(html_path, fixed_html)
+
+        if cache is not None:
+            cache.put(
+                cache_key, html_path, page_rules, fixed_html, resources, page_link_index.lookups, page_dead_links,
+                title, body
+            )
+
+    if cache is not None:
+        logger.info("[2] rewrite cache : %d pages reused, %d rewritten" % (cache.hits, cache.misses))
 
+    if profile is not None:
+        for line in profile.summary():
+            logger.info("[2] %s" % line)
+
+    pages.commit()
     return additional_resources
 
 
-def download_additional_resources(configuration: Configuration, documents_dir: str, resources_to_dl: set = set()):
+class ThemeResourceCache:
+    """ Theme stylesheets, fonts and images of previous builds by url, downloaded again only if their url changes """
+
+    def __init__(self, filepath: str):
+        self.db = sqlite3.connect(filepath)
+        self.db.execute('PRAGMA synchronous = OFF;')
+        self.db.execute('CREATE TABLE IF NOT EXISTS resources(url TEXT PRIMARY KEY, data BLOB);')
+
+    def get(self, url: str):
+        row = self.db.execute('SELECT data FROM resources WHERE url = ?', (url,)).fetchone()
+        return zlib.decompress(row[0]) if row else None
+
+    def put(self, url: str, data: bytes):
+        self.db.execute('INSERT OR REPLACE INTO resources(url, data) VALUES (?,?)', (url, zlib.compress(data)))
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+# css references to sub-resources : url(...) and @import "..."
+CSS_URL_PATTERN = re.compile(r"""url\(\s*(['"]?)([^'")]+?)\1\s*\)|@import\s+(['"])([^'"]+)\3""")
+
+
+def _theme_resource_path(configuration: Configuration, url: str):
+    """ path relative to the Documents folder of a theme resource url, None if it can't be stored locally """
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.scheme not in ("http", "https") or not parsed.path.strip('/') or parsed.path.endswith('/'):
+        return None
+
+    # resources of other hosts (e.g. fonts cdn) are kept apart
+    if parsed.netloc == urllib.parse.urlsplit(configuration.docs_url).netloc:
+        return posixpath.join(Configuration.domain, parsed.path.lstrip('/'))
+    return posixpath.join(Configuration.domain, "_external", parsed.netloc, parsed.path.lstrip('/'))
+
+
+def _rewrite_css_urls(configuration: Configuration, css: bytes, css_url: str, css_path: str):
+    """ rewrite the sub-resources of a stylesheet as local relative paths, return it along with their (url, path) """
+    references = []
+
+    def rewrite_reference(match):
+        quote, reference = (match.group(1), match.group(2)) if match.group(2) else (match.group(3), match.group(4))
+        reference = reference.strip()
+        if reference.startswith(('data:', '#')):
+            return match.group(0)
+
+        reference_url, fragment = urllib.parse.urldefrag(urllib.parse.urljoin(css_url, reference))
+        reference_path = _theme_resource_path(configuration, reference_url)
+        if reference_path is None:
+            return match.group(0)
+
+        references.append((reference_url, reference_path))
+        rel_uri = posixpath.relpath(reference_path, posixpath.dirname(css_path)) + ('#' + fragment if fragment else '')
+
+        if match.group(2):
+            return "url(%s%s%s)" % (quote, rel_uri, quote)
+        return "@import %s%s%s" % (quote, rel_uri, quote)
+
+    # surrogateescape round trips any byte the stylesheet may hold
+    css = CSS_URL_PATTERN.sub(rewrite_reference, css.decode('utf-8', errors='surrogateescape'))
+    return css.encode('utf-8', errors='surrogateescape'), references
+
+
+def fetch_theme_resources(
+        configuration: Configuration,
+        pages: PageStore,
+        resources: set,
+        cache: ThemeResourceCache = None
+):
+    """
+    Download theme stylesheets concurrently, then the stylesheets, fonts and images they reference,
+    level after level, rewriting the css references as local relative paths.
+    """
+    to_fetch = dict((resource.url, resource.path) for resource in resources)
+    seen = set(to_fetch)
+    fetched, cached, failed = 0, 0, 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=configuration.http_connections) as executor:
+        while to_fetch:
+            level, to_fetch = to_fetch, {}
+
+            contents = {}
+            futures = {}
+            for url in level:
+                data = cache.get(url) if cache is not None else None
+                if data is not None:
+                    contents[url] = data
+                    cached += 1
+                else:
+                    futures[url] = executor.submit(transport.get_content, url)
+
+            for url, future in futures.items():
+                data = future.result()
+                if data is None:
+                    logger.warning("[3] could not download theme resource %s" % url)
+                    failed += 1
+                    continue
+
+                contents[url] = data
+                fetched += 1
+                if cache is not None:
+                    cache.put(url, data)
+
+            for url, data in contents.items():
+                path = level[url]
+
+                if path.lower().endswith(".css"):
+                    data, references = _rewrite_css_urls(configuration, data, url, path)
+                    for reference_url, reference_path in references:
+                        if reference_url not in seen:
+                            seen.add(reference_url)
+                            to_fetch[reference_url] = reference_path
+
+                pages.put(path, data)
+
+    logger.info("[3] theme resources : %d downloaded, %d cached, %d failed" % (fetched, cached, failed))
+    return fetched + cached
+
+
+def download_additional_resources(
+        configuration: Configuration,
+        pages: PageStore,
+        resources_to_dl: set = set(),
+        cache: ThemeResourceCache = None
+):
     """ Download optional resources for "beautification """
 
-    for resource in resources_to_dl:
-        download_textfile(
-            resource.url,
-            os.path.join(documents_dir, resource.path)
-        )
+    fetch_theme_resources(configuration, pages, resources_to_dl, cache)
 
-    # Download index start page
-    src_index_filepath = os.path.join(documents_dir, Configuration.domain, "win32", "desktop-app-technologies.html")
-    index_filepath = os.path.join(documents_dir, Configuration.domain, "win32", "index.html")
-    shutil.copy(src_index_filepath, index_filepath)
+    # Download index start page, which a snapshot may not have crawled yet
+    src_index_path = os.path.join(Configuration.domain, "win32", "desktop-app-technologies.html")
+    index_path = os.path.join(Configuration.domain, "win32", "index.html")
+    index_html = pages.get(src_index_path)
+    if index_html is not None:
+        pages.put(index_path, index_html)
+    pages.commit()
 
     # soup = bs( configuration.webdriver.get_url_page(index_url), 'html.parser')
     # soup = rewrite_index_soup(configuration, soup, index_filepath, documents_dir)
@@ -782,7 +2390,160 @@ def download_additional_resources(configuration: Configuration, documents_dir: s
     # download_binary(icon_module_url, icon_module_path)
 
 
-def create_sqlite_database(configuration, content_toc, resources_dir, documents_dir):
+def _optimize_png(data: bytes):
+    """ losslessly recompress the image data of a png at the highest zlib level, keeping every other chunk """
+    if data[:8] != b"\x89PNG\r\n\x1a\n":
+        return data
+
+    chunks = []
+    idat = bytearray()
+    offset = 8
+    while offset + 8 <= len(data):
+        length, chunk_type = struct.unpack(">I4s", data[offset:offset + 8])
+        chunk_data = data[offset + 8:offset + 8 + length]
+        offset += 12 + length
+
+        if chunk_type == b"IDAT":
+            # consecutive IDAT chunks are merged into one
+            if (b"IDAT", None) not in chunks:
+                chunks.append((b"IDAT", None))
+            idat += chunk_data
+        else:
+            chunks.append((chunk_type, chunk_data))
+
+    try:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9)
+        new_idat = compressor.compress(zlib.decompress(bytes(idat))) + compressor.flush()
+    except zlib.error:
+        return data
+
+    optimized = bytearray(data[:8])
+    for chunk_type, chunk_data in chunks:
+        if chunk_data is None:
+            chunk_data = new_idat
+        optimized += struct.pack(">I", len(chunk_data)) + chunk_type + chunk_data
+        optimized += struct.pack(">I", zlib.crc32(chunk_type + chunk_data))
+
+    return bytes(optimized)
+
+
+def _optimize_jpeg(data: bytes):
+    """ losslessly optimize the huffman tables of a jpeg with jpegtran, when it is installed """
+    jpegtran = shutil.which("jpegtran")
+    if not jpegtran:
+        return data
+
+    # every marker is kept : ICC colour profiles and EXIF orientation change how the image is displayed
+    result = subprocess.run(
+        [jpegtran, "-copy", "all", "-optimize", "-progressive"],
+        input=data,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    if result.returncode != 0 or not result.stdout:
+        return data
+
+    return result.stdout
+
+
+def optimize_image(ext: str, data: bytes):
+    """ return the smallest lossless encoding of an image """
+    if ext == ".png":
+        optimized = _optimize_png(data)
+    else:
+        optimized = _optimize_jpeg(data)
+
+    return optimized if len(optimized) < len(data) else data
+
+
+def optimize_images(configuration: Configuration, pages: PageStore, cache_filepath: str, report_filepath: str):
+    """
+    Losslessly recompress png and jpeg images across a process pool.
+
+    Results are cached by content hash across builds, so unchanged images are never processed twice.
+    """
+    cache = sqlite3.connect(cache_filepath)
+    cache.execute('CREATE TABLE IF NOT EXISTS images(digest TEXT PRIMARY KEY, size INTEGER, optimized BLOB);')
+
+    # identical images are processed once
+    image_paths = collections.defaultdict(list)
+    for path in pages.paths(extensions=(".png", ".jpg", ".jpeg")):
+        image_paths[pages.digest(path)].append(path)
+
+    to_optimize = [
+        digest for digest in image_paths
+        if cache.execute('SELECT 1 FROM images WHERE digest = ?', (digest,)).fetchone() is None
+    ]
+    logger.info("[3] optimizing %d images, %d cached" % (len(to_optimize), len(image_paths) - len(to_optimize)))
+
+    def cache_result(digest, size, optimized):
+        # unchanged images are cached without data
+        cache.execute(
+            'INSERT OR REPLACE INTO images(digest, size, optimized) VALUES (?,?,?)',
+            (digest, size, zlib.compress(optimized) if len(optimized) < size else None)
+        )
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=configuration.compression_jobs) as executor:
+        pending = collections.deque()
+
+        for digest in to_optimize:
+            path = image_paths[digest][0]
+            data = pages.get(path)
+            ext = os.path.splitext(path)[1].lower()
+            pending.append((digest, len(data), executor.submit(optimize_image, ext, data)))
+
+            while len(pending) > 4 * configuration.compression_jobs:
+                digest, size, future = pending.popleft()
+                cache_result(digest, size, future.result())
+
+        while pending:
+            digest, size, future = pending.popleft()
+            cache_result(digest, size, future.result())
+
+    cache.commit()
+
+    size_before = 0
+    size_after = 0
+    for digest, paths in image_paths.items():
+        size, optimized = cache.execute('SELECT size, optimized FROM images WHERE digest = ?', (digest,)).fetchone()
+        size_before += size * len(paths)
+
+        if optimized is None:
+            size_after += size * len(paths)
+            continue
+
+        optimized = zlib.decompress(optimized)
+        size_after += len(optimized) * len(paths)
+        for path in paths:
+            pages.put(path, optimized)
+
+    pages.commit()
+    cache.close()
+
+    report = {
+        'images': sum(len(paths) for paths in image_paths.values()),
+        'distinct_images': len(image_paths),
+        'optimized_this_build': len(to_optimize),
+        'size_before': size_before,
+        'size_after': size_after,
+    }
+    with open(report_filepath, "w") as report_fd:
+        json.dump(report, report_fd, indent=2)
+
+    logger.info(
+        "[3] images : %.1f MB -> %.1f MB (%d images, %d processed)" % (
+        size_before / 1e6, size_after / 1e6, report['images'], len(to_optimize))
+    )
+    return report
+
+
+def create_sqlite_database(
+        configuration,
+        build_state: BuildStateStore,
+        resources_dir,
+        documents_dir,
+        fulltext: FullTextIndex = None
+):
     """ Indexing the html document in a format Dash can understand """
 
     def insert_into_sqlite_db(cursor, name, record_type, path):
@@ -811,89 +2572,892 @@ def create_sqlite_database(configuration, content_toc, resources_dir, documents_
 
     db = sqlite3.connect(sqlite_filepath)
     cur = db.cursor()
+    cur.execute('PRAGMA page_size = %d;' % Configuration.index_page_size)
     cur.execute('CREATE TABLE searchIndex(id INTEGER PRIMARY KEY, name TEXT, type TEXT, path TEXT);')
     cur.execute('CREATE UNIQUE INDEX anchor ON searchIndex (name, type, path);')
 
-    mapping = {
-        # win32 content
-        "guides": "Guide",
-        "attributes": "Attribute",
-        "classes": "Class",
-        "entries": "Entry",
-
-        # api-sdk content
-        "categories": "Category",
-        "files": "File",
-
-        'callbacks': "Callback",
-        'functions': "Function",
-        'enums': "Enum",
-        'interfaces': "Interface",
-        'structures': "Structure",
+    # the path index is used by the unicity checks of every insert
+    tune_sqlite_database(db)
 
-    }
+    mapping = Configuration.index_types
 
     # import pdb;pdb.set_trace()
     for key in mapping.keys():
 
-        for _value in content_toc.get(key, []):
+        for _value in build_state.iter_entries(key):
             # path should be unix compliant
             value_path = _value['path'].replace(os.sep, '/')
             insert_into_sqlite_db(cur, _value['name'], mapping[key], value_path)
 
             # commit and close db
     db.commit()
+
+    if fulltext is not None:
+        fulltext.copy_into(db)
+
+    # statistics and compaction of the filled index
+    tune_sqlite_database(db)
     db.close()
 
 
-def copy_folder(src_folder: str, dst_folder: str):
-    """ Copy a full folder tree anew every time """
+def tune_sqlite_database(db):
+    """ Index docSet.dsidx for the case insensitive name searches of Dash and Zeal, then compact it """
 
-    def onerror(func, path, exc_info):
-        """
-        Error handler for ``shutil.rmtree``.
+    # LIKE 'prefix%' can only use an index with a NOCASE collation
+    db.execute('CREATE INDEX IF NOT EXISTS searchIndex_name_nocase ON searchIndex (name COLLATE NOCASE);')
+    db.execute('CREATE INDEX IF NOT EXISTS searchIndex_path ON searchIndex (path);')
+    db.execute('ANALYZE;')
+    db.commit()
 
-        If the error is due to an access error (read only file)
-        it attempts to add write permission and then retries.
+    # page size changes only take effect on vacuum
+    db.execute('PRAGMA page_size = %d;' % Configuration.index_page_size)
+    db.execute('VACUUM;')
 
-        If the error is for another reason it re-raises the error.
 
-        Usage : ``shutil.rmtree(path, onerror=onerror)``
-        """
-        import stat
+def benchmark_sqlite_database(sqlite_filepath: str, queries: int = 1000, seed: int = 0):
+    """ Replay exact, prefix and substring name searches against docSet.dsidx, return latencies per query kind """
 
-        if not os.path.exists(path):
-            return
+    db = sqlite3.connect(sqlite_filepath)
+    names = [name for name, in db.execute('SELECT name FROM searchIndex WHERE name IS NOT NULL')]
+    if not names:
+        raise ValueError("no rows in %s" % sqlite_filepath)
+
+    # what users type : lowercase fragments of existing names
+    rng = random.Random(seed)
+    searches = {'exact': [], 'prefix': [], 'substring': []}
+    for name in rng.choices(names, k=queries):
+        name = name.lower()
+        searches['exact'].append(name)
+        searches['prefix'].append(name[:rng.randint(1, min(len(name), 6))])
+        start = rng.randint(0, max(len(name) - 3, 0))
+        searches['substring'].append(name[start:start + rng.randint(3, 6)])
+
+    statements = {
+        'exact': "SELECT name, type, path FROM searchIndex WHERE name = ? COLLATE NOCASE LIMIT 100",
+        'prefix': "SELECT name, type, path FROM searchIndex WHERE name LIKE ? ESCAPE '\\' "
+                  "ORDER BY name COLLATE NOCASE LIMIT 100",
+        'substring': "SELECT name, type, path FROM searchIndex WHERE name LIKE ? ESCAPE '\\' LIMIT 100",
+    }
 
-        if not os.access(path, os.W_OK):
-            # Is the error an access error ?
-            os.chmod(path, stat.S_IWUSR)
-            func(path)
-        else:
-            raise
+    def like_escape(text):
+        return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+    results = {}
+    for kind, statement in statements.items():
+        if kind == 'prefix':
+            searches[kind] = [like_escape(search) + '%' for search in searches[kind]]
+        elif kind == 'substring':
+            searches[kind] = ['%' + like_escape(search) + '%' for search in searches[kind]]
 
-    # print(dst_folder)
-    shutil.rmtree(dst_folder, ignore_errors=False, onerror=onerror)
-    shutil.copytree(src_folder, dst_folder)
+        plan = ' / '.join(row[-1] for row in db.execute('EXPLAIN QUERY PLAN ' + statement, (searches[kind][0],)))
 
+        latencies = []
+        for search in searches[kind]:
+            start = time.perf_counter()
+            db.execute(statement, (search,)).fetchall()
+            latencies.append((time.perf_counter() - start) * 1000)
 
-def merge_folders(src, dst):
-    if os.path.isdir(src):
+        latencies.sort()
+        results[kind] = {
+            'p50_ms': latencies[len(latencies) // 2],
+            'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+            'max_ms': latencies[-1],
+            'plan': plan,
+        }
 
-        if not os.path.exists(dst):
-            os.makedirs(dst)
+    db.close()
+    return len(names), results
+
+
+# href and src attributes of the tags a docset page links with
+HTML_REFERENCE_PATTERN = re.compile(
+    r"""<(a|link|img|script|source)\b[^>]*?\s(?:href|src)\s*=\s*(?:"([^"]*)"|'([^']*)')""",
+    re.IGNORECASE
+)
+URL_SCHEME_PATTERN = re.compile(r"^[a-zA-Z][a-zA-Z0-9+.-]*:")
+
+
+def _local_reference(reference: str):
+    """ path part of a relative reference, None for external, anchor-only or data references """
+    reference = reference.strip()
+    if not reference or reference.startswith(('#', '/', 'data:', 'mailto:', 'javascript:')):
+        return None
+    if URL_SCHEME_PATTERN.match(reference):
+        return None
+
+    path = urllib.parse.unquote(re.split(r"[?#]", reference, maxsplit=1)[0])
+    return path or None
+
+
+def _verify_documents(documents_dir: str, paths: list):
+    """ check the relative links of a chunk of html pages and stylesheets, return (references checked, broken) """
+    checked = 0
+    broken = []
 
-        for name in os.listdir(src):
-            merge_folders(
-                os.path.join(src, name),
-                os.path.join(dst, name)
+    # pages of a chunk mostly link to the same targets, stat each one once
+    exists = {}
+
+    for path in paths:
+        filepath = os.path.join(documents_dir, *path.split('/'))
+        with open(filepath, 'rb') as i_fd:
+            content = i_fd.read().decode('utf-8', errors='replace')
+
+        if path.lower().endswith('.css'):
+            references = (
+                ('asset', match.group(2) or match.group(4))
+                for match in CSS_URL_PATTERN.finditer(content)
+            )
+        else:
+            references = (
+                ('link' if match.group(1).lower() == 'a' else 'asset', match.group(2) or match.group(3) or '')
+                for match in HTML_REFERENCE_PATTERN.finditer(content)
             )
-    else:
-        shutil.copyfile(src, dst)
 
+        page_dir = os.path.dirname(filepath)
+        for kind, reference in references:
+            reference_path = _local_reference(reference)
+            if reference_path is None:
+                continue
 
-def main(configuration: Configuration):
-    # """ Scheme for content toc :
+            checked += 1
+            target = os.path.normpath(os.path.join(page_dir, reference_path))
+            if target not in exists:
+                exists[target] = os.path.isfile(target)
+            if not exists[target]:
+                broken.append((kind, path, reference))
+
+    return checked, broken
+
+
+def verify_docset(docset_dir: str, jobs: int = None, chunk_size: int = 256):
+    """
+    Check that every searchIndex row points to an existing document, and that the relative links, stylesheets
+    and images of every page and stylesheet resolve, across a process pool. Return the report as a dict.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    resources_dir = os.path.join(docset_dir, "Contents", "Resources")
+    documents_dir = os.path.join(resources_dir, "Documents")
+
+    start = time.perf_counter()
+    broken = collections.defaultdict(list)
+
+    # index rows
+    db = sqlite3.connect(os.path.join(resources_dir, "docSet.dsidx"))
+    index_paths = [path for path, in db.execute('SELECT DISTINCT path FROM searchIndex')]
+    db.close()
+
+    for path in index_paths:
+        document_path = re.split(r"[?#]", path, maxsplit=1)[0]
+        if not os.path.isfile(os.path.join(documents_dir, *document_path.split('/'))):
+            broken['index'].append((path, path))
+
+    # pages and stylesheets
+    documents = []
+    for root, dirs, files in os.walk(documents_dir):
+        for filename in files:
+            if filename.lower().endswith(('.html', '.css')):
+                documents.append(os.path.relpath(os.path.join(root, filename), documents_dir).replace(os.sep, '/'))
+
+    checked = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(_verify_documents, documents_dir, documents[offset:offset + chunk_size])
+            for offset in range(0, len(documents), chunk_size)
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            chunk_checked, chunk_broken = future.result()
+            checked += chunk_checked
+            for kind, path, reference in chunk_broken:
+                broken[kind].append((path, reference))
+
+    report = {
+        'index_rows': len(index_paths),
+        'documents': len(documents),
+        'references': checked,
+        'broken': sum(len(items) for items in broken.values()),
+        'elapsed_s': round(time.perf_counter() - start, 3),
+    }
+    for kind in ('index', 'link', 'asset'):
+        report['broken_%s' % kind] = [
+            {'document': path, 'reference': reference}
+            for path, reference in sorted(broken[kind])
+        ]
+
+    return report
+
+
+def copy_page_store(src_filepath: str, dst_folder: str):
+    """ Copy a stage page store anew every time, return the copy filepath """
+    dst_filepath = os.path.join(dst_folder, os.path.basename(src_filepath))
+    shutil.copyfile(src_filepath, dst_filepath)
+    return dst_filepath
+
+
+def merge_shards(configuration: Configuration, shard_build_folders: list):
+    """ Combine the page trees and TOC fragments of crawl shards, then build the docset from them """
+
+    download_dir = os.path.join(configuration.build_folder, "_1_downloaded_contents")
+    shutil.rmtree(download_dir, ignore_errors=True)
+    os.makedirs(download_dir)
+
+    build_state = BuildStateStore(os.path.join(download_dir, "build_state.sqlite"))
+    pages = PageStore(os.path.join(download_dir, "pages.sqlite"))
+
+    for shard_build_folder in shard_build_folders:
+        shard_download_dir = os.path.join(shard_build_folder, "_1_downloaded_contents")
+        logger.info("[1] merging shard %s" % shard_download_dir)
+
+        pages.merge(os.path.join(shard_download_dir, "pages.sqlite"))
+        build_state.merge(os.path.join(shard_download_dir, "build_state.sqlite"))
+
+    pages.close()
+    build_state.close()
+
+    configuration.crawl_contents = False
+    main(configuration)
+
+
+class DocsetWatcher:
+    """
+    Long running incremental rebuild of a docset.
+
+    The build state, href -> title indexes, link index, rewrite cache, manifest and docSet.dsidx connection are
+    kept open between polls of the upstream source archives. When an archive changed, only the pages whose markdown
+    source was added, modified or deleted are downloaded again, rewritten, re-indexed and republished, along with
+    the pages linking to added or deleted pages and the index entries of directories whose TOC changed.
+    """
+
+    def __init__(self, configuration: Configuration):
+        self.configuration = configuration
+        build_folder = configuration.build_folder
+
+        self.source_dirs = {
+            'win32': os.path.join(build_folder, "_0_win32_source"),
+            'sdk-api': os.path.join(build_folder, "_0_api_sdk_source"),
+        }
+        self.source_urls = {
+            'win32': configuration.win32_source_url,
+            'sdk-api': configuration.sdk_api_source_url,
+        }
+
+        download_dir = os.path.join(build_folder, "_1_downloaded_contents")
+        self.docset_dir = os.path.join(build_folder, "_4_ready_to_be_packaged", "%s.docset" % Configuration.docset_name)
+        self.document_dir = os.path.join(self.docset_dir, "Contents", "Resources", "Documents")
+
+        if not os.path.exists(os.path.join(self.docset_dir, "Contents", "Resources", "docSet.dsidx")):
+            logger.info("[watch] no previous build in %s, building the docset first" % build_folder)
+            main(configuration)
+
+        self.build_state = BuildStateStore(os.path.join(download_dir, "build_state.sqlite"))
+        self.stores = [
+            PageStore(os.path.join(download_dir, "pages.sqlite")),
+            PageStore(os.path.join(build_folder, "_2_html_rewrite", "pages.sqlite")),
+            PageStore(os.path.join(build_folder, "_3_additional_resources", "pages.sqlite")),
+        ]
+        self.dsidx = sqlite3.connect(os.path.join(self.docset_dir, "Contents", "Resources", "docSet.dsidx"))
+        self.has_fulltext = self.dsidx.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'searchBodies'"
+        ).fetchone() is not None
+
+        self.link_index = LinkTargetIndex(self.stores[-1].paths(extensions=(".html",)))
+        self.rewrite_cache = RewriteCache(
+            os.path.join(build_folder, "rewrite_cache.sqlite"), configuration, build_folder
+        )
+        self.manifest = build_docset_manifest(self.docset_dir)
+        self.titles = {}
+        self.etags = {}
+        self.source_digests = {corpus: self._source_digests(corpus) for corpus in self.source_dirs}
+
+    def _source_digests(self, corpus: str):
+        """ relative path -> sha256 of the markdown sources and images of a corpus """
+        digests = {}
+        source_dir = self.source_dirs[corpus]
+        for r, d, f in os.walk(source_dir):
+            for filename in f:
+                if os.path.splitext(filename)[1].lower() not in (".md", ".png", ".jpg", ".jpeg"):
+                    continue
+
+                filepath = os.path.join(r, filename)
+                with open(filepath, "rb") as i_fd:
+                    digests[os.path.relpath(filepath, source_dir).replace(os.sep, '/')] = hashlib.sha256(
+                        i_fd.read()
+                    ).hexdigest()
+
+        return digests
+
+    def _title(self, corpus: str, directory: str, href: str):
+        """ title of a page from its directory TOC, using in memory href -> title indexes """
+        if (corpus, directory) not in self.titles:
+            toc = self.build_state.get_toc(corpus, directory) or {}
+            self.titles[(corpus, directory)] = _toc_titles(toc)
+
+        return self.titles[(corpus, directory)].get(href)
+
+    def poll_sources(self):
+        """ download the source archives which changed upstream, return the changed source files per corpus """
+        changes = {}
+
+        for corpus, url in self.source_urls.items():
+            headers = {'If-None-Match': self.etags[corpus]} if corpus in self.etags else {}
+            r = transport.get(url, headers=headers, stream=True)
+
+            if r.status_code == 304:
+                continue
+            if r.status_code != 200:
+                logger.warning("[watch] could not poll %s : HTTP %d" % (url, r.status_code))
+                continue
+
+            source_dir = self.source_dirs[corpus]
+            archive_filepath = os.path.join(source_dir, "docs.zip")
+            with open(archive_filepath, "wb") as o_fd:
+                for data in r.iter_content(32 * 1024):
+                    o_fd.write(data)
+
+            if 'ETag' in r.headers:
+                self.etags[corpus] = r.headers['ETag']
+
+            # extract anew, so deleted sources disappear
+            with zipfile.ZipFile(archive_filepath, 'r') as zip_ref:
+                for name in set(member.split('/')[0] for member in zip_ref.namelist()):
+                    shutil.rmtree(os.path.join(source_dir, name), ignore_errors=True)
+                zip_ref.extractall(source_dir)
+
+            previous_digests = self.source_digests[corpus]
+            digests = self._source_digests(corpus)
+            self.source_digests[corpus] = digests
+
+            changed = set(path for path, digest in digests.items() if previous_digests.get(path) != digest)
+            deleted = set(path for path in previous_digests if path not in digests)
+            if changed or deleted:
+                changes[corpus] = (changed, deleted)
+
+            logger.info("[watch] %s sources : %d changed, %d deleted" % (corpus, len(changed), len(deleted)))
+
+        return changes
+
+    def _affected_pages(self, corpus: str, source_path: str):
+        """ (page path, url, index category, title) of the page generated from a source file """
+        configuration = self.configuration
+        page_filename, ext = os.path.splitext(os.path.basename(source_path))
+
+        if corpus == 'win32':
+            prefix = "win32-docs/desktop-src/"
+            if not source_path.startswith(prefix):
+                return None
+
+            realarb = os.path.dirname(source_path[len(prefix):]) or '.'
+            page_dir = os.path.normpath(os.path.join("docs.microsoft.com/win32", realarb))
+            if ext.lower() != ".md":
+                return os.path.join(page_dir, os.path.basename(source_path)), None, None, None
+
+            url = "{0:s}/windows/win32/{1:s}/{2:s}".format(configuration.locale_url, realarb, page_filename)
+            page_path = os.path.join(page_dir, "%s.html" % page_filename)
+            if realarb == '.':
+                return page_path, url, None, None
+
+            title = self._title('win32', realarb, page_filename) or page_filename
+            if "ADSchema" in realarb and page_filename.startswith("c-"):
+                return page_path, url, 'classes', title
+            elif "ADSchema" in realarb and page_filename.startswith("a-"):
+                return page_path, url, 'attributes', title
+            return page_path, url, 'entries', title
+
+        prefix = "sdk-api-docs/sdk-api-src/content/"
+        if not source_path.startswith(prefix) or ext.lower() != ".md":
+            return None
+
+        directory = os.path.dirname(source_path[len(prefix):])
+        if page_filename == "index":
+            url = "{0:s}/windows/win32/api/{1:s}".format(configuration.locale_url, directory)
+            page_path = "docs.microsoft.com/en-us/windows/win32/api/{0:s}/index.html".format(directory)
+            return page_path, url, None, None
+
+        url = "{0:s}/windows/win32/api/{1:s}/{2:s}".format(configuration.locale_url, directory, page_filename)
+        url_relpath = "/windows/win32/api/{0:s}/{1:s}".format(directory, page_filename)
+        title = self._title('sdk-api', directory, url_relpath)
+        page_path = "docs.microsoft.com/en-us{0:s}.html".format(url_relpath)
+        return page_path, url, _sdk_api_category(page_filename), title
+
+    def _publish_file(self, page_path: str, data: bytes):
+        filepath = os.path.join(self.document_dir, *page_path.split('/'))
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+        # never write through a deduplication hardlink
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        with open(filepath, "wb") as o_fd:
+            o_fd.write(data)
+
+    def _unpublish_file(self, page_path: str):
+        filepath = os.path.join(self.document_dir, *page_path.split('/'))
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+    def rebuild(self, changes: dict):
+        """ download, rewrite, index and publish the pages affected by source changes """
+        configuration = self.configuration
+        raw_pages, rewrite_pages, final_pages = self.stores
+        dead_links = DeadLinkReport()
+        cursor = self.dsidx.cursor()
+        to_rewrite = []
+        added_or_deleted = set()
+        published = 0
+
+        for corpus, (changed, deleted) in changes.items():
+
+            # TOCs of touched directories may have changed as well
+            self._refresh_tocs(corpus, changed | deleted)
+
+            for source_path in sorted(deleted):
+                affected = self._affected_pages(corpus, source_path)
+                if affected is None:
+                    continue
+
+                page_path = affected[0]
+                logger.info("[watch] removing %s" % page_path)
+                for pages in self.stores:
+                    pages.delete(page_path)
+                self._unpublish_file(page_path)
+                self.build_state.remove_entries(page_path)
+                if self.link_index.resolve(page_path) is not None:
+                    self.link_index.remove(page_path)
+                    added_or_deleted.add(page_path)
+                cursor.execute('DELETE FROM searchIndex WHERE path = ?', (page_path,))
+                if self.has_fulltext:
+                    cursor.execute('DELETE FROM searchBodies WHERE path = ?', (page_path,))
+                published += 1
+
+            for source_path in sorted(changed):
+                affected = self._affected_pages(corpus, source_path)
+                if affected is None:
+                    continue
+
+                page_path, url, category, title = affected
+
+                # images are copied as is
+                if url is None:
+                    with open(os.path.join(self.source_dirs[corpus], *source_path.split('/')), "rb") as i_fd:
+                        data = i_fd.read()
+                    for pages in self.stores:
+                        pages.put(page_path, data)
+                    self._publish_file(page_path, data)
+                    published += 1
+                    continue
+
+                logger.info("[watch] download page %s  -> %s " % (url, page_path))
+                if not download_page(url, raw_pages, page_path):
+                    logger.info("[watch] could not download page %s" % url)
+                    continue
+
+                if self.link_index.resolve(page_path) is None:
+                    self.link_index.add(page_path)
+                    added_or_deleted.add(page_path)
+                to_rewrite.append(page_path)
+
+                if category and title:
+                    self.build_state.remove_entries(page_path)
+                    self.build_state.add_entry(category, title, page_path)
+                    cursor.execute('DELETE FROM searchIndex WHERE path = ?', (page_path,))
+                    cursor.execute(
+                        'INSERT OR IGNORE INTO searchIndex(name, type, path) VALUES (?,?,?)',
+                        (title, Configuration.index_types[category], page_path)
+                    )
+
+        # pages which looked up an added or deleted page have a link to rewrite, online or relative
+        linking_pages = self.rewrite_cache.dependents(added_or_deleted) - set(to_rewrite)
+        to_rewrite.extend(sorted(page_path for page_path in linking_pages if page_path in raw_pages))
+
+        resources = set()
+        for page_path in to_rewrite:
+            html_file = os.path.join(self.document_dir, *page_path.split('/'))
+            soup = bs(raw_pages.get(page_path).decode('utf8'), Configuration.rewrite_parser)
+
+            # the lookups and fired rules are cached, as a full build would
+            page_link_index = _RecordingLinkIndex(self.link_index)
+            page_dead_links = DeadLinkReport()
+            page_rules = set()
+            soup, page_resources = rewrite_soup(
+                configuration, soup, html_file, self.document_dir, page_link_index, page_dead_links,
+                fired=page_rules
+            )
+            resources |= page_resources
+            dead_links.merge(page_dead_links)
+
+            title, body = None, None
+            if self.has_fulltext:
+                title, body = FullTextIndex.page_text(soup)
+                cursor.execute('DELETE FROM searchBodies WHERE path = ?', (page_path,))
+                cursor.execute(
+                    'INSERT INTO searchBodies(path, title, body) VALUES (?,?,?)',
+                    (page_path, title, body)
+                )
+
+            fixed_html = soup.prettify("utf-8")
+            rewrite_pages.put(page_path, fixed_html)
+            final_pages.put(page_path, fixed_html)
+            self._publish_file(page_path, fixed_html)
+            self.rewrite_cache.put(
+                self.rewrite_cache.key(page_path, raw_pages.digest(page_path)), page_path, page_rules, fixed_html,
+                page_resources, page_link_index.lookups, page_dead_links, title, body
+            )
+            published += 1
+
+        # only download stylesheets the docset does not have yet, along with their fonts and images
+        new_resources = set(resource for resource in resources if resource.path not in final_pages)
+        if new_resources:
+            known_paths = set(final_pages.paths())
+            theme_cache = ThemeResourceCache(os.path.join(configuration.build_folder, "theme_cache.sqlite"))
+            fetch_theme_resources(configuration, final_pages, new_resources, theme_cache)
+            theme_cache.close()
+
+            for resource_path in set(final_pages.paths()) - known_paths:
+                self._publish_file(resource_path, final_pages.get(resource_path))
+
+        for pages in self.stores:
+            pages.commit()
+        self.build_state.commit()
+        self.rewrite_cache.commit()
+        self.dsidx.commit()
+
+        logger.info(
+            "[watch] rebuilt %d pages, %d files published, %d dead links" % (
+            len(to_rewrite), published, len(dead_links))
+        )
+        return published
+
+    def _refresh_tocs(self, corpus: str, source_paths: set):
+        """ download again the TOCs of the directories holding changed sources """
+        configuration = self.configuration
+
+        directories = set()
+        for source_path in source_paths:
+            if corpus == 'win32' and source_path.startswith("win32-docs/desktop-src/"):
+                directory = os.path.dirname(source_path[len("win32-docs/desktop-src/"):])
+                if directory:
+                    directories.add(directory)
+            elif corpus == 'sdk-api' and source_path.startswith("sdk-api-docs/sdk-api-src/content/"):
+                directories.add(os.path.dirname(source_path[len("sdk-api-docs/sdk-api-src/content/"):]))
+
+        for directory in sorted(directories):
+            toc = fetch_textfile(_toc_url(configuration, corpus, directory))
+            if toc is not None:
+                self.build_state.set_toc(corpus, directory, json.loads(toc))
+                self.titles.pop((corpus, directory), None)
+                self._refresh_titles(corpus, directory)
+
+    def _refresh_titles(self, corpus: str, directory: str):
+        """ name the index entries of a directory after its TOC again, as the crawl does """
+        cursor = self.dsidx.cursor()
+        for entry_path in self.build_state.entry_paths(_toc_entry_prefix(corpus, directory)):
+            toc_href = _entry_toc_href(entry_path)
+            if toc_href is None or toc_href[:2] != (corpus, directory):
+                continue
+
+            href = toc_href[2]
+            if href is None:
+                title = self.build_state.get_toc(corpus, directory)['items'][0].get('toc_title')
+            elif corpus == 'win32':
+                title = self._title(corpus, directory, href) or href
+            else:
+                title = self._title(corpus, directory, href)
+
+            self.build_state.rename_entries(entry_path, title)
+            cursor.execute('UPDATE OR IGNORE searchIndex SET name = ? WHERE path = ?', (title, entry_path))
+
+    def publish(self):
+        """ package the docset again, with a delta against the previous publication """
+        configuration = self.configuration
+        output_dir = os.path.dirname(configuration.output_filepath)
+        os.makedirs(output_dir, exist_ok=True)
+
+        if configuration.output_format == "tarix":
+            make_tarix_docset(self.docset_dir, output_dir, jobs=configuration.compression_jobs)
+        else:
+            make_docset(
+                self.docset_dir,
+                configuration.output_filepath,
+                compression=configuration.compression,
+                jobs=configuration.compression_jobs
+            )
+
+        manifest = build_docset_manifest(self.docset_dir)
+        output_basename, ext = os.path.splitext(configuration.output_filepath)
+        make_docset_delta(
+            self.manifest,
+            manifest,
+            self.docset_dir,
+            "%s.delta.tgz" % output_basename,
+            jobs=configuration.compression_jobs
+        )
+        with open("%s.manifest.json" % output_basename, "w") as manifest_fd:
+            json.dump(manifest, manifest_fd)
+
+        self.manifest = manifest
+        logger.info("[watch] published %s" % configuration.output_filepath)
+
+    def run(self, interval: int, trigger_filepath: str = None, once: bool = False):
+        """ poll, rebuild and publish every interval seconds, or as soon as the trigger file is touched """
+        trigger_mtime = None
+        if trigger_filepath and os.path.exists(trigger_filepath):
+            trigger_mtime = os.path.getmtime(trigger_filepath)
+
+        while True:
+            changes = self.poll_sources()
+            if changes and self.rebuild(changes):
+                self.publish()
+
+            if once:
+                break
+
+            deadline = time.time() + interval
+            while time.time() < deadline:
+                time.sleep(1)
+                if trigger_filepath and os.path.exists(trigger_filepath):
+                    mtime = os.path.getmtime(trigger_filepath)
+                    if mtime != trigger_mtime:
+                        trigger_mtime = mtime
+                        logger.info("[watch] triggered by %s" % trigger_filepath)
+                        break
+
+    def close(self):
+        for pages in self.stores:
+            pages.close()
+        self.build_state.close()
+        self.rewrite_cache.close(prune=False)
+        self.dsidx.close()
+
+
+def _parse_shard(value: str):
+    """ argparse type for "i/N" shard specifications """
+    try:
+        shard_index, shard_count = (int(v) for v in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard must be formatted as i/N, got %r" % value)
+
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise argparse.ArgumentTypeError("shard index must be in [0, N), got %r" % value)
+
+    return shard_index, shard_count
+
+
+def _parse_locales(value: str):
+    """ argparse type for comma separated locales, e.g. "en-us,de-de,ja-jp" """
+    locales = []
+    for locale in value.split(","):
+        locale = locale.strip().lower()
+        if not Configuration.locale_pattern.match("/%s/" % locale):
+            raise argparse.ArgumentTypeError("locales must be formatted as ll-cc, got %r" % locale)
+        if locale not in locales:
+            locales.append(locale)
+
+    return locales
+
+
+def write_http_report(configuration: Configuration):
+    """ request accounting of the build, to spot duplicated and wasted fetches """
+    report_filepath = os.path.join(configuration.build_folder, "http_requests.json")
+    report = transport.report(report_filepath)
+    logger.info(
+        "%d requests (%.1f MB) to %d urls : %d repeated, %d deduplicated in flight, %d failed, see %s" % (
+        report['requests'], report['bytes'] / 1e6, report['urls'], report['repeated_requests'],
+        report['deduplicated'], report['failed_requests'], report_filepath)
+    )
+
+
+def download_locale_pages(configuration: Configuration, pages_filepath: str, locale: str, locale_dir: str):
+    """ copy of the crawled pages with every html page downloaded again in another locale """
+    locale_pages_filepath = copy_page_store(pages_filepath, locale_dir)
+    pages = PageStore(locale_pages_filepath)
+
+    html_sources = pages.sources(extensions=(".html",))
+    localized = 0
+    for page_path, url in html_sources:
+        if download_page(configuration.localize_url(url, locale), pages, page_path):
+            localized += 1
+        else:
+            # keep the page of the crawled locale rather than a hole in the docset
+            logger.info("[1] no %s version of %s" % (locale, url))
+
+    pages.close()
+    logger.info("[1] %d/%d %s pages downloaded" % (localized, len(html_sources), locale))
+    return locale_pages_filepath
+
+
+def localize_build_state(configuration: Configuration, build_state: BuildStateStore, locale: str, locale_dir: str):
+    """ copy of the build state with the TOCs of another locale, index entries being named after their titles """
+    build_state.commit()
+    locale_build_state_filepath = os.path.join(locale_dir, "build_state.sqlite")
+    shutil.copyfile(build_state.filepath, locale_build_state_filepath)
+    locale_build_state = BuildStateStore(locale_build_state_filepath)
+
+    # the TOCs are read from the crawled state while the copy is updated, a directory at a time
+    directories = 0
+    renamed = 0
+    for corpus, directory, toc in build_state.iter_tocs():
+        # placeholder of a directory without TOC
+        if not toc['items'][0]:
+            continue
+
+        toc_url = configuration.localize_url(_toc_url(configuration, corpus, directory), locale)
+        locale_toc = fetch_textfile(toc_url)
+        if locale_toc is None:
+            # keep the names of the crawled locale rather than no entry
+            logger.info("[1] no %s TOC %s" % (locale, toc_url))
+            continue
+
+        toc = json.loads(locale_toc)
+        locale_build_state.set_toc(corpus, directory, toc)
+        titles = _toc_titles(toc)
+        titles[None] = toc['items'][0].get('toc_title')
+        directories += 1
+
+        for entry_path in locale_build_state.entry_paths(_toc_entry_prefix(corpus, directory)):
+            toc_href = _entry_toc_href(entry_path)
+            if toc_href is None or toc_href[:2] != (corpus, directory):
+                continue
+
+            title = titles.get(toc_href[2])
+            if title:
+                locale_build_state.rename_entries(entry_path, title)
+                renamed += 1
+
+    locale_build_state.commit()
+    logger.info("[1] %d index entries named from %d %s TOCs" % (renamed, directories, locale))
+    return locale_build_state
+
+
+def build_docset(
+        configuration: Configuration,
+        build_state: BuildStateStore,
+        pages_filepath: str,
+        build_folder: str,
+        output_filepath: str,
+        previous_manifest_filepath: str = None
+):
+    """
+    Rewrite, index and package the crawled pages into a docset, the stages 2 to 5 of a build.
+
+    Theme resources are cached across builds and locales in the main build folder.
+    """
+    html_rewrite_dir = os.path.join(build_folder, "_2_html_rewrite")
+    additional_resources_dir = os.path.join(build_folder, "_3_additional_resources")
+    package_dir = os.path.join(build_folder, "_4_ready_to_be_packaged")
+
+    for folder in [html_rewrite_dir, additional_resources_dir, package_dir]:
+        os.makedirs(folder, exist_ok=True)
+
+    # _4_ready_to_be_packaged is the final build dir
+    docset_dir = os.path.join(package_dir, "%s.docset" % Configuration.docset_name)
+    content_dir = os.path.join(docset_dir, "Contents")
+    resources_dir = os.path.join(content_dir, "Resources")
+    document_dir = os.path.join(resources_dir, "Documents")
+
+    """ 2.  Parse and rewrite html contents """
+    logger.info("[2] rewriting urls and hrefs")
+    pages_filepath = copy_page_store(pages_filepath, html_rewrite_dir)
+    pages = PageStore(pages_filepath)
+    dead_links = DeadLinkReport()
+
+    fulltext = None
+    if configuration.fulltext:
+        fulltext_filepath = os.path.join(html_rewrite_dir, "fulltext.sqlite")
+        if os.path.exists(fulltext_filepath):
+            os.remove(fulltext_filepath)
+        fulltext = FullTextIndex(fulltext_filepath)
+
+    rewrite_profile = RewriteProfile() if configuration.profile_rewrite else None
+
+    rewrite_cache = RewriteCache(
+        os.path.join(configuration.build_folder, "rewrite_cache.sqlite"), configuration, build_folder
+    )
+    resources_to_dl = rewrite_html_contents(
+        configuration, pages, document_dir, dead_links, fulltext, rewrite_cache, rewrite_profile
+    )
+    rewrite_cache.close()
+    pages.close()
+
+    if rewrite_profile is not None:
+        rewrite_profile.write(os.path.join(build_folder, "rewrite_profile.json"))
+
+    dead_links_filepath = os.path.join(build_folder, "dead_links.json")
+    dead_links.write(dead_links_filepath)
+    logger.info(
+        "[2] %d dead links to %d missing documents, see %s" % (
+        len(dead_links), len(dead_links.targets), dead_links_filepath)
+    )
+
+    """ 3.  Download additionnal resources """
+    logger.info("[3] download style contents")
+    pages_filepath = copy_page_store(pages_filepath, additional_resources_dir)
+    pages = PageStore(pages_filepath)
+    theme_cache = ThemeResourceCache(os.path.join(configuration.build_folder, "theme_cache.sqlite"))
+    download_additional_resources(configuration, pages, resources_to_dl, theme_cache)
+    theme_cache.close()
+
+    if configuration.optimize_images:
+        optimize_images(
+            configuration,
+            pages,
+            os.path.join(configuration.build_folder, "image_cache.sqlite"),
+            os.path.join(build_folder, "image_optimization.json")
+        )
+
+    """ 4.  Database indexing """
+    logger.info("[4] indexing to database")
+    shutil.rmtree(document_dir, ignore_errors=True)
+    exported = pages.export(document_dir)
+    files, blobs, saved = pages.dedup_stats()
+    pages.close()
+    logger.info(
+        "[4] exported %d documents, %d distinct : deduplication saved %.1f MB" % (exported, blobs, saved / 1e6)
+    )
+    create_sqlite_database(configuration, build_state, resources_dir, document_dir, fulltext)
+    if fulltext is not None:
+        fulltext.close()
+
+    """ 5.  Archive packaging """
+    src_dir = os.path.dirname(__file__)
+    shutil.copy(os.path.join(src_dir, "static/Info.plist"), content_dir)
+    shutil.copy(os.path.join(src_dir, "static/DASH_LICENSE"), os.path.join(resources_dir, "LICENSE"))
+    shutil.copy(os.path.join(src_dir, "static/icon.png"), docset_dir)
+    shutil.copy(os.path.join(src_dir, "static/icon@2x.png"), docset_dir)
+
+    output_dir = os.path.dirname(output_filepath)
+    os.makedirs(output_dir, exist_ok=True)
+
+    if configuration.output_format == "tarix":
+        logger.info("[5] packaging as a tarix compressed dash docset in %s" % output_dir)
+        make_tarix_docset(docset_dir, output_dir, jobs=configuration.compression_jobs)
+    else:
+        logger.info("[5] packaging as a dash docset")
+        make_docset(
+            docset_dir,
+            output_filepath,
+            compression=configuration.compression,
+            jobs=configuration.compression_jobs
+        )
+
+    # build manifest, and delta since the previous build
+    manifest = build_docset_manifest(docset_dir)
+    output_basename, ext = os.path.splitext(output_filepath)
+    with open("%s.manifest.json" % output_basename, "w") as manifest_fd:
+        json.dump(manifest, manifest_fd)
+
+    if previous_manifest_filepath:
+        with open(previous_manifest_filepath, "r") as manifest_fd:
+            previous_manifest = json.load(manifest_fd)
+
+        make_docset_delta(
+            previous_manifest,
+            manifest,
+            docset_dir,
+            "%s.delta.tgz" % output_basename,
+            jobs=configuration.compression_jobs
+        )
+
+
+def main(configuration: Configuration):
+    # """ Scheme for content toc :
     # {
     #     module_name : {
     #         'name' : str,
@@ -909,35 +3473,25 @@ def main(configuration: Configuration):
     #     ...
     # }
     # """
-    content_toc = {}
-    resources_to_dl = set()
-
     """ 0. Prepare folders """
     source_dir = os.path.join(configuration.build_folder, "_0_win32_source")
     api_source_dir = os.path.join(configuration.build_folder, "_0_api_sdk_source")
-
     download_dir = os.path.join(configuration.build_folder, "_1_downloaded_contents")
-    html_rewrite_dir = os.path.join(configuration.build_folder, "_2_html_rewrite")
-    additional_resources_dir = os.path.join(configuration.build_folder, "_3_additional_resources")
-    package_dir = os.path.join(configuration.build_folder, "_4_ready_to_be_packaged")
 
-    for folder in [source_dir, api_source_dir, download_dir, html_rewrite_dir, additional_resources_dir, package_dir]:
+    for folder in [source_dir, api_source_dir, download_dir]:
         os.makedirs(folder, exist_ok=True)
 
-    # _4_ready_to_be_packaged is the final build dir
-    docset_dir = os.path.join(package_dir, "%s.docset" % Configuration.docset_name)
-    content_dir = os.path.join(docset_dir, "Contents")
-    resources_dir = os.path.join(content_dir, "Resources")
-    document_dir = os.path.join(resources_dir, "Documents")
+    build_state_filepath = os.path.join(download_dir, "build_state.sqlite")
+    pages_filepath = os.path.join(download_dir, "pages.sqlite")
 
-    if conf.crawl_contents:
+    if configuration.crawl_contents:
         # cloning source directories for scraping contents, extremely long operation
         logger.info(
             "Downloading win32 markdown zipped sources : %s -> %s" % (
-            "https://github.com/MicrosoftDocs/win32/archive/refs/heads/docs.zip", os.path.join(source_dir, "docs.zip"))
+            configuration.win32_source_url, os.path.join(source_dir, "docs.zip"))
         )
         download_binary(
-            "https://github.com/MicrosoftDocs/win32/archive/refs/heads/docs.zip",
+            configuration.win32_source_url,
             os.path.join(source_dir, "docs.zip")
         )
 
@@ -947,10 +3501,10 @@ def main(configuration: Configuration):
 
         logger.info(
             "Downloading sdk-api markdown zipped sources : %s -> %s" % (
-            "https://github.com/MicrosoftDocs/win32/archive/refs/heads/docs.zip", os.path.join(source_dir, "docs.zip"))
+            configuration.sdk_api_source_url, os.path.join(api_source_dir, "docs.zip"))
         )
         download_binary(
-            "https://github.com/MicrosoftDocs/sdk-api/archive/refs/heads/docs.zip",
+            configuration.sdk_api_source_url,
             os.path.join(api_source_dir, "docs.zip")
         )
 
@@ -959,70 +3513,200 @@ def main(configuration: Configuration):
             zip_ref.extractall(api_source_dir)
 
         """ 1. Download html pages """
-        logger.info("[1] scraping win32 web contents")
-        content_toc = {}
-        content_toc = crawl_msdn_contents(configuration, download_dir, source_dir)
+        for filepath in [build_state_filepath, pages_filepath]:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+        build_state = BuildStateStore(build_state_filepath)
+        pages = PageStore(pages_filepath)
+
+        # partial docsets of the pages crawled so far, in their own build and output folders
+        snapshot = None
+        if configuration.snapshot_interval and configuration.shard[1] == 1:
+            output_dir, output_filename = os.path.split(configuration.output_filepath)
+
+            def snapshot():
+                start = time.perf_counter()
+                build_docset(
+                    configuration,
+                    build_state,
+                    pages_filepath,
+                    os.path.join(configuration.build_folder, "_snapshot"),
+                    os.path.join(output_dir, "snapshot", output_filename)
+                )
+                logger.info("[1] snapshot docset built in %.1f s" % (time.perf_counter() - start))
+
+        logger.info("[1] scraping sdk-api and win32 web contents")
+        crawl_contents(configuration, pages, source_dir, api_source_dir, build_state, snapshot)
+        pages.close()
+
+        # a crawl shard stops here, the remaining stages are run by the "merge" command
+        shard_index, shard_count = configuration.shard
+        if shard_count > 1:
+            build_state.close()
+            write_http_report(configuration)
+            logger.info("[1] shard %d/%d crawled into %s" % (shard_index, shard_count, configuration.build_folder))
+            return
+    else:
+        build_state = BuildStateStore(build_state_filepath)
+
+    # every locale shares the crawled layout, images and stylesheets, index entries are named after its own TOCs
+    for locale in configuration.locales:
+        if locale == configuration.locale:
+            locale_build_folder = configuration.build_folder
+            locale_pages_filepath = pages_filepath
+            locale_build_state = build_state
+        else:
+            locale_build_folder = os.path.join(configuration.build_folder, "_locales", locale)
+            locale_download_dir = os.path.join(locale_build_folder, "_1_downloaded_contents")
+            os.makedirs(locale_download_dir, exist_ok=True)
+
+            logger.info("[1] downloading %s html pages" % locale)
+            locale_pages_filepath = download_locale_pages(configuration, pages_filepath, locale, locale_download_dir)
+            locale_build_state = localize_build_state(configuration, build_state, locale, locale_download_dir)
+
+        # each locale diffs against the manifest of the same name in its own output subfolder
+        previous_manifest = configuration.locale_filepath(configuration.previous_manifest, locale)
+        if previous_manifest != configuration.previous_manifest:
+            logger.info("[5] %s delta against the previous manifest %s" % (locale, previous_manifest))
+
+        build_docset(
+            configuration,
+            locale_build_state,
+            locale_pages_filepath,
+            locale_build_folder,
+            configuration.locale_filepath(configuration.output_filepath, locale),
+            previous_manifest
+        )
+        if locale_build_state is not build_state:
+            locale_build_state.close()
 
-        logger.info("[1] scraping sdk-api web contents")
-        api_content_toc = crawl_sdk_api_contents(configuration, download_dir, api_source_dir)
+    build_state.close()
+    write_http_report(configuration)
 
-        # Merge win32 api content
-        content_toc.update(api_content_toc)
-        with open(os.path.join(download_dir, "toc.json"), "w") as content:
-            json.dump(content_toc, content)
-    else:
-        # print(os.path.join(download_dir, "toc.json"))
-        with open(os.path.join(download_dir, "toc.json"), "r") as content:
-            content_toc = json.load(content)
+if __name__ == '__main__':
 
-    """ 2.  Parse and rewrite html contents """
-    logger.info("[2] rewriting urls and hrefs")
-    copy_folder(download_dir, html_rewrite_dir)
-    resources_to_dl = rewrite_html_contents(configuration, html_rewrite_dir)
+    parser = argparse.ArgumentParser(
+        description="Dash docset creation script for MSDN's Win32 API"
+    )
 
-    """ 3.  Download additionnal resources """
-    logger.info("[3] download style contents")
-    copy_folder(html_rewrite_dir, additional_resources_dir)
-    download_additional_resources(configuration, additional_resources_dir, resources_to_dl)
+    parser.add_argument(
+        "-vv", "--verbose",
+        help="increase output verbosity",
+        action="store_true"
+    )
 
-    """ 4.  Database indexing """
-    logger.info("[4] indexing to database")
-    copy_folder(additional_resources_dir, document_dir)
-    create_sqlite_database(configuration, content_toc, resources_dir, document_dir)
+    subparsers = parser.add_subparsers(help='sub-command help', dest='command')
 
-    """ 5.  Archive packaging """
-    src_dir = os.path.dirname(__file__)
-    shutil.copy(os.path.join(src_dir, "static/Info.plist"), content_dir)
-    shutil.copy(os.path.join(src_dir, "static/DASH_LICENSE"), os.path.join(resources_dir, "LICENSE"))
-    shutil.copy(os.path.join(src_dir, "static/icon.png"), docset_dir)
-    shutil.copy(os.path.join(src_dir, "static/icon@2x.png"), docset_dir)
+    # options shared by the commands building a docset
+    parser_output = argparse.ArgumentParser(add_help=False)
 
-    output_dir = os.path.dirname(configuration.output_filepath)
-    os.makedirs(output_dir, exist_ok=True)
+    parser_output.add_argument(
+        "-o", "--output",
+        help="set output filepath",
+        default=os.path.join(os.getcwd(), "MSDN.tgz"),
+    )
 
-    logger.info("[5] packaging as a dash docset")
-    make_docset(
-        docset_dir,
-        configuration.output_filepath,
-        Configuration.docset_name
+    parser_output.add_argument(
+        "--build-dir",
+        help="set the build folder, default to _build_msdn in current dir",
+        default=None,
     )
 
+    parser_output.add_argument(
+        "--connections",
+        help="number of pooled keep-alive http connections, sized to the concurrent requests (default 8)",
+        type=int,
+        default=None,
+    )
 
-if __name__ == '__main__':
+    parser_output.add_argument(
+        "--base-url",
+        help="docs host to crawl and download theme resources from, default to https://docs.microsoft.com",
+        default=None,
+    )
 
-    parser = argparse.ArgumentParser(
-        description="Dash docset creation script for MSDN's Win32 API"
+    parser_output.add_argument(
+        "--format",
+        help="output a tar.gz archive, or an installable docset folder kept compressed with a tarix index",
+        choices=["tgz", "tarix"],
+        default="tgz",
     )
 
-    parser.add_argument(
-        "-vv", "--verbose",
-        help="increase output verbosity",
+    parser_output.add_argument(
+        "--compression",
+        help="tgz archive compression : gzip readable by any tar, or zstd (requires the zstandard package)",
+        choices=["gzip", "zstd"],
+        default="gzip",
+    )
+
+    parser_output.add_argument(
+        "-j", "--jobs",
+        help="compression threads and image optimization processes count, default to the number of cpus",
+        type=int,
+        default=None,
+    )
+
+    parser_output.add_argument(
+        "--dead-links",
+        help="rewrite links to missing documents to their online url, or drop them",
+        choices=["online", "drop"],
+        default="online",
+    )
+
+    # options of the commands downloading the markdown sources
+    parser_sources = argparse.ArgumentParser(add_help=False)
+
+    parser_sources.add_argument(
+        "--sources-url",
+        help="host of the markdown source archives, default to https://github.com",
+        default=None,
+    )
+
+    # options of the full builds
+    parser_build = argparse.ArgumentParser(add_help=False)
+
+    parser_build.add_argument(
+        "--optimize-images",
+        help="losslessly recompress png images, and jpeg images when jpegtran is installed",
+        default=False,
         action="store_true"
     )
 
-    subparsers = parser.add_subparsers(help='sub-command help', dest='command')
+    parser_build.add_argument(
+        "--locales",
+        help="build one docset per locale (e.g. en-us,de-de,ja-jp) in per-locale output subfolders, "
+             "crawling the contents once in the first locale. --previous-manifest is read from the same "
+             "per-locale subfolders",
+        type=_parse_locales,
+        default=None,
+    )
+
+    parser_build.add_argument(
+        "--fulltext",
+        help="add a full text index of the page bodies to docSet.dsidx, see the 'search' command",
+        default=False,
+        action="store_true"
+    )
+
+    parser_build.add_argument(
+        "--previous-manifest",
+        help="manifest.json of a previous build, to also create a delta update package against it",
+        default=None,
+    )
+
+    parser_build.add_argument(
+        "--profile-rewrite",
+        help="count and time every rewrite rule, summarized in the log and _build_msdn/rewrite_profile.json",
+        default=False,
+        action="store_true"
+    )
+
+    parser_create = subparsers.add_parser(
+        'create_docset',
+        help='scrap the internet in order to create a docset',
+        parents=[parser_output, parser_sources, parser_build],
+    )
 
-    parser_create = subparsers.add_parser('create_docset', help='scrap the internet in order to create a docset')
     parser_create.add_argument(
         "-t", "--temporary",
         help="Use a temporary directory for creating docset, otherwise use current dir.",
@@ -1031,18 +3715,145 @@ if __name__ == '__main__':
     )
 
     parser_create.add_argument(
-        "-o", "--output",
-        help="set output filepath",
-        default=os.path.join(os.getcwd(), "MSDN.tgz"),
+        "-s", "--sampling",
+        help="generate only a 'sample' docset, in order to test if the rewriting rules are corrects",
+        default=False,
+        action="store_true"
     )
 
     parser_create.add_argument(
-        "-s", "--sampling",
-        help="generate only a 'sample' docset, in order to test if the rewriting rules are corrects",
+        "--snapshot-interval",
+        help="while crawling, build a partial docset of the pages crawled so far in a 'snapshot' output subfolder "
+             "every MINUTES, and whenever a crawl priority is done",
+        type=float,
+        metavar="MINUTES",
+        default=None,
+    )
+
+    parser_create.add_argument(
+        "--shard",
+        help="crawl only the i-th of N shards (e.g. 0/4) into its own build folder, see the 'merge' command",
+        type=_parse_shard,
+        default=None,
+    )
+
+    parser_merge = subparsers.add_parser(
+        'merge',
+        help='merge crawl shards and create the docset',
+        parents=[parser_output, parser_build],
+    )
+
+    parser_merge.add_argument(
+        "shards",
+        help="shard build folders, default to every _build_msdn/_shard_* folder",
+        nargs="*",
+    )
+
+    parser_watch = subparsers.add_parser(
+        'watch',
+        help='keep the docset up to date with incremental rebuilds',
+        parents=[parser_output, parser_sources],
+    )
+
+    parser_watch.add_argument(
+        "--interval",
+        help="seconds between two polls of the upstream sources",
+        type=int,
+        default=3600,
+    )
+
+    parser_watch.add_argument(
+        "--trigger-file",
+        help="poll the upstream sources as soon as this file is touched",
+        default=None,
+    )
+
+    parser_watch.add_argument(
+        "--once",
+        help="poll and rebuild only once, e.g. from a scheduled task",
         default=False,
         action="store_true"
     )
 
+    parser_search = subparsers.add_parser('search', help='full text search in the page bodies of a docSet.dsidx')
+
+    parser_search.add_argument(
+        "dsidx",
+        help="docSet.dsidx filepath, built with --fulltext"
+    )
+
+    parser_search.add_argument(
+        "query",
+        help="fts5 query, e.g. ERROR_ACCESS_DENIED or \"access denied\" NOT token"
+    )
+
+    parser_search.add_argument(
+        "-n", "--limit",
+        help="maximum number of hits",
+        type=int,
+        default=20,
+    )
+
+    parser_benchmark = subparsers.add_parser('benchmark', help='measure search latencies of a docSet.dsidx')
+
+    parser_benchmark.add_argument(
+        "dsidx",
+        help="docSet.dsidx filepath"
+    )
+
+    parser_benchmark.add_argument(
+        "-n", "--queries",
+        help="number of searches per query kind",
+        type=int,
+        default=1000,
+    )
+
+    parser_benchmark.add_argument(
+        "--tune",
+        help="add the search indexes, statistics and compaction of current builds before measuring",
+        default=False,
+        action="store_true"
+    )
+
+    parser_verify = subparsers.add_parser('verify', help='check index rows, relative links and assets of a built docset')
+
+    parser_verify.add_argument(
+        "docset",
+        help="docset folder, e.g. _build_msdn/_4_ready_to_be_packaged/MSDN.docset"
+    )
+
+    parser_verify.add_argument(
+        "--max-broken",
+        help="number of broken index rows, links and assets tolerated before failing (default 0)",
+        type=int,
+        default=0,
+    )
+
+    parser_verify.add_argument(
+        "--report",
+        help="write every broken reference to this json file",
+        default=None,
+    )
+
+    parser_verify.add_argument(
+        "-j", "--jobs",
+        help="number of verification processes, default to the number of cpus",
+        type=int,
+        default=None,
+    )
+
+    parser_apply_delta = subparsers.add_parser('apply_delta', help='patch an installed docset with a delta package')
+
+    parser_apply_delta.add_argument(
+        "delta",
+        help="delta package filepath"
+    )
+
+    parser_apply_delta.add_argument(
+        "docset",
+        help="installed docset folder, e.g. <docsets>/MSDN.docset"
+    )
+
     parser_rewrite = subparsers.add_parser('rewrite_html', help='rewrite html file in order to test rules')
 
     parser_rewrite.add_argument(
@@ -1060,6 +3871,20 @@ if __name__ == '__main__':
         help="set html_root_dir filepath"
     )
 
+    parser_rewrite.add_argument(
+        "--profile-rewrite",
+        help="count and time every rewrite rule, summary printed once the page is rewritten",
+        default=False,
+        action="store_true"
+    )
+
+    parser_rewrite.add_argument(
+        "--dead-links",
+        help="rewrite links to missing documents to their online url, or drop them",
+        choices=["online", "drop"],
+        default="online",
+    )
+
     args = parser.parse_args()
     #if args.verbose:
         # logger.basicConfig(level=logger.DEBUG)
@@ -1076,10 +3901,19 @@ if __name__ == '__main__':
         with open(args.input, 'r', encoding='utf8') as i_fd:
             html_content = i_fd.read()
 
-        soup = bs(html_content, 'html.parser')
+        soup = bs(html_content, Configuration.rewrite_parser)
 
         # rewrite html
-        soup, resources = rewrite_soup(conf, soup, args.input, args.html_root_dir)
+        dead_links = DeadLinkReport()
+        link_index = LinkTargetIndex.from_directory(args.html_root_dir)
+        profile = RewriteProfile() if conf.profile_rewrite else None
+        soup, resources = rewrite_soup(conf, soup, args.input, args.html_root_dir, link_index, dead_links, profile)
+
+        if profile is not None:
+            print("\n".join(profile.summary()))
+
+        for target, count in dead_links.targets.most_common():
+            logger.warning("[!] dead link (x%d) : %s" % (count, target))
 
         # Export fixed html
         fixed_html = soup.prettify("utf-8")
@@ -1089,6 +3923,13 @@ if __name__ == '__main__':
     elif args.command == "create_docset":
         conf = Configuration(args)
 
+        shard_index, shard_count = conf.shard
+        if shard_count > 1 and not args.build_dir:
+            conf.build_folder = os.path.join(conf.build_folder, "_shard_%d_of_%d" % (shard_index, shard_count))
+
+        if args.temporary and shard_count > 1:
+            parser.error("a crawl shard can not be built in a temporary directory")
+
         if args.temporary:
 
             with tempfile.TemporaryDirectory() as tmp_builddir:
@@ -1097,5 +3938,71 @@ if __name__ == '__main__':
         else:
             main(conf)
 
+    elif args.command == "watch":
+        conf = Configuration(args)
+
+        watcher = DocsetWatcher(conf)
+        try:
+            watcher.run(args.interval, trigger_filepath=args.trigger_file, once=args.once)
+        finally:
+            watcher.close()
+
+    elif args.command == "search":
+        start = time.perf_counter()
+        hits = search_fulltext(args.dsidx, args.query, limit=args.limit)
+        elapsed = (time.perf_counter() - start) * 1000
+
+        for path, title, snippet in hits:
+            print("%s\n  %s\n  %s" % (title, path, snippet))
+        print("%d hits in %.1f ms" % (len(hits), elapsed))
+
+    elif args.command == "benchmark":
+        if args.tune:
+            db = sqlite3.connect(args.dsidx)
+            tune_sqlite_database(db)
+            db.close()
+
+        rows, results = benchmark_sqlite_database(args.dsidx, queries=args.queries)
+
+        print("%s : %d rows, %d searches per kind" % (args.dsidx, rows, args.queries))
+        for kind, result in results.items():
+            print(
+                "  %-9s p50 %7.3f ms   p99 %7.3f ms   max %7.3f ms   %s" % (
+                kind, result['p50_ms'], result['p99_ms'], result['max_ms'], result['plan'])
+            )
+
+    elif args.command == "verify":
+        report = verify_docset(args.docset, jobs=args.jobs)
+
+        print(
+            "%s : %d index rows, %d documents, %d references checked in %.1f s" % (
+            args.docset, report['index_rows'], report['documents'], report['references'], report['elapsed_s'])
+        )
+        for kind in ('index', 'link', 'asset'):
+            items = report['broken_%s' % kind]
+            print("  broken %-5s : %d" % (kind, len(items)))
+            for item in items[:10]:
+                print("    %s -> %s" % (item['document'], item['reference']))
+
+        if args.report:
+            with open(args.report, "w") as report_fd:
+                json.dump(report, report_fd, indent=2)
+
+        if report['broken'] > args.max_broken:
+            print("%d broken references, more than the %d tolerated" % (report['broken'], args.max_broken))
+            sys.exit(1)
+
+    elif args.command == "apply_delta":
+        apply_docset_delta(args.delta, args.docset)
+
+    elif args.command == "merge":
+        conf = Configuration(args)
+
+        shards = args.shards or sorted(glob.glob(os.path.join(conf.build_folder, "_shard_*")))
+        if not shards:
+            parser.error("no crawl shards to merge")
+
+        merge_shards(conf, shards)
+
     else:
         raise NotImplementedError("command not implemented %s" % args.command)
@@ -0,0 +1,979 @@
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import glob
+import hashlib
+import http.server
+import importlib.util
+import io
+import json
+import os
+import shutil
+import sqlite3
+import struct
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+import zlib
+
+import pytest
+
+# bs4 deprecates the findAll spelling the script uses
+pytestmark = pytest.mark.filterwarnings("ignore::DeprecationWarning")
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "msdn-to-docset.py")
+
+PNG = bytes.fromhex(
+    '89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c4890000000d49444154789c63600000020000050001'
+    '57a8e7a30000000049454e44ae426082'
+)
+
+
+@pytest.fixture(scope="session")
+def msdn(tmp_path_factory):
+    """ the script as a module, its example.log being written in a temporary folder """
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("log"))
+    try:
+        spec = importlib.util.spec_from_file_location("msdn_to_docset", SCRIPT)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        os.chdir(cwd)
+
+    return module
+
+
+def _write(root, path, data):
+    filepath = os.path.join(root, *path.strip('/').split('/'))
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with open(filepath, "wb") as o_fd:
+        o_fd.write(data if isinstance(data, bytes) else data.encode('utf-8'))
+
+
+def _page(title, body):
+    return (
+        '<html><head><title>%s</title>'
+        '<link rel="stylesheet" href="/_themes/docs.theme/master/en-us/_themes/styles/site.css">'
+        '<script>x()</script></head>'
+        '<body><div class="sidebar" role="navigation">nav</div><main><h1>%s</h1>%s</main></body></html>'
+    ) % (title, title, body)
+
+
+WIN32_PAGES = {'.': ['desktop-app-technologies'], 'gdi': ['gdi-start', 'drawing'], 'ADSchema': ['c-user', 'a-cn']}
+
+
+def _build_site(root, win32=WIN32_PAGES, titles=None):
+    """ docs pages, TOCs, theme and source archives of a tiny win32 and sdk-api corpus """
+    sources = {}
+    titles = titles or {}
+
+    for folder, pages in win32.items():
+        for page in pages:
+            relpath = page if folder == '.' else "%s/%s" % (folder, page)
+            sources["win32-docs/desktop-src/%s.md" % relpath] = "# %s" % page
+            _write(root, "en-us/windows/win32/%s" % relpath, _page(page.title(), (
+                '<p>See <a href="/en-us/windows/desktop/api/fileapi/nf-fileapi-createfilew" '
+                'data-linktype="absolute-path">CreateFileW</a> and <a href="/en-us/windows/desktop/gdi/missing-page" '
+                'data-linktype="absolute-path">a missing page</a> <img src="diagram.png"></p>'
+            )))
+
+        if folder != '.':
+            sources["win32-docs/desktop-src/%s/diagram.png" % folder] = PNG
+            _write(root, "en-us/windows/win32/%s/toc.json" % folder, json.dumps({'items': [{
+                'toc_title': folder.title(),
+                'href': pages[0],
+                'children': [
+                    {'toc_title': titles.get(page, "%s title" % page.title()), 'href': page} for page in pages
+                ],
+            }]}))
+
+    api = {'fileapi': ['nf-fileapi-createfilew', 'ns-fileapi-file_info'], 'winuser': ['nf-winuser-messageboxw']}
+    for directory, pages in api.items():
+        sources["sdk-api-docs/sdk-api-src/content/%s/index.md" % directory] = "# %s" % directory
+        _write(root, "en-us/windows/win32/api/%s/index.html" % directory, _page(directory, "<p>header</p>"))
+        _write(root, "en-us/windows/win32/api/%s/toc.json" % directory, json.dumps({'items': [{
+            'toc_title': "%s.h" % directory,
+            'children': [
+                {'toc_title': page.split('-')[-1].upper(), 'href': "/windows/win32/api/%s/%s" % (directory, page)}
+                for page in pages
+            ],
+        }]}))
+
+        for page in pages:
+            sources["sdk-api-docs/sdk-api-src/content/%s/%s.md" % (directory, page)] = "# %s" % page
+            _write(root, "en-us/windows/win32/api/%s/%s" % (directory, page), _page(page, (
+                '<p>See <a href="/en-us/windows/win32/api/winuser/nf-winuser-messageboxw" '
+                'data-linktype="absolute-path">MessageBox</a></p>'
+            )))
+
+    theme = "_themes/docs.theme/master/en-us/_themes"
+    _write(root, "%s/styles/site.css" % theme, 'body{background:url("../images/bg.png")}')
+    _write(root, "%s/images/bg.png" % theme, PNG)
+
+    for repo, prefix in (('win32', "win32-docs/"), ('sdk-api', "sdk-api-docs/")):
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zip_fd:
+            for path, data in sources.items():
+                if path.startswith(prefix):
+                    zip_fd.writestr(path, data)
+        _write(root, "MicrosoftDocs/%s/archive/refs/heads/docs.zip" % repo, archive.getvalue())
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _SlowCountingHandler(_QuietHandler):
+    """ answers after a delay, counting the requests of every path """
+
+    requests = collections.Counter()
+
+    def do_GET(self):
+        _SlowCountingHandler.requests[self.path] += 1
+        time.sleep(0.5)
+        super().do_GET()
+
+
+@contextlib.contextmanager
+def _serve(root, handler=_QuietHandler):
+    """ local stand-in for docs.microsoft.com and the github source archives serving root, as a base url """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(handler, directory=root))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield "http://127.0.0.1:%d" % server.server_port
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(scope="module")
+def docs_site(tmp_path_factory):
+    root = str(tmp_path_factory.mktemp("site"))
+    _build_site(root)
+    with _serve(root) as base_url:
+        yield base_url
+
+
+def _run(cwd, *args):
+    subprocess.run([sys.executable, "-W", "ignore", SCRIPT] + list(args), cwd=cwd, check=True)
+
+
+def _index_rows(build_dir):
+    dsidx_filepath, = glob.glob(os.path.join(
+        build_dir, "_4_ready_to_be_packaged", "*.docset", "Contents", "Resources", "docSet.dsidx"
+    ))
+    db = sqlite3.connect(dsidx_filepath)
+    rows = set(db.execute('SELECT name, type, path FROM searchIndex'))
+    db.close()
+    return rows
+
+
+def test_merged_shards_match_single_crawl(docs_site, tmp_path):
+    single_dir = tmp_path / "single"
+    sharded_dir = tmp_path / "sharded"
+    single_dir.mkdir()
+    sharded_dir.mkdir()
+
+    _run(single_dir, "create_docset", "--base-url", docs_site, "--sources-url", docs_site, "-o", "MSDN.tgz")
+
+    for shard in ("0/2", "1/2"):
+        _run(sharded_dir, "create_docset", "--shard", shard, "--base-url", docs_site, "--sources-url", docs_site)
+    assert len(glob.glob(str(sharded_dir / "_build_msdn" / "_shard_*"))) == 2
+
+    _run(sharded_dir, "merge", "--base-url", docs_site, "-o", "MSDN.tgz")
+
+    rows = _index_rows(str(sharded_dir / "_build_msdn"))
+    assert rows == _index_rows(str(single_dir / "_build_msdn"))
+    assert any(name == "CREATEFILEW" for name, type, path in rows)
+    assert any(name == "Gdi" for name, type, path in rows)
+    assert os.path.getsize(str(sharded_dir / "MSDN.tgz")) > 0
+
+
+def _index_name(build_dir, page_path):
+    db = sqlite3.connect(os.path.join(
+        build_dir, "_4_ready_to_be_packaged", "MSDN.docset", "Contents", "Resources", "docSet.dsidx"
+    ))
+    row = db.execute('SELECT name FROM searchIndex WHERE path = ?', (page_path,)).fetchone()
+    db.close()
+    return row[0] if row else None
+
+
+def test_watch_rewrites_pages_linking_to_added_and_deleted_pages(tmp_path):
+    site_dir = str(tmp_path / "site")
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    build_dir = str(work_dir / "_build_msdn")
+    documents_dir = os.path.join(
+        build_dir, "_4_ready_to_be_packaged", "MSDN.docset", "Contents", "Resources", "Documents"
+    )
+    drawing_filepath = os.path.join(documents_dir, "docs.microsoft.com", "win32", "gdi", "drawing.html")
+    missing_filepath = os.path.join(documents_dir, "docs.microsoft.com", "win32", "gdi", "missing-page.html")
+    online_href = 'href="https://docs.microsoft.com/en-us/windows/desktop/gdi/missing-page"'
+
+    _build_site(site_dir)
+    with _serve(site_dir) as base_url:
+        urls = ["--base-url", base_url, "--sources-url", base_url, "-o", "out/MSDN.tgz"]
+        _run(work_dir, "create_docset", *urls)
+        with open(drawing_filepath) as html_fd:
+            assert online_href in html_fd.read()
+
+        # a new page, and a renamed TOC entry of its directory
+        win32 = dict(WIN32_PAGES, gdi=['gdi-start', 'drawing', 'missing-page'])
+        _build_site(site_dir, win32, titles={'drawing': "Drawing renamed"})
+        _run(work_dir, "watch", "--once", *urls)
+
+        with open(drawing_filepath) as html_fd:
+            assert 'href="missing-page.html"' in html_fd.read()
+        assert os.path.exists(missing_filepath)
+        assert _index_name(build_dir, "docs.microsoft.com/win32/gdi/drawing.html") == "Drawing renamed"
+
+        # deleted again, the links to it go back online
+        _build_site(site_dir)
+        _run(work_dir, "watch", "--once", *urls)
+
+        with open(drawing_filepath) as html_fd:
+            assert online_href in html_fd.read()
+        assert not os.path.exists(missing_filepath)
+        assert _index_name(build_dir, "docs.microsoft.com/win32/gdi/drawing.html") == "Drawing title"
+
+
+def test_locales_name_entries_after_their_own_tocs(tmp_path):
+    site_dir = str(tmp_path / "site")
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+
+    # a German copy of the site, with its own TOC titles
+    _build_site(site_dir)
+    shutil.copytree(os.path.join(site_dir, "en-us"), os.path.join(site_dir, "de-de"))
+    for toc_filepath in glob.glob(os.path.join(site_dir, "de-de", "**", "toc.json"), recursive=True):
+        with open(toc_filepath) as toc_fd:
+            toc = toc_fd.read()
+        with open(toc_filepath, "w") as toc_fd:
+            toc_fd.write(toc.replace('"toc_title": "', '"toc_title": "DE '))
+
+    with _serve(site_dir) as base_url:
+        _run(
+            work_dir, "create_docset", "--base-url", base_url, "--sources-url", base_url,
+            "--locales", "en-us,de-de", "-o", "out/MSDN.tgz"
+        )
+
+    build_dir = str(work_dir / "_build_msdn")
+    en_rows = _index_rows(build_dir)
+    de_rows = _index_rows(os.path.join(build_dir, "_locales", "de-de"))
+    assert ("Gdi", "Guide", "docs.microsoft.com/win32/gdi/gdi-start.html") in en_rows
+    assert ("DE Gdi", "Guide", "docs.microsoft.com/win32/gdi/gdi-start.html") in de_rows
+    assert set((path, kind) for name, kind, path in en_rows) == set((path, kind) for name, kind, path in de_rows)
+    assert all(name.startswith("DE ") for name, kind, path in de_rows if name)
+    assert os.path.exists(str(work_dir / "out" / "de-de" / "MSDN.tgz"))
+
+
+def test_page_store_round_trip_and_merge(msdn, tmp_path):
+    store = msdn.PageStore(str(tmp_path / "pages.sqlite"))
+    store.put("win32/gdi/drawing.html", b"drawing")
+    store.put("win32/gdi/../index.html", b"index")
+    store.put("win32/img/a.png", PNG)
+    store.set_source("win32/gdi/drawing.html", "https://docs.microsoft.com/en-us/windows/win32/gdi/drawing")
+    store.commit()
+
+    assert store.get("win32/gdi/drawing.html") == b"drawing"
+    assert store.get("win32/index.html") == b"index"
+    assert store.get("win32/missing.html") is None
+    assert store.digest("win32/img/a.png") == hashlib.sha256(PNG).hexdigest()
+    assert "win32/img/a.png" in store
+    assert store.paths(extensions=(".html",)) == ["win32/gdi/drawing.html", "win32/index.html"]
+    assert store.sources() == [
+        ("win32/gdi/drawing.html", "https://docs.microsoft.com/en-us/windows/win32/gdi/drawing")
+    ]
+
+    # a shard store adds its pages and replaces the ones crawled again
+    shard = msdn.PageStore(str(tmp_path / "shard.sqlite"))
+    shard.put("win32/gdi/drawing.html", b"drawing again")
+    shard.put("win32/gdi/gdi-start.html", b"start")
+    shard.close()
+    store.merge(str(tmp_path / "shard.sqlite"))
+    assert store.get("win32/gdi/drawing.html") == b"drawing again"
+    assert store.get("win32/gdi/gdi-start.html") == b"start"
+
+    # blobs no path points to are dropped on close
+    store.delete("win32/img/a.png")
+    store.close()
+    db = sqlite3.connect(str(tmp_path / "pages.sqlite"))
+    assert db.execute('SELECT COUNT(*) FROM blobs').fetchone() == (3,)
+    db.close()
+
+
+def test_page_store_dedups_and_exports_hardlinks(msdn, tmp_path):
+    store = msdn.PageStore(str(tmp_path / "pages.sqlite"))
+    for path in ("win32/img/a.png", "win32/img/b.png", "win32/gdi/img/a.png"):
+        store.put(path, PNG)
+    store.put("win32/gdi/drawing.html", b"drawing")
+    store.commit()
+
+    assert store.dedup_stats() == (4, 2, 2 * len(PNG))
+
+    documents_dir = str(tmp_path / "Documents")
+    assert store.export(documents_dir) == 4
+    store.close()
+
+    copies = [
+        os.path.join(documents_dir, "win32", *path.split('/')) for path in ("img/a.png", "img/b.png", "gdi/img/a.png")
+    ]
+    for filepath in copies:
+        with open(filepath, "rb") as i_fd:
+            assert i_fd.read() == PNG
+        assert os.path.samefile(filepath, copies[0])
+    assert os.stat(copies[0]).st_nlink == 3
+    assert os.stat(os.path.join(documents_dir, "win32", "gdi", "drawing.html")).st_nlink == 1
+
+
+def _make_docset(root, files, rows, fulltext=None, links=()):
+    """ extracted docset folder with Documents files, searchIndex rows and optional full text rows """
+    docset_dir = os.path.join(root, "MSDN.docset")
+    shutil.rmtree(docset_dir, ignore_errors=True)
+    resources_dir = os.path.join(docset_dir, "Contents", "Resources")
+
+    for path, data in files.items():
+        _write(resources_dir, "Documents/%s" % path, data)
+
+    # hardlinked duplicates, as written by the page store export
+    for path, target in links:
+        filepath = os.path.join(resources_dir, "Documents", path)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        os.link(os.path.join(resources_dir, "Documents", target), filepath)
+
+    db = sqlite3.connect(os.path.join(resources_dir, "docSet.dsidx"))
+    db.execute('CREATE TABLE searchIndex(id INTEGER PRIMARY KEY, name TEXT, type TEXT, path TEXT);')
+    db.execute('CREATE UNIQUE INDEX anchor ON searchIndex (name, type, path);')
+    db.executemany('INSERT INTO searchIndex(name, type, path) VALUES (?,?,?)', rows)
+    if fulltext is not None:
+        db.execute('CREATE VIRTUAL TABLE searchBodies USING fts5(path UNINDEXED, title, body);')
+        db.executemany('INSERT INTO searchBodies(path, title, body) VALUES (?,?,?)', fulltext)
+    db.commit()
+    db.close()
+
+    return docset_dir
+
+
+def _read(docset_dir, path):
+    with open(os.path.join(docset_dir, "Contents", "Resources", "Documents", path), "rb") as i_fd:
+        return i_fd.read()
+
+
+def test_docset_delta_round_trip(msdn, tmp_path):
+    previous_dir = _make_docset(
+        str(tmp_path / "previous"),
+        {'a.html': "old a", 'b.html': "b", 'gone.html': "gone", 'img/a.png': "old png"},
+        [("A", "Guide", "a.html"), (None, "Guide", "b.html"), ("Gone", "Guide", "gone.html")],
+        fulltext=[("a.html", "A", "old a"), ("b.html", "B", "b"), ("gone.html", "Gone", "gone")],
+        links=[("img/b.png", "img/a.png")],
+    )
+    previous_manifest = msdn.build_docset_manifest(previous_dir)
+
+    installed_dir = str(tmp_path / "installed" / "MSDN.docset")
+    shutil.copytree(previous_dir, installed_dir)
+    os.remove(os.path.join(installed_dir, "Contents", "Resources", "Documents", "img", "b.png"))
+    os.link(
+        os.path.join(installed_dir, "Contents", "Resources", "Documents", "img", "a.png"),
+        os.path.join(installed_dir, "Contents", "Resources", "Documents", "img", "b.png"),
+    )
+
+    # new duplicates are archived as a file and a link member
+    docset_dir = _make_docset(
+        str(tmp_path / "current"),
+        {'a.html': "new a", 'b.html': "b", 'new.html': "new", 'img/a.png': "new png", 'img/b.png': "old png",
+         'css/site.css': "css"},
+        [("A", "Guide", "a.html"), (None, "Guide", "b.html"), (None, "Function", "new.html")],
+        fulltext=[("a.html", "A", "new a"), ("b.html", "B", "b"), ("new.html", "New", "new")],
+        links=[("css/copy.css", "css/site.css")],
+    )
+    manifest = msdn.build_docset_manifest(docset_dir)
+
+    delta_filepath = str(tmp_path / "MSDN.delta.tgz")
+    delta = msdn.make_docset_delta(previous_manifest, manifest, docset_dir, delta_filepath)
+    assert sorted(delta['changed']) == [
+        "Contents/Resources/Documents/a.html",
+        "Contents/Resources/Documents/css/copy.css",
+        "Contents/Resources/Documents/css/site.css",
+        "Contents/Resources/Documents/img/a.png",
+        "Contents/Resources/Documents/new.html",
+    ]
+    assert delta['deleted'] == ["Contents/Resources/Documents/gone.html"]
+
+    msdn.apply_docset_delta(delta_filepath, installed_dir)
+
+    installed_manifest = msdn.build_docset_manifest(installed_dir)
+    assert installed_manifest['files'] == manifest['files']
+    assert installed_manifest['index'] == manifest['index']
+    assert installed_manifest['fulltext'] == manifest['fulltext']
+
+    # the unchanged hardlinked copy keeps its content
+    assert _read(installed_dir, "img/a.png") == b"new png"
+    assert _read(installed_dir, "img/b.png") == b"old png"
+
+
+def _fulltext_docset(msdn, root, pages):
+    """ docset whose full text index is built from the parsed pages, as create_docset --fulltext does """
+    docset_dir = _make_docset(root, pages, [(path, "Guide", path) for path in pages])
+    dsidx_filepath = os.path.join(docset_dir, "Contents", "Resources", "docSet.dsidx")
+
+    fulltext = msdn.FullTextIndex(os.path.join(root, "fulltext.sqlite"))
+    for path, html in pages.items():
+        fulltext.add_text(path, *msdn.FullTextIndex.page_text(msdn.bs(html, "html.parser")))
+
+    db = sqlite3.connect(dsidx_filepath)
+    fulltext.copy_into(db)
+    db.close()
+    fulltext.close()
+    return docset_dir
+
+
+def _search(dsidx_filepath, query):
+    result = subprocess.run(
+        [sys.executable, "-W", "ignore", SCRIPT, "search", dsidx_filepath, query],
+        check=True, stdout=subprocess.PIPE, universal_newlines=True,
+    )
+    return result.stdout
+
+
+def test_search_fulltext_after_delta(msdn, tmp_path):
+    previous_dir = _fulltext_docset(msdn, str(tmp_path / "previous"), {
+        'a.html': _page("CreateFileW", "Returns ERROR_ACCESS_DENIED when the file is locked."),
+        'b.html': _page("CloseHandle", "Closes an open object handle."),
+    })
+    installed_dir = str(tmp_path / "installed" / "MSDN.docset")
+    shutil.copytree(previous_dir, installed_dir)
+    dsidx_filepath = os.path.join(installed_dir, "Contents", "Resources", "docSet.dsidx")
+
+    output = _search(dsidx_filepath, "ERROR_ACCESS_DENIED")
+    assert "CreateFileW\n  a.html\n" in output
+    assert "1 hits" in output
+    assert "1 hits" in _search(dsidx_filepath, '"object handle"')
+
+    docset_dir = _fulltext_docset(msdn, str(tmp_path / "current"), {
+        'a.html': _page("CreateFileW", "Returns ERROR_SHARING_VIOLATION when the file is locked."),
+        'b.html': _page("CloseHandle", "Closes an open object handle."),
+    })
+    delta_filepath = str(tmp_path / "MSDN.delta.tgz")
+    msdn.make_docset_delta(
+        msdn.build_docset_manifest(previous_dir), msdn.build_docset_manifest(docset_dir), docset_dir, delta_filepath
+    )
+    msdn.apply_docset_delta(delta_filepath, installed_dir)
+
+    # the changed page body replaces its previous row instead of being added next to it
+    db = sqlite3.connect(dsidx_filepath)
+    assert db.execute("SELECT count(*) FROM searchBodies WHERE path = 'a.html'").fetchone() == (1,)
+    assert db.execute("SELECT count(*) FROM searchBodies").fetchone() == (2,)
+    db.close()
+
+    assert "0 hits" in _search(dsidx_filepath, "ERROR_ACCESS_DENIED")
+    assert "CreateFileW\n  a.html\n" in _search(dsidx_filepath, "ERROR_SHARING_VIOLATION")
+    assert "1 hits" in _search(dsidx_filepath, '"object handle"')
+
+
+def _index_schema(dsidx_filepath):
+    db = sqlite3.connect(dsidx_filepath)
+    schema = set(db.execute("SELECT type, name, sql FROM sqlite_master WHERE name NOT LIKE 'sqlite_%'"))
+    page_size, = db.execute('PRAGMA page_size').fetchone()
+    db.close()
+    return schema, page_size
+
+
+def test_tuned_index_matches_build(msdn, tmp_path):
+    build_state = msdn.BuildStateStore(str(tmp_path / "build_state.sqlite"))
+    build_state.add_entry("functions", "CreateFileW", "a.html")
+    build_state.add_entry("guides", "Files", "b.html")
+    build_state.add_entry("guides", "Files", "c.html")
+    build_state.commit()
+
+    configuration = msdn.Configuration(argparse.Namespace(build_dir=str(tmp_path), output=str(tmp_path / "MSDN.tgz")))
+    resources_dir = str(tmp_path / "built")
+    os.makedirs(resources_dir)
+    msdn.create_sqlite_database(configuration, build_state, resources_dir, None)
+    build_state.close()
+
+    built_filepath = os.path.join(resources_dir, "docSet.dsidx")
+    db = sqlite3.connect(built_filepath)
+    # the name unicity checks skip the duplicated name
+    assert set(db.execute('SELECT name, type, path FROM searchIndex')) == {
+        ("CreateFileW", "Function", "a.html"), ("Files", "Guide", "b.html")
+    }
+    query = "EXPLAIN QUERY PLAN SELECT rowid FROM searchIndex WHERE path = 'a.html'"
+    plan = " ".join(row[-1] for row in db.execute(query))
+    assert "searchIndex_path" in plan
+    db.close()
+
+    # an index built before tuning gets the same schema from benchmark --tune
+    docset_dir = _make_docset(str(tmp_path / "previous"), {"a.html": "a"}, [("CreateFileW", "Function", "a.html")])
+    tuned_filepath = os.path.join(docset_dir, "Contents", "Resources", "docSet.dsidx")
+    _run(str(tmp_path), "benchmark", tuned_filepath, "--tune", "-n", "10")
+
+    assert _index_schema(tuned_filepath) == _index_schema(built_filepath)
+
+
+def _write_delta(msdn, delta_filepath, docset_dir, delta, members=()):
+    """ hand made delta archive against the current state of docset_dir """
+    delta = dict({
+        'docset': "MSDN.docset",
+        'base': msdn.manifest_version(msdn.build_docset_manifest(docset_dir)),
+        'changed': {},
+        'deleted': [],
+        'index_added': [],
+        'index_removed': [],
+    }, **delta)
+    delta_json = json.dumps(delta).encode('utf-8')
+
+    with tarfile.open(delta_filepath, "w:gz") as tar:
+        tarinfo = tarfile.TarInfo("delta.json")
+        tarinfo.size = len(delta_json)
+        tar.addfile(tarinfo, io.BytesIO(delta_json))
+
+        for tarinfo, data in members:
+            tar.addfile(tarinfo, io.BytesIO(data) if data is not None else None)
+
+    return delta_filepath
+
+
+def test_apply_delta_rejects_links_outside_the_docset(msdn, tmp_path):
+    docset_dir = _make_docset(str(tmp_path), {'a.html': "a"}, [("A", "Guide", "a.html")])
+
+    link = tarfile.TarInfo("files/Contents/Resources/Documents/a.html")
+    link.type = tarfile.LNKTYPE
+    link.linkname = "files/../../../secret"
+    delta_filepath = _write_delta(
+        msdn, str(tmp_path / "evil.delta.tgz"), docset_dir,
+        {'changed': {"Contents/Resources/Documents/a.html": "0" * 64}}, [(link, None)]
+    )
+
+    with pytest.raises(ValueError, match="link escapes"):
+        msdn.apply_docset_delta(delta_filepath, docset_dir)
+    assert _read(docset_dir, "a.html") == b"a"
+
+
+def test_apply_delta_rejects_deleted_paths_outside_the_docset(msdn, tmp_path):
+    docset_dir = _make_docset(str(tmp_path / "docsets"), {'a.html': "a"}, [("A", "Guide", "a.html")])
+    _write(str(tmp_path), "victim.txt", "victim")
+
+    delta_filepath = _write_delta(
+        msdn, str(tmp_path / "evil.delta.tgz"), docset_dir,
+        {'deleted': ["Contents/Resources/Documents/a.html", "../../victim.txt"]}
+    )
+
+    with pytest.raises(ValueError, match="escapes the docset folder"):
+        msdn.apply_docset_delta(delta_filepath, docset_dir)
+    assert os.path.exists(str(tmp_path / "victim.txt"))
+    assert _read(docset_dir, "a.html") == b"a"
+
+
+def test_apply_delta_rejects_other_base_and_corrupted_files(msdn, tmp_path):
+    docset_dir = _make_docset(str(tmp_path), {'a.html': "a"}, [("A", "Guide", "a.html")])
+
+    other_base = _write_delta(
+        msdn, str(tmp_path / "other.delta.tgz"), docset_dir, {'base': "0" * 64, 'deleted': ["a.html"]}
+    )
+    with pytest.raises(ValueError, match="applies to docset version"):
+        msdn.apply_docset_delta(other_base, docset_dir)
+
+    member = tarfile.TarInfo("files/Contents/Resources/Documents/a.html")
+    member.size = len(b"tampered")
+    corrupted = _write_delta(
+        msdn, str(tmp_path / "corrupted.delta.tgz"), docset_dir,
+        {'changed': {"Contents/Resources/Documents/a.html": hashlib.sha256(b"new").hexdigest()}},
+        [(member, b"tampered")]
+    )
+    with pytest.raises(ValueError, match="does not match its digest"):
+        msdn.apply_docset_delta(corrupted, docset_dir)
+    assert _read(docset_dir, "a.html") == b"a"
+
+
+def test_tarix_member_round_trip(msdn, tmp_path):
+    files = {
+        'a.html': "<html>a</html>",
+        'sub/b.html': "b" * 5000,
+        'img/a.png': PNG,
+        'empty.css': "",
+    }
+    source_dir = _make_docset(
+        str(tmp_path / "build"), files, [("A", "Guide", "a.html")], links=[("img/copy.png", "img/a.png")]
+    )
+    files['img/copy.png'] = PNG
+
+    msdn.make_tarix_docset(source_dir, str(tmp_path / "out"), jobs=2)
+    docset_dir = str(tmp_path / "out" / "MSDN.docset")
+
+    for path, data in files.items():
+        data = data if isinstance(data, bytes) else data.encode('utf-8')
+        assert msdn.read_tarix_member(docset_dir, "Contents/Resources/Documents/%s" % path) == data
+    assert msdn.read_tarix_member(docset_dir, "Contents/Resources/Documents/missing.html") is None
+
+    # the concatenated members are a regular tar.gz, link members included
+    extract_dir = str(tmp_path / "extract")
+    with tarfile.open(os.path.join(docset_dir, "Contents", "Resources", "tarix.tgz"), "r:gz") as tar:
+        tar.extractall(extract_dir, filter="fully_trusted")
+
+    for path, data in files.items():
+        data = data if isinstance(data, bytes) else data.encode('utf-8')
+        assert _read(os.path.join(extract_dir, "MSDN.docset"), path) == data
+
+
+def _rewrite_links(msdn, tmp_path, dead_links, policy):
+    """ rewritten links of a page against an index holding only its sibling B.html """
+    api = "docs.microsoft.com/en-us/windows/win32/api/x"
+    configuration = msdn.Configuration(argparse.Namespace(
+        build_dir=str(tmp_path), output=str(tmp_path / "MSDN.tgz"), dead_links=policy
+    ))
+    html = (
+        '<html><head></head><body>'
+        '<a href="/en-us/windows/win32/api/x/b#remarks" data-linktype="absolute-path">b</a>'
+        '<a href="/en-us/windows/win32/api/x/missing" data-linktype="absolute-path">missing</a>'
+        '<a href="/en-us/windows/win32/api/x/missing#see-also" data-linktype="absolute-path">missing</a>'
+        '<a href="gone" data-linktype="relative-path">gone</a>'
+        '</body></html>'
+    )
+    documents_dir = str(tmp_path / "Documents")
+    link_index = msdn.LinkTargetIndex(["%s/B.html" % api, "%s/a.html" % api])
+
+    soup, resources = msdn.rewrite_soup(
+        configuration, msdn.bs(html, "html.parser"), os.path.join(documents_dir, api, "a.html"), documents_dir,
+        link_index, dead_links
+    )
+    return [(a.get("href"), a.get_text()) for a in soup.find_all("a")], soup
+
+
+def test_dead_links_are_reported_and_follow_the_policy(msdn, tmp_path):
+    api = "docs.microsoft.com/en-us/windows/win32/api/x"
+
+    dead_links = msdn.DeadLinkReport()
+    links, soup = _rewrite_links(msdn, tmp_path, dead_links, "online")
+    assert links == [
+        ("B.html#remarks", "b"),
+        ("https://docs.microsoft.com/en-us/windows/win32/api/x/missing", "missing"),
+        ("https://docs.microsoft.com/en-us/windows/win32/api/x/missing#see-also", "missing"),
+        ("gone.html", "gone"),
+    ]
+
+    # dropped links keep their text
+    dropped = msdn.DeadLinkReport()
+    links, soup = _rewrite_links(msdn, tmp_path, dropped, "drop")
+    assert links == [("B.html#remarks", "b"), ("gone.html", "gone")]
+    assert soup.get_text() == "bmissingmissinggone"
+
+    dead_links.merge(dropped)
+    report_filepath = str(tmp_path / "dead_links.json")
+    dead_links.write(report_filepath)
+    with open(report_filepath) as report_fd:
+        report = json.load(report_fd)
+
+    assert report['dead_links'] == 6
+    assert report['missing_targets'] == 2
+    assert report['targets'][0] == {
+        'target': "%s/missing.html" % api,
+        'count': 4,
+        'href': "/en-us/windows/win32/api/x/missing",
+        'example_page': "%s/a.html" % api,
+    }
+    assert report['targets'][1]['target'] == "%s/gone.html" % api
+
+
+def _rewrite_pages(msdn, tmp_path, pages, name):
+    """ rewrite pages through the rewrite cache of tmp_path, return the cache and the rewritten page paths """
+    configuration = msdn.Configuration(argparse.Namespace(build_dir=str(tmp_path), output=str(tmp_path / "MSDN.tgz")))
+    store = msdn.PageStore(str(tmp_path / ("%s.sqlite" % name)))
+    for path, html in pages.items():
+        store.put(path, html.encode('utf-8'))
+    store.commit()
+
+    rewritten = []
+    rewrite_soup = msdn.rewrite_soup
+
+    def recording_rewrite_soup(configuration, soup, html_path, *args):
+        rewritten.append(os.path.relpath(html_path, str(tmp_path / "Documents")).replace(os.sep, '/'))
+        return rewrite_soup(configuration, soup, html_path, *args)
+
+    cache = msdn.RewriteCache(str(tmp_path / "rewrite_cache.sqlite"), configuration, str(tmp_path))
+    msdn.rewrite_soup = recording_rewrite_soup
+    try:
+        msdn.rewrite_html_contents(configuration, store, str(tmp_path / "Documents"), cache=cache)
+    finally:
+        msdn.rewrite_soup = rewrite_soup
+    cache.close()
+
+    output = {path: store.get(path).decode('utf-8') for path in pages}
+    store.close()
+    return sorted(rewritten), output
+
+
+def test_rewrite_cache_invalidates_only_dependent_pages(msdn, tmp_path, monkeypatch):
+    api = "docs.microsoft.com/en-us/windows/win32/api/x"
+    pages = {
+        "%s/a.html" % api: '<html><head></head><body><a href="/en-us/windows/win32/api/x/b" '
+                           'data-linktype="absolute-path">b</a></body></html>',
+        "%s/b.html" % api: '<html><head></head><body><p>b</p></body></html>',
+        "%s/c.html" % api: '<html><head></head><body><div class="sidebar" role="navigation">nav</div></body></html>',
+    }
+
+    rewritten, output = _rewrite_pages(msdn, tmp_path, pages, "first")
+    assert rewritten == sorted(pages)
+    assert 'href="b.html"' in output["%s/a.html" % api]
+
+    rewritten, output = _rewrite_pages(msdn, tmp_path, pages, "unchanged")
+    assert rewritten == []
+
+    # a rule version bump only rewrites the pages it fired on
+    monkeypatch.setitem(msdn.Configuration.rewrite_rule_versions, "nav : div[class=sidebar role=navigation]", 2)
+    rewritten, output = _rewrite_pages(msdn, tmp_path, pages, "nav_bumped")
+    assert rewritten == ["%s/c.html" % api]
+
+    # a removed link target only rewrites the pages which looked it up
+    del pages["%s/b.html" % api]
+    rewritten, output = _rewrite_pages(msdn, tmp_path, pages, "target_removed")
+    assert rewritten == ["%s/a.html" % api]
+    assert "https://docs.microsoft.com/en-us/windows/win32/api/x/b" in output["%s/a.html" % api]
+
+    # the entries of the removed page and of the previous rule version are pruned
+    db = sqlite3.connect(str(tmp_path / "rewrite_cache.sqlite"))
+    assert db.execute('SELECT COUNT(*) FROM rewrites').fetchone()[0] == 2
+    db.close()
+
+
+def test_crawl_by_priority_fetches_tocs_when_reached(msdn, tmp_path, monkeypatch):
+    sources = {
+        "sdk-api-docs/sdk-api-src/content/winuser/index.md": "",
+        "sdk-api-docs/sdk-api-src/content/winuser/nl-winuser-helper.md": "",
+        "sdk-api-docs/sdk-api-src/content/fileapi/index.md": "",
+        "sdk-api-docs/sdk-api-src/content/fileapi/nf-fileapi-createfilew.md": "",
+        "win32-docs/desktop-src/gdi/drawing.md": "",
+        "win32-docs/desktop-src/ADSchema/c-user.md": "",
+    }
+    for path, data in sources.items():
+        _write(str(tmp_path), path, data)
+
+    fetched = []
+
+    def fetch_textfile(url, params=None):
+        fetched.append(url)
+        return json.dumps({'items': [{'toc_title': "title", 'href': "drawing"}]})
+
+    def download_page(url, pages, page_path):
+        fetched.append(url)
+        pages.put(page_path, b"<html></html>")
+        return True
+
+    monkeypatch.setattr(msdn, "fetch_textfile", fetch_textfile)
+    monkeypatch.setattr(msdn, "download_page", download_page)
+
+    configuration = msdn.Configuration(argparse.Namespace(build_dir=str(tmp_path), output=str(tmp_path / "MSDN.tgz")))
+    configuration.snapshot_interval = 3600
+    pages = msdn.PageStore(str(tmp_path / "pages.sqlite"))
+    build_state = msdn.BuildStateStore(str(tmp_path / "build_state.sqlite"))
+    snapshots = []
+    msdn.crawl_contents(
+        configuration, pages, str(tmp_path), str(tmp_path), build_state, lambda: snapshots.append(len(fetched))
+    )
+
+    api = "%s/windows/win32/api" % configuration.locale_url
+    win32 = "%s/windows/win32" % configuration.locale_url
+    # reference pages first, the TOC of their directory just before them
+    assert fetched[:2] == ["%s/fileapi/toc.json" % api, "%s/fileapi/nf-fileapi-createfilew" % api]
+
+    # ADSchema classes
+    assert fetched[2:4] == ["%s/ADSchema/c-user" % win32, "%s/ADSchema/toc.json" % win32]
+
+    # the rest of sdk-api, in source folder order : the winuser TOC is only needed now
+    assert sorted(fetched[4:8]) == sorted([
+        "%s/winuser/toc.json" % api,
+        "%s/winuser" % api,
+        "%s/fileapi" % api,
+        "%s/winuser/nl-winuser-helper" % api,
+    ])
+    assert fetched.index("%s/winuser/toc.json" % api) < fetched.index("%s/winuser" % api)
+
+    # win32 guides
+    assert fetched[8:] == ["%s/gdi/drawing" % win32, "%s/gdi/toc.json" % win32]
+    assert snapshots == [2, 4, 8]
+    build_state.close()
+    pages.close()
+
+
+def _png_chunks(data):
+    offset = 8
+    while offset < len(data):
+        length, chunk_type = struct.unpack(">I4s", data[offset:offset + 8])
+        yield chunk_type, data[offset + 8:offset + 8 + length]
+        offset += 12 + length
+
+
+def test_png_optimization_keeps_chunks_and_pixels(msdn):
+    def chunk(chunk_type, chunk_data):
+        crc = zlib.crc32(chunk_type + chunk_data)
+        return struct.pack(">I", len(chunk_data)) + chunk_type + chunk_data + struct.pack(">I", crc)
+
+    # 64x64 grey png, stored without compression across two IDAT chunks
+    pixels = b"".join(b"\x00" + bytes(x % 4 for x in range(64)) for _ in range(64))
+    idat = zlib.compress(pixels, 0)
+    png = (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", 64, 64, 8, 0, 0, 0, 0))
+        + chunk(b"iCCP", b"profile\x00\x00" + zlib.compress(bytes(range(128))))
+        + chunk(b"IDAT", idat[:100])
+        + chunk(b"IDAT", idat[100:])
+        + chunk(b"tEXt", b"Comment\x00kept")
+        + chunk(b"IEND", b"")
+    )
+
+    optimized = msdn.optimize_image(".png", png)
+    assert len(optimized) < len(png)
+
+    chunks = list(_png_chunks(optimized))
+    assert [chunk_type for chunk_type, _ in chunks] == [b"IHDR", b"iCCP", b"IDAT", b"tEXt", b"IEND"]
+    assert chunks[1] == list(_png_chunks(png))[1]
+    assert zlib.decompress(chunks[2][1]) == pixels
+
+    # anything that is not a png is returned as is
+    assert msdn.optimize_image(".png", b"GIF89a") == b"GIF89a"
+
+
+def _jpeg_segment(marker, payload):
+    return b"\xff" + bytes([marker]) + struct.pack(">H", len(payload) + 2) + payload
+
+
+@pytest.mark.skipif(shutil.which("jpegtran") is None, reason="jpegtran is not installed")
+def test_jpeg_optimization_keeps_icc_profile_and_exif(msdn):
+    icc_profile = b"ICC_PROFILE\x00\x01\x01" + bytes(range(128))
+    exif = b"Exif\x00\x00MM\x00\x2a\x00\x00\x00\x08\x00\x01\x01\x12\x00\x03\x00\x00\x00\x01\x00\x06\x00\x00"
+
+    # 8x8 grey baseline jpeg, tagged with a colour profile and a rotated orientation
+    jpeg = (
+        b"\xff\xd8"
+        + _jpeg_segment(0xe1, exif)
+        + _jpeg_segment(0xe2, icc_profile)
+        + _jpeg_segment(0xdb, b"\x00" + b"\x01" * 64)
+        + _jpeg_segment(0xc0, b"\x08\x00\x08\x00\x08\x01\x01\x11\x00")
+        + _jpeg_segment(0xc4, b"\x00\x01" + b"\x00" * 16)
+        + _jpeg_segment(0xc4, b"\x10\x01" + b"\x00" * 16)
+        + _jpeg_segment(0xda, b"\x01\x01\x00\x00\x3f\x00")
+        + b"\x3f\xff\xd9"
+    )
+
+    optimized = msdn._optimize_jpeg(jpeg)
+    assert optimized != jpeg
+    assert _jpeg_segment(0xe2, icc_profile) in optimized
+    assert _jpeg_segment(0xe1, exif) in optimized
+
+
+def test_transport_fetches_concurrent_requests_once(msdn, tmp_path):
+    _write(str(tmp_path), "page.html", "page")
+    transport = msdn.HttpTransport(pool_size=8)
+
+    with _serve(str(tmp_path), _SlowCountingHandler) as base_url:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            contents = list(executor.map(lambda url: transport.get_content(url), [base_url + "/page.html"] * 8))
+            missing = list(executor.map(lambda url: transport.get_content(url), [base_url + "/missing.html"] * 2))
+
+        # once done, the url is fetched again
+        assert transport.get_text(base_url + "/page.html") == "page"
+
+    assert contents == [b"page"] * 8
+    assert missing == [None, None]
+    assert _SlowCountingHandler.requests["/page.html"] == 2
+    assert _SlowCountingHandler.requests["/missing.html"] == 1
+
+    report = transport.report(str(tmp_path / "http_requests.json"))
+    assert report['urls'] == 2
+    assert report['requests'] == 3
+    assert report['deduplicated'] == 8
+    assert report['repeated'] == [{'url': base_url + "/page.html", 'requests': 2, 'bytes': 8}]
+    assert report['failed'] == [{'url': base_url + "/missing.html", 'requests': 1, 'status': 404}]
+
+
+def test_theme_stylesheets_follow_their_references(msdn, tmp_path):
+    root = str(tmp_path / "site")
+    _write(root, "_themes/styles/base.css", 'body { background: url("../fonts/../img/bg.png") }')
+    _write(root, "_themes/img/bg.png", PNG)
+    _write(root, "fonts/cdn.woff", "woff")
+
+    with _serve(root, _SlowCountingHandler) as base_url, _serve(root, _SlowCountingHandler) as external_url:
+        _write(root, "_themes/styles/site.css", (
+            '@import "base.css";\n'
+            '.a { background: url(\'../img/bg.png#icon\') }\n'
+            '.b { background: url(data:image/png;base64,AAAA) }\n'
+            '.c { background: url(missing.png) }\n'
+            '@font-face { src: url(%s/fonts/cdn.woff) }\n' % external_url
+        ))
+
+        configuration = msdn.Configuration(argparse.Namespace(
+            build_dir=str(tmp_path), output=str(tmp_path / "MSDN.tgz"), base_url=base_url
+        ))
+        theme = "docs.microsoft.com/_themes"
+        external = "docs.microsoft.com/_external/%s" % external_url.split("//")[1]
+        resources = {msdn.ThemeResourceRecord("%s/_themes/styles/site.css" % base_url, "%s/styles/site.css" % theme)}
+
+        _SlowCountingHandler.requests.clear()
+        cache = msdn.ThemeResourceCache(str(tmp_path / "theme_cache.sqlite"))
+        pages = msdn.PageStore(str(tmp_path / "pages.sqlite"))
+        assert msdn.fetch_theme_resources(configuration, pages, resources, cache) == 4
+
+        assert pages.get("%s/styles/site.css" % theme).decode('utf-8') == (
+            '@import "base.css";\n'
+            '.a { background: url(\'../img/bg.png#icon\') }\n'
+            '.b { background: url(data:image/png;base64,AAAA) }\n'
+            '.c { background: url(missing.png) }\n'
+            '@font-face { src: url(../../_external/%s/fonts/cdn.woff) }\n' % external_url.split("//")[1]
+        )
+        assert pages.get("%s/styles/base.css" % theme) == b'body { background: url("../img/bg.png") }'
+        assert pages.get("%s/img/bg.png" % theme) == PNG
+        assert pages.get("%s/fonts/cdn.woff" % external) == b"woff"
+        assert "%s/styles/missing.png" % theme not in pages
+
+        # every resource is downloaded once, even when referenced twice
+        assert _SlowCountingHandler.requests["/_themes/img/bg.png"] == 1
+
+        # the next build only tries the missing resource again
+        _SlowCountingHandler.requests.clear()
+        assert msdn.fetch_theme_resources(configuration, pages, resources, cache) == 4
+        assert dict(_SlowCountingHandler.requests) == {"/_themes/styles/missing.png": 1}
+        cache.close()
+        pages.close()
+
+
+def test_verify_reports_broken_index_rows_links_and_assets(msdn, tmp_path):
+    docset_dir = _make_docset(str(tmp_path), {
+        'win32/a.html': (
+            '<html><head><link rel="stylesheet" href="../css/site.css">'
+            '<script src="../js/missing.js"></script></head>'
+            '<body><a href="b.html#remarks">b</a><a href="missing.html">missing</a><a href="#top">top</a>'
+            '<a href="https://docs.microsoft.com/en-us/windows/win32/">online</a>'
+            '<img src=\'../img/a.png\'></body></html>'
+        ),
+        'win32/b.html': '<html><body><a href="a.html?view=1">a</a></body></html>',
+        'css/site.css': 'a { background: url("../img/a.png") } @font-face { src: url(fonts/gone.woff) }',
+        'img/a.png': PNG,
+    }, [("A", "Guide", "win32/a.html"), ("B", "Guide", "win32/b.html#remarks"), ("Gone", "Guide", "win32/gone.html")])
+
+    report_filepath = str(tmp_path / "broken.json")
+    _run(str(tmp_path), "verify", docset_dir, "--max-broken", "4", "--report", report_filepath)
+    with open(report_filepath) as report_fd:
+        report = json.load(report_fd)
+
+    assert (report['index_rows'], report['documents'], report['references']) == (3, 3, 8)
+    assert report['broken_index'] == [{'document': "win32/gone.html", 'reference': "win32/gone.html"}]
+    assert report['broken_link'] == [{'document': "win32/a.html", 'reference': "missing.html"}]
+    assert report['broken_asset'] == [
+        {'document': "css/site.css", 'reference': "fonts/gone.woff"},
+        {'document': "win32/a.html", 'reference': "../js/missing.js"},
+    ]
+
+    # past --max-broken the command fails
+    result = subprocess.run(
+        [sys.executable, "-W", "ignore", SCRIPT, "verify", docset_dir, "--max-broken", "3"],
+        cwd=str(tmp_path), stdout=subprocess.PIPE,
+    )
+    assert result.returncode == 1